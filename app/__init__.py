@@ -3,9 +3,12 @@
 import re
 from datetime import datetime
 from getpass import getpass
-from mongoengine import connect, disconnect, get_connection
+from mongoengine import connect, disconnect, get_connection, register_connection
 from pymongo.errors import OperationFailure
-from utils import print_cr
+from utils import (
+    print_cr, register_metrics_listener, register_trace_listener, register_census_listener,
+    census_enabled, finish_census, MetricsReport, span,
+)
 
 from app.config import (
     ATLAS_URI,
@@ -15,13 +18,14 @@ from app.config import (
     GEN_USER,
     GEN_PWD,
     ALL_STATES,
+    METADATA_DB,
+    METADATA_ALIAS,
+    PRODUCTION_RETENTION,
+    BUILD_REPORTS_DIR,
 )
 from app.build import (
-    refresh_tiger,
-    refresh_asthma,
-    refresh_daily_kos,
-    refresh_jobs,
-    refresh_environmental_orgs,
+    BuildScheduler, BuildManifest, get_upstream_stages, propagate_changes, promotion,
+    checkpoints,
 )
 
 
@@ -63,21 +67,34 @@ class ClimateCabinetDBManager:
             else [s for state in SKIP_STATES for s in state]
         )
 
+    def _get_build_states(self, targets_only):
+        """Returns the states (as found in ALL_STATES) that a build should load data for"""
+        states_to_skip = self._get_skip_states(targets_only)
+        return [state for state in ALL_STATES if state[0] not in states_to_skip]
+
+    def _get_host(self, db_name):
+        return (
+            f"mongodb://127.0.0.1:27017/{db_name}"
+            if self._local
+            else ATLAS_URI.format(usr=self.user, pwd=self.pwd, db=db_name)
+        )
+
+    @property
+    def host(self):
+        """The URI of the database being managed, ie - for worker processes to connect to"""
+        return self._get_host(self.db_name)
+
     def _get_production_db_name(self):
-        """Finds and returns the name of the current production database.
+        """Finds and returns the name of the current production database, on clusters where
+        no database has been promoted yet (see promote) - otherwise, the production pointer
+        in the metadata database is read instead.
 
         All production databases following a specific naming convention, which is
         the world 'production' followed by the date the database was built and deployed,
         all of which is separated by dashes. The database on the cloud server with
         the most recent build date is considered the current production database.
         """
-        connect(
-            host=(
-                "mongodb://127.0.0.1:27017/TEMP"
-                if self._local
-                else ATLAS_URI.format(usr=self.user, pwd=self.pwd, db="TEMP")
-            )
-        )
+        connect(host=self._get_host("TEMP"))
 
         dbs = list(
             filter(
@@ -108,17 +125,21 @@ class ClimateCabinetDBManager:
         if not quiet:
             print(GEN_WELCOME)
 
+        # must be registered before any connection is made, to capture the build's traffic
+        register_metrics_listener()
+        register_trace_listener()
+        register_census_listener()
+        # only registered, so the client is made the first time the metadata is actually
+        # read (ie - not at all for most sessions)
+        register_connection(METADATA_ALIAS, host=self._get_host(METADATA_DB))
+
         # if no db name is provided, get the current production database from local or cloud
         if not self.db_name:
-            self.db_name = self._get_production_db_name()
-
-        connect(
-            host=(
-                f"mongodb://127.0.0.1:27017/{self.db_name}"
-                if self._local
-                else ATLAS_URI.format(usr=self.user, pwd=self.pwd, db=self.db_name)
+            self.db_name = (
+                promotion.get_production_db_name() or self._get_production_db_name()
             )
-        )
+
+        connect(host=self._get_host(self.db_name))
 
         try:  # ensure that we've successfully connected to the cluster
             get_connection().server_info()
@@ -149,38 +170,180 @@ class ClimateCabinetDBManager:
         if not quiet:
             print("\nDisconnecting from the database.")
         disconnect()
+        disconnect(alias=METADATA_ALIAS)
 
-    def build(self, datasets=None, targets_only=None, slim=None):
-        states_to_skip = self._get_skip_states(targets_only)
+    def _run_scheduler(self, operation, scheduler):
+        """Runs a BuildScheduler, then writes the metrics of every unit that finished to a
+        JSON report in BUILD_REPORTS_DIR and prints them by stage - whether or not the run
+        succeeded. The query census (see utils.query_census) is reported alongside, if on.
+        """
+        scheduler.report = MetricsReport(self.db_name)
+        start = datetime.now()
+
+        try:
+            with span(operation, cat='build', units=len(scheduler)):
+                scheduler.run()
+        finally:
+            path = BUILD_REPORTS_DIR / f"{self.db_name}-{operation}-{start:%Y%m%d-%H%M%S}.json"
+            census = finish_census() if census_enabled() else None
+            scheduler.report.write(
+                path,
+                operation=operation,
+                workers=scheduler.workers,
+                date_started=start.isoformat(),
+                wall_s=(datetime.now() - start).total_seconds(),
+                **({'query_census': census.as_dict()} if census is not None else {}),
+            )
 
+            if census is not None:
+                print(f"\n{census.summary(client=get_connection())}")
+
+            print(f"\n{scheduler.report.table(by='stage')}")
+            print(f"\nMetrics of {len(scheduler.report.units)} units written to:\n\t{path}")
+
+    def build(self, datasets=None, targets_only=None, slim=None, workers=None):
+        """Loads every dataset into the database, running each stage state-by-state on a
+        pool of worker processes (see BuildScheduler). Each (stage, state) unit is
+        checkpointed as it runs, so that a failed build can be picked back up with resume.
+        """
         print(f"\nDatabase build beginning at {(start := datetime.now())}")
+        promotion.stage(self.db_name)
 
-        refresh_tiger(states_to_skip)
-        refresh_environmental_orgs(states_to_skip, False)
-        refresh_daily_kos(states_to_skip)
-        refresh_asthma(states_to_skip)
-        refresh_jobs(states_to_skip)
+        stages = {
+            'tiger': {},
+            # unloading first keeps the unit idempotent, should the build be resumed
+            'environmental_orgs': {'unload': True},
+            'daily_kos': {},
+            'asthma': {},
+            'jobs': {},
+        }
+        states = self._get_build_states(targets_only)
+        checkpoints.start_build(stages, states)
+
+        self._run_scheduler('build', BuildScheduler(
+            stages,
+            states,
+            self.host,
+            workers=workers,
+            manifest=BuildManifest(stages, states),
+            checkpoint=True,
+        ))
+        checkpoints.finish_build()
 
         print(
             f"\nDatabase build ending at {datetime.now()}, a total "
             f"runtime of {datetime.now() - start}\n"
         )
 
-    def refresh(self, datasets, targets_only, slim):
-        states_to_skip = self._get_skip_states(targets_only)
+    def resume(self, workers=None):
+        """Picks a failed (or interrupted) build back up, running only the units that
+        hadn't completed before it stopped, with the same stages and states it started with.
+        """
+        plan = checkpoints.get_build_plan()
 
+        if plan.date_completed:
+            print(f"\nThe build of '{self.db_name}' completed at {plan.date_completed}")
+            return
+
+        print(f"\nDatabase build resuming at {(start := datetime.now())}")
+
+        states = [state for state in ALL_STATES if state[0] in plan.states]
+        scheduler = BuildScheduler(
+            plan.stages,
+            states,
+            self.host,
+            workers=workers,
+            manifest=BuildManifest(plan.stages, states),
+            checkpoint=True,
+        )
+
+        print(f"{len(scheduler)}/{len(plan.stages) * len(states)} units left to run")
+        self._run_scheduler('resume', scheduler)
+        checkpoints.finish_build()
+
+        print(
+            f"\nDatabase build ending at {datetime.now()}, a total "
+            f"runtime of {datetime.now() - start}\n"
+        )
+
+    def refresh(self, datasets, targets_only, slim, workers=None, full=False):
+        """Reloads the given datasets, for only the states whose cleaned data has changed
+        since it was last loaded (see BuildManifest), or for every state if full is True.
+
+        The stages the datasets depend on (ie - tiger) are checked for changes too, and any
+        that were loaded into the database and have changed since are reloaded for the
+        states that changed - along with the given datasets, for those states.
+        """
         print(f"\nDatabase build beginning at {(start := datetime.now())}")
 
-        if 'environmental_orgs' in datasets:
-            refresh_environmental_orgs(states_to_skip, True)
-        if 'daily_kos' in datasets:
-            refresh_daily_kos(states_to_skip)
-        if 'asthma' in datasets:
-            refresh_asthma(states_to_skip)
-        if 'jobs' in datasets:
-            refresh_jobs(states_to_skip)
+        states = self._get_build_states(targets_only)
+        upstream = get_upstream_stages(datasets)
+        manifest = BuildManifest(list(datasets) + sorted(upstream), states)
+
+        changed = {
+            name: (
+                {state[0] for state in states} if full else manifest.changed_states(name)
+            )
+            for name in datasets
+        }
+        changed.update({
+            name: abbrs for name in upstream
+            if (abbrs := manifest.changed_states(name, recorded_only=True))
+        })
+        changed = propagate_changes(changed)
+
+        for name in changed:
+            print(f"{name}: {len(changed[name])}/{len(states)} states to refresh")
+
+        self._run_scheduler('refresh', BuildScheduler(
+            {
+                name: ({'unload': True} if name == 'environmental_orgs' else {})
+                for name in changed
+            },
+            {name: [state for state in states if state[0] in changed[name]] for name in changed},
+            self.host,
+            workers=workers,
+            manifest=manifest,
+        ))
 
         print(
             f"\nDatabase build ending at {datetime.now()}, a total "
             f"runtime of {datetime.now() - start}\n"
         )
+
+    def promote(self, targets_only=None, retention=PRODUCTION_RETENTION):
+        """Validates the database, then atomically makes it the production database that
+        connect() resolves to. Retired production databases beyond the retention most
+        recent are then dropped (see app.build.promotion).
+
+        The database is validated against the states in its build plan, or the states
+        given by targets_only if it has none.
+        """
+        print(f"\nValidating database '{self.db_name}' for promotion")
+
+        planned = checkpoints.get_planned_states()
+        states = (
+            [state for state in ALL_STATES if state[0] in planned]
+            if planned is not None
+            else self._get_build_states(targets_only)
+        )
+
+        validations = promotion.validate_database(states)
+        timings = promotion.time_queries()
+
+        for name, result in validations.items():
+            print(f"\t{'passed' if result['passed'] else 'FAILED'}: {name} {result}")
+        for name, runtime in timings.items():
+            print(f"\t{name}: {runtime}ms")
+
+        if failed := [name for name, result in validations.items() if not result['passed']]:
+            raise Exception(
+                f"\n\nCCDB Manager Error - database '{self.db_name}' failed validation, "
+                f"and was not promoted: {', '.join(failed)}"
+            )
+
+        previous = promotion.promote(self.db_name, validations, timings)
+        print(f"\nPromoted '{self.db_name}' to production (previously '{previous}')")
+
+        for db_name in promotion.collect_garbage(retention):
+            print(f"\tDropped retired database '{db_name}'")
@@ -1,8 +1,13 @@
 from .tiger import *
 from .daily_kos import *
+from .geo_fragments import *
 from .environmental_orgs import *
 from .asthma import *
 from .jobs import *
+from .scheduler import *
+from .manifest import *
+from .promotion import *
+from .checkpoints import *
 
 __all__ = (
     # tiger.py
@@ -11,8 +16,28 @@ __all__ = (
     refresh_environmental_orgs,
     # daily_kos.py
     refresh_daily_kos,
+    # geo_fragments.py
+    refresh_geo_fragments,
     # asthma.py
     refresh_asthma,
     # jobs.py
     refresh_jobs,
+    # scheduler.py
+    BuildScheduler,
+    get_upstream_stages,
+    propagate_changes,
+    # manifest.py
+    BuildManifest,
+    # promotion.py
+    get_production_db_name,
+    stage,
+    validate_database,
+    time_queries,
+    promote,
+    collect_garbage,
+    # checkpoints.py
+    start_build,
+    get_build_plan,
+    get_planned_states,
+    finish_build,
 )
@@ -3,37 +3,52 @@
 """
 import pandas as pd
 from halo import Halo
-from utils import switch_halo_icon, update_halo_base, update_halo_scroll
-from app.models import Region, RegionType, AsthmaData
-from app.config import AsthmaDataset as AD
-from app.lookups.ccid import assemble_ccid
-from mongoengine.queryset.visitor import Q
+from utils import (
+    switch_halo_icon, update_halo_base, update_halo_scroll, print_warning, count_rows
+)
+from app.models import RegionType, AsthmaData, FragmentGraph
+from app.config import AsthmaDataset as AD, DEFAULT_BATCH_INSERT_SIZE
+from app.lookups.ccid import assemble_ccids
+from app.build.bulk import find_existing_ccids, bulk_set_by_ccid, unset_missing_ccids
 
 AK = AD.AsthmaKeys
+CCID = 'ccid'
+KEYS_TO_FIELDS = {
+    AK.POP: 'population',
+    AK.ADULT: 'adult',
+    AK.CHILD: 'child',
+    AK.NON_WHITE: 'non_white',
+    AK.POVERTY: 'poverty',
+}
 spinner = Halo()
 
 
-def refresh_region_asthma(row, num_regions):
-    """Refreshes the asthma counts for a single region"""
-    region = Region.objects.get(
-        ccid=assemble_ccid(RegionType.COUNTY, row[AK.COUNTY], state=row[AK.STATE])
-    )
+def get_asthma_docs(df):
+    """Builds an AsthmaData document (as a raw dict) for every row of the dataset"""
+    return [
+        AsthmaData(**fields, extrapolated=False).to_mongo()
+        for fields in df[list(KEYS_TO_FIELDS)].rename(columns=KEYS_TO_FIELDS).to_dict('records')
+    ]
 
-    region.update(
-        asthma=AsthmaData(
-            population=row[AK.POP],
-            adult=row[AK.ADULT],
-            child=row[AK.CHILD],
-            non_white=row[AK.NON_WHITE],
-            poverty=row[AK.POVERTY],
-            extrapolated=False,
-        )
-    )
 
-    update_halo_scroll(spinner, f"{row.name}/{num_regions}")
+def report_unloaded_rows(df, missing_ccids):
+    """Prints a summary of the rows in the dataset that couldn't be loaded"""
+    unreadable = df[df[CCID].isna()]
+    missing = df[df[CCID].isin(missing_ccids)]
 
+    for label, rows in [
+        ("could not be interpreted as a county", unreadable),
+        ("have no matching region in the database", missing),
+    ]:
+        if not rows.empty:
+            names = [f"{r[AK.COUNTY]}, {r[AK.STATE]}" for _, r in rows.head(10).iterrows()]
+            print_warning(
+                f"{len(rows)} asthma rows {label}, and were skipped: "
+                f"{'; '.join(names)}{' ...' if len(rows) > 10 else ''}"
+            )
 
-def refresh_asthma(states_to_skip):
+
+def refresh_asthma(states_to_skip, batch_size=DEFAULT_BATCH_INSERT_SIZE):
     """Refreshes the asthma counts"""
     print("\n~~ Refreshing Asthma Data ~~")
     switch_halo_icon(spinner)
@@ -42,22 +57,32 @@ def refresh_asthma(states_to_skip):
     update_halo_base(spinner, "Opening asthma dataset")
     df = pd.read_csv(AD.DATASET)
     df = df[~df[AK.STATE].isin(states_to_skip)].reset_index(drop=True)
+    count_rows(len(df))
+    df[CCID] = assemble_ccids(RegionType.COUNTY, df[AK.COUNTY], df[AK.STATE], errors='coerce')
 
     update_halo_base(spinner, "Refreshing asthma data from dataset")
-    df.apply(refresh_region_asthma, args=[len(df)], axis=1)
+    missing_ccids = set(df[CCID].dropna()) - find_existing_ccids(df[CCID].dropna())
+    loadable = df[df[CCID].notna() & ~df[CCID].isin(missing_ccids)]
 
-    update_halo_base(spinner, "Extrapolating for regions without direct data")
-    target_regions = Region.objects.only('id', 'fragments', 'ccid', 'asthma')(
-        Q(state_abbr__nin=states_to_skip)
-        & Q(fragments__exists=True)
-        & (Q(asthma__exists=False) | Q(asthma__extrapolated=True))
+    bulk_set_by_ccid('asthma', zip(loadable[CCID], get_asthma_docs(loadable)), batch_size)
+    update_halo_scroll(spinner, f"{len(loadable)}/{len(df)}")
+
+    # direct data left behind by rows removed from the dataset since it was last loaded
+    unset_missing_ccids(
+        'asthma', states_to_skip, loadable[CCID], query={'asthma.extrapolated': False}
     )
 
-    for i, region in enumerate(target_regions):
-        region.update(
-            asthma=region.extrapolate_count(AsthmaData, RegionType.COUNTY, 'asthma')
-        )
+    update_halo_base(spinner, "Extrapolating for regions without direct data")
+    graph = FragmentGraph.load(['asthma'], states_to_skip)
+    target_regions = graph.targets('asthma')
+
+    update_halo_scroll(spinner, f"{len(target_regions)} regions")
+    extrapolated = graph.extrapolate_all(
+        target_regions, AsthmaData, RegionType.COUNTY, 'asthma', method='count'
+    )
 
-        update_halo_scroll(spinner, f"{i}/{len(target_regions)}")
+    update_halo_scroll(spinner, "writing...")
+    graph.write('asthma', extrapolated)
 
     spinner.succeed("Done!")
+    report_unloaded_rows(df, missing_ccids)
@@ -0,0 +1,56 @@
+"""Helpers for writing dataset rows onto documents in the Region collection in bulk.
+
+"""
+from pymongo import UpdateOne
+from utils import span
+from app.models import Region
+from app.config import DEFAULT_BATCH_INSERT_SIZE
+
+
+def find_existing_ccids(ccids):
+    """Returns the subset of the given CCIDs that belong to a Region, using one query."""
+    return set(Region._get_collection().distinct('ccid', {'ccid': {'$in': list(set(ccids))}}))
+
+
+def unset_missing_ccids(field, states_to_skip, ccids, query=None):
+    """Unsets a field on every region in the states being loaded whose CCID isn't one of the
+    given ones, ie - the regions whose rows were removed from a dataset since it was last
+    loaded. The field is only unset where it matches query, if given.
+
+    Returns:
+        int: the number of regions the field was unset on.
+    """
+    return Region._get_collection().update_many(
+        {
+            'state_abbr': {'$nin': list(states_to_skip)},
+            'ccid': {'$nin': list(set(ccids))},
+            field: {'$exists': True},
+            **(query or {}),
+        },
+        {'$unset': {field: True}},
+    ).modified_count
+
+
+def bulk_set_by_ccid(field, ccids_and_values, batch_size=DEFAULT_BATCH_INSERT_SIZE):
+    """Sets a single field on many regions, keyed by CCID.
+
+    The updates are sent as unordered bulk writes of at most batch_size operations each.
+
+    Args:
+        field (str): the name of the Region field to set.
+        ccids_and_values ([(str, object)]): (CCID, value) pairs.
+        batch_size (int, optional): the maximum number of updates sent per bulk write.
+
+    Returns:
+        int: the number of regions matched by the updates.
+    """
+    ops = [UpdateOne({'ccid': ccid}, {'$set': {field: value}}) for ccid, value in ccids_and_values]
+    matched = 0
+
+    for i in range(0, len(ops), batch_size):
+        with span(f"set {field}", cat='flush', ops=len(ops[i:i + batch_size])):
+            matched += Region._get_collection().bulk_write(
+                ops[i:i + batch_size], ordered=False
+            ).matched_count
+
+    return matched
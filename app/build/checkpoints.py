@@ -0,0 +1,81 @@
+"""Persists the plan and per-unit progress of a database build, in the database being built.
+
+A build saves its plan (see start_build) before any unit runs, and the BuildScheduler
+checkpoints each (stage, state) unit as it starts, completes or fails. Resuming a build
+reads the plan back (see get_build_plan), and reruns only the units that never completed.
+
+Every unit can safely be run more than once: TIGER Regions are upserted by CCID and Shapes
+by (CCID, year), fragments lists are replaced whole, asthma and jobs data are set by CCID,
+and environmental orgs are unloaded for the unit's state before they're loaded again.
+"""
+from datetime import datetime
+from app.models import BuildPlan, BuildCheckpoint
+from app.models.checkpoint import STARTED, COMPLETE, FAILED
+
+
+def start_build(stages, states):
+    """Saves the plan of a new build, discarding any previous build's plan and checkpoints.
+
+    Args:
+        stages ({str: dict}): the names of the stages to run, mapped to any extra keyword
+            arguments for that stage's refresh_* function.
+        states ([tuple]): the states (as found in ALL_STATES) to run every stage for.
+    """
+    BuildCheckpoint.objects.delete()
+    BuildPlan.objects.delete()
+    BuildPlan(stages=stages, states=[state[0] for state in states]).save()
+
+
+def get_build_plan():
+    """Returns the plan of the build in the connected database."""
+    plan = BuildPlan.objects.first()
+
+    if plan is None:
+        raise Exception(
+            "Build Checkpoint Error - no build plan was found in this database, so there "
+            "is no build to resume."
+        )
+
+    return plan
+
+
+def get_planned_states():
+    """Returns the abbreviations of the states in the connected database's build plan, or
+    None if it has none (ie - it was built before build plans were saved).
+    """
+    plan = BuildPlan.objects.only('states').first()
+    return plan.states if plan else None
+
+
+def finish_build():
+    BuildPlan.objects.update(set__date_completed=datetime.utcnow())
+
+
+def get_completed_units():
+    """Returns the (stage, state abbreviation) of every unit that has completed."""
+    return {
+        (c['stage'], c['state_abbr'])
+        for c in BuildCheckpoint.objects(status=COMPLETE)
+        .only('stage', 'state_abbr').as_pymongo()
+    }
+
+
+def checkpoint_unit(stage, abbr, status, error=None):
+    BuildCheckpoint.objects(stage=stage, state_abbr=abbr).update_one(
+        upsert=True,
+        set__status=status,
+        set__error=error,
+        set__date_modified=datetime.utcnow(),
+    )
+
+
+def start_unit(stage, abbr):
+    checkpoint_unit(stage, abbr, STARTED)
+
+
+def complete_unit(stage, abbr):
+    checkpoint_unit(stage, abbr, COMPLETE)
+
+
+def fail_unit(stage, abbr, error):
+    checkpoint_unit(stage, abbr, FAILED, repr(error))
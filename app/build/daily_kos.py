@@ -1,9 +1,12 @@
 import pandas as pd
 from halo import Halo
+from pymongo import UpdateOne, UpdateMany
+from mongoengine.queryset import DoesNotExist
 from utils import (
-    find_first_from_regex, switch_halo_icon, update_halo_base, update_halo_scroll
+    find_first_from_regex, switch_halo_icon, update_halo_base, update_halo_scroll, count_rows,
+    span,
 )
-from app.lookups.ccid import assemble_ccid
+from app.lookups.ccid import assemble_ccid, assemble_ccids
 from app.models import (Region, RegionType, RegionFragment)
 from app.config import DailyKosDatasets as DK
 
@@ -15,26 +18,13 @@ DK_DIR_TO_TYPES = {
     "state-house-districts-to-counties": (RegionType.SLDL, RegionType.COUNTY),
     "state-senate-districts-to-counties": (RegionType.SLDU, RegionType.COUNTY)
 }
+OWNER_CCID = 'owner_ccid'
+SOURCE_CCID = 'source_ccid'
+POP = 'population'
+PERC = 'perc_of_whole'
 spinner = Halo()
 
 
-def add_fragment_from_row(row, o_type, s_type, state, abbr, keys):
-    """Adds a relationship between two regions (either interstecting or parent-child) to the
-    appropriate region's relationship list.
-    """
-    update_halo_scroll(spinner, f"{abbr} ~ {row.name}")
-
-    source = s_type.cls.objects.only('id').get(ccid=assemble_ccid(s_type,
-                                                                  row[keys.SOURCE],
-                                                                  state=state))
-
-    owner = o_type.cls.objects.get(ccid=assemble_ccid(o_type, row[keys.OWNER], state=state))
-
-    owner.update(push__fragments=RegionFragment(region=source,
-                                                population=row[keys.POP],
-                                                perc_of_whole=row[keys.PERC]))
-
-
 def get_dk_keys(o_type, s_type, headers):
     """TODO:
         * move this to the Daily Kos clean script
@@ -55,29 +45,94 @@ def get_dk_keys(o_type, s_type, headers):
     return Keys(o_type, s_type)
 
 
+def read_state_fragments(abbr):
+    """Reads every Daily Kos relationship CSV for a state into a single DataFrame of
+    fragments, with the CCIDs of each fragment's owner and source regions assembled.
+    """
+    state_fips = assemble_ccid(RegionType.STATE, abbr)
+    frames = []
+
+    for dk_dir in [d for d in DK.DATA_DIR.iterdir() if d.is_dir()]:
+        if not (csv := dk_dir / f"{abbr}.csv").exists() or (df := pd.read_csv(csv)).empty:
+            continue
+
+        owner, source = DK_DIR_TO_TYPES[dk_dir.name]
+        keys = get_dk_keys(owner, source, list(df.columns))
+
+        frames.append(pd.DataFrame({
+            OWNER_CCID: assemble_ccids(owner, df[keys.OWNER], state_fips),
+            SOURCE_CCID: assemble_ccids(source, df[keys.SOURCE], state_fips),
+            POP: df[keys.POP],
+            PERC: df[keys.PERC],
+        }))
+
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+def refresh_state_fragments(abbr, fragments):
+    """Replaces the fragments lists of every region in a state in a single bulk write.
+
+    The CCIDs of all owner and source regions are resolved to ObjectIds with one query,
+    then each owner's full list of fragments is set at once. Regions in the state that no
+    longer own any fragments have their (stale) fragments list removed.
+    """
+    ccids = set(fragments[OWNER_CCID]) | set(fragments[SOURCE_CCID])
+    ccids_to_ids = {
+        r['ccid']: r['_id']
+        for r in Region.objects(ccid__in=list(ccids)).only('id', 'ccid').as_pymongo()
+    }
+
+    if missing := sorted(ccids - ccids_to_ids.keys()):
+        raise DoesNotExist(
+            f"Daily Kos Error - unable to find regions in {abbr} with the following CCIDs: "
+            f"{', '.join(missing)}"
+        )
+
+    owners_to_fragments = {}
+    for owner, source, pop, perc in fragments[[OWNER_CCID, SOURCE_CCID, POP, PERC]].itertuples(
+        index=False
+    ):
+        fragment = RegionFragment(region=ccids_to_ids[source], population=pop, perc_of_whole=perc)
+        fragment.validate()
+
+        owners_to_fragments.setdefault(ccids_to_ids[owner], []).append(fragment.to_mongo())
+
+    ops = [
+        UpdateOne({'_id': owner}, {'$set': {'fragments': frags}})
+        for owner, frags in owners_to_fragments.items()
+    ]
+    ops.append(UpdateMany(
+        {
+            'state_abbr': abbr,
+            'fragments': {'$exists': True},
+            '_id': {'$nin': list(owners_to_fragments.keys())},
+        },
+        {'$unset': {'fragments': True}},
+    ))
+
+    Region._get_collection().bulk_write(ops, ordered=False)
+
+
 def refresh_daily_kos(state_filter):
     """ Refreshes the daily kos region-relationship data, as well as population data."""
     print("\n~~ Refreshing Daily Kos fragments data ~~")
     switch_halo_icon(spinner)
     spinner.start()
-    update_halo_base(spinner, "Clearing previous fragment data...")
-    Region.objects().update(unset__fragments=True)
 
-    for dk_dir in [d for d in DK.DATA_DIR.iterdir() if d.is_dir()]:
-        owner, source = DK_DIR_TO_TYPES[dk_dir.name]
-        update_halo_base(spinner, (f"\tHandling {owner.name}-owned {source.name} fragments"))
+    abbrs = sorted({
+        csv.stem for csv in DK.DATA_DIR.glob("*/*.csv") if csv.stem not in state_filter
+    })
 
-        for state in dk_dir.glob("*.csv"):
-            if (abbr := state.name.split(".")[0]) not in state_filter:
-                if not (df := pd.read_csv(state)).empty:
-                    keys = get_dk_keys(owner, source, list(df.columns))
+    for i, abbr in enumerate(abbrs):
+        update_halo_base(spinner, f"Handling fragments in {abbr}")
+        update_halo_scroll(spinner, f"{i}/{len(abbrs)}")
 
-                    apply_args = (owner,
-                                  source,
-                                  assemble_ccid(RegionType.STATE, abbr),
-                                  abbr,
-                                  keys)
+        with span(f"{abbr} relationship files", cat='file'):
+            fragments = read_state_fragments(abbr)
+        count_rows(len(fragments))
 
-                    df.apply(add_fragment_from_row, args=apply_args, axis=1)
+        if not fragments.empty:
+            with span(f"{abbr} fragments", cat='flush', rows=len(fragments)):
+                refresh_state_fragments(abbr, fragments)
 
     spinner.succeed("Done!")
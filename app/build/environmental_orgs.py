@@ -3,7 +3,7 @@
 """
 import pandas as pd
 from halo import Halo
-from utils import switch_halo_icon, update_halo_base, update_halo_scroll
+from utils import switch_halo_icon, update_halo_base, update_halo_scroll, count_rows
 from app.models import State, EnvironmentalOrg
 from app.config import EnvironmentalOrgsDataset as EOD
 
@@ -17,13 +17,16 @@ def refresh_environmental_orgs(states_to_skip, unload):
     switch_halo_icon(spinner)
     spinner.start()
 
-    # if we're reloading, unload the data firt
+    # if we're reloading, unload the data firt (only for the states being refreshed)
     if unload:
-        State.objects.update(unset__environmental_organizations=True)
+        State.objects(state_abbr__nin=states_to_skip).update(
+            unset__environmental_organizations=True
+        )
 
     update_halo_base(spinner, "Opening dataset")
     df = pd.read_csv(EOD.DATASET)
     df = df[~df[KEYS.STATE_ABBR].isin(states_to_skip)].reset_index(drop=True)
+    count_rows(len(df))
 
     update_halo_base(spinner, "Loading data from dataset")
 
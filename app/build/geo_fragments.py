@@ -0,0 +1,177 @@
+"""Builds region fragments geometrically, from the intersections of TIGER shapes.
+
+This is an alternative to the Daily Kos relationship spreadsheets, which don't cover every
+state or year. For a given year, every county in a state is intersected with each of the
+state's congressional and state legislative districts, and each pair that overlaps
+produces a fragment in both directions - in the same form as the Daily Kos fragments:
+    * owner district, source county - perc_of_whole is the share of the district's area
+      inside the county
+    * owner county, source district - perc_of_whole is the share of the county's area
+      inside the district
+
+Only pairs whose bounding boxes intersect (found through a SpatialIndex of the state's
+counties) are intersected exactly. Areas are compared in longitude/latitude, which
+distorts them with latitude, but evenly enough across a single pair of regions that the
+shares are unaffected in practice.
+
+A fragment's population is estimated from its county's population, in proportion to the
+share of the county's area in the fragment, or is 0 if the county has no population data.
+County populations are read straight from the cleaned asthma dataset rather than from the
+database, since the asthma stage is itself extrapolated through the fragments.
+
+Every region has a single list of fragments, so only a single year's fragments can be
+loaded at once (the latest year's, by default).
+"""
+import pandas as pd
+from halo import Halo
+from shapely.geometry import shape as to_shapely
+from utils import (
+    switch_halo_icon, update_halo_base, update_halo_scroll, run_with_pool, GeoJSONStream,
+    count_rows, span,
+)
+from app.models import RegionType
+from app.lookups.ccid import assemble_ccids
+from app.lookups.spatial import SpatialIndex
+from app.config import ALL_STATES, TigerDataset as TD, AsthmaDataset as AD
+from app.build.tiger import get_state_geojsons
+from app.build.daily_kos import (
+    refresh_state_fragments, OWNER_CCID, SOURCE_CCID, POP, PERC
+)
+
+TK = TD.Keys
+AK = AD.AsthmaKeys
+DISTRICT_TYPES = [RegionType.CONGR, RegionType.SLDU, RegionType.SLDL]
+spinner = Halo()
+
+
+def get_latest_tiger_year(tiger_dir=TD.TIGER_DIR):
+    return max(int(d.name) for d in tiger_dir.iterdir() if d.name.isdigit())
+
+
+def read_state_shapes(fips, year, tiger_dir=TD.TIGER_DIR):
+    """Reads the shapes of every county and district in a state, for a given year.
+
+    Returns:
+        {RegionType: {str: dict}}: each region type, mapped to the CCIDs and geometries
+            of the state's regions of that type.
+    """
+    mafs = {rt.maf: rt for rt in [RegionType.COUNTY] + DISTRICT_TYPES}
+    shapes = {rt: {} for rt in mafs.values()}
+    other_states = [s for state in ALL_STATES if state[1] != fips for s in state]
+
+    for geo_file in get_state_geojsons(tiger_dir / str(year), other_states):
+        with span(geo_file.name, cat='file'):
+            for feature in GeoJSONStream(
+                geo_file,
+                skip=lambda p: p[TK.STATE_FIPS] != fips or p[TK.TYPE_CODE] not in mafs,
+            ):
+                props = feature['properties']
+                shapes[mafs[props[TK.TYPE_CODE]]][props[TK.CCID]] = feature['geometry']
+
+    return shapes
+
+
+def compute_fragments(counties, districts, county_pops=None):
+    """Computes the fragments between a state's counties and districts of a single type.
+
+    Args:
+        counties ({str: dict}): the CCIDs and geometries of the counties.
+        districts ({str: dict}): the CCIDs and geometries of the districts.
+        county_pops ({str: float}, optional): the CCIDs and populations of the counties.
+
+    Returns:
+        pd.DataFrame: a fragment per row, in both directions, with the same columns as
+            daily_kos.read_state_fragments.
+    """
+    county_pops = county_pops or {}
+    index = SpatialIndex(
+        list(counties), [RegionType.COUNTY] * len(counties), [0] * len(counties),
+        list(counties.values()),
+    )
+    county_areas = {ccid: index.geometry(i).area for i, ccid in enumerate(index.ccids)}
+    rows = []
+
+    for district_ccid, geometry in districts.items():
+        district_area = to_shapely(geometry).area
+
+        for county_ccid, area in index.intersections(geometry):
+            county_share = area / county_areas[county_ccid]
+            if max(county_share, area / district_area) < TD.MIN_FRAGMENT_PERC:
+                continue  # a sliver from the shapes' borders not quite lining up
+
+            pop = round(county_pops.get(county_ccid, 0) * county_share)
+            rows.append((district_ccid, county_ccid, pop, area / district_area))
+            rows.append((county_ccid, district_ccid, pop, county_share))
+
+    return pd.DataFrame(rows, columns=[OWNER_CCID, SOURCE_CCID, POP, PERC])
+
+
+def compute_state_fragments(work_item):
+    """Computes every fragment in a state, from a (fips, year, county_pops) work item."""
+    fips, year, county_pops = work_item
+    shapes = read_state_shapes(fips, year)
+
+    return pd.concat(
+        [
+            compute_fragments(shapes[RegionType.COUNTY], shapes[r_type], county_pops)
+            for r_type in DISTRICT_TYPES
+        ],
+        ignore_index=True,
+    )
+
+
+def get_county_pops(states_to_skip):
+    """Returns the CCID and population of every county in the asthma dataset, in the
+    states not being skipped.
+    """
+    df = pd.read_csv(AD.DATASET, usecols=[AK.STATE, AK.COUNTY, AK.POP])
+    df = df[~df[AK.STATE].isin(states_to_skip) & df[AK.POP].notna()]
+    ccids = assemble_ccids(RegionType.COUNTY, df[AK.COUNTY], df[AK.STATE], errors='coerce')
+
+    return dict(zip(ccids[ccids.notna()], df.loc[ccids.notna(), AK.POP]))
+
+
+def refresh_geo_fragments(states_to_skip, year=None, workers=None):
+    """Refreshes the fragments of every state from the intersections of its TIGER shapes.
+
+    The fragments of each state are computed in parallel worker processes (unless only
+    one state is being refreshed), and written to the database from this one.
+
+    Args:
+        states_to_skip ([str]): abbreviations, FIPS codes and names of states to skip.
+        year (int, optional): the year of TIGER shapes to use. Defaults to the latest.
+        workers (int, optional): the number of worker processes. Defaults to the CPU count.
+    """
+    print("\n~~ Refreshing geometric fragments data ~~")
+    switch_halo_icon(spinner)
+    spinner.start()
+
+    year = year or get_latest_tiger_year()
+    states = sorted(s for s in ALL_STATES if s[0] not in states_to_skip)
+    county_pops = get_county_pops(states_to_skip)
+    work_items = [
+        (fips, year, {ccid: pop for ccid, pop in county_pops.items() if ccid[:2] == fips})
+        for _, fips, *_ in states
+    ]
+
+    update_halo_base(spinner, f"Intersecting {year} TIGER shapes")
+    if len(work_items) == 1:
+        all_fragments = [compute_state_fragments(work_items[0])]
+    else:
+        all_fragments = [
+            r.result for r in run_with_pool(
+                compute_state_fragments,
+                work_items,
+                update_callback=lambda n: update_halo_scroll(spinner, f"{n}/{len(states)}"),
+                workers=workers,
+            )
+        ]
+
+    for (abbr, *_), fragments in zip(states, all_fragments):
+        update_halo_base(spinner, f"Writing fragments in {abbr}")
+        count_rows(len(fragments))
+        if not fragments.empty:
+            with span(f"{abbr} fragments", cat='flush', rows=len(fragments)):
+                refresh_state_fragments(abbr, fragments)
+
+    spinner.succeed("Done!")
@@ -1,65 +1,88 @@
 """Refreshes the Jobs data.
 """
+import numpy as np
 import pandas as pd
 from halo import Halo
-from utils import switch_halo_icon, update_halo_base, update_halo_scroll
-from app.models import Region, JobsData, JobsStat, JobsCounts, RegionType
-from app.lookups.ccid import assemble_ccid
-from app.config import JobsDataset as JD
+from utils import switch_halo_icon, update_halo_base, update_halo_scroll, count_rows
+from app.models import JobsData, JobsStat, JobsCounts, RegionType
+from app.lookups.ccid import assemble_ccids
+from app.config import JobsDataset as JD, DEFAULT_BATCH_INSERT_SIZE
+from app.build.bulk import find_existing_ccids, bulk_set_by_ccid, unset_missing_ccids
 
 JK = JD.JobsKeys
+CCID = 'ccid'
+STATUS = 'status'
+APPLIED, MISSING, SKIPPED = 'applied', 'missing', 'skipped'
+
+COUNTS_KEYS = {
+    JK.COUNT_SOLAR_JOBS: 'solar',
+    JK.COUNT_WIND_JOBS: 'wind',
+    JK.COUNT_ENERGY_JOBS: 'energy',
+    JK.TOTAL_JOBS: 'total',
+}
+STATS_KEYS = {
+    'mwh_invested': {
+        JK.RESIDENTIAL_MWH_INVESTED: 'residential',
+        JK.COMMERCIAL_MWH_INVESTED: 'commercial',
+        JK.UTILITY_MWH_INVESTED: 'utility',
+        JK.TOTAL_MWH_INVESTED: 'total',
+    },
+    'dollars_invested': {
+        JK.RESIDENTIAL_DOLLARS_INVESTED: 'residential',
+        JK.COMMERCIAL_DOLLARS_INVESTED: 'commercial',
+        JK.UTILITY_DOLLARS_INVESTED: 'utility',
+        JK.TOTAL_DOLLARS_INVESTED: 'total',
+        JK.INVESTMENT_HOMES_EQUIVALENT: 'home_equivalent',
+    },
+    'installations_count': {
+        JK.COUNT_RESIDENTIAL_INSTALLATIONS: 'residential',
+        JK.COUNT_COMMERCIAL_INSTALLATIONS: 'commercial',
+        JK.COUNT_UTILITY_INSTALLATIONS: 'utility',
+        JK.TOTAL_INSTALLATIONS: 'total',
+    },
+    'mw_capacity': {
+        JK.RESIDENTIAL_MW_CAPACITY: 'residential',
+        JK.COMMERCIAL_MW_CAPACITY: 'commercial',
+        JK.UTILITY_MW_CAPACITY: 'utility',
+        JK.TOTAL_MW_CAPACITY: 'total',
+    },
+}
 spinner = Halo()
 
 
-def refresh_region_jobs(row, len_df):
-    """Refreshs jobs data for a single region."""
-    counts = JobsCounts(solar=row[JK.COUNT_SOLAR_JOBS],
-                        energy=row[JK.COUNT_ENERGY_JOBS],
-                        total=row[JK.TOTAL_JOBS])
+def get_jobs_docs(df):
+    """Builds a JobsData document (as a raw dict) for every row of the dataset.
 
-    # wind counts are sparser than energy and solar counts
-    if not pd.isna(row[JK.COUNT_WIND_JOBS]):
-        counts.wind = row[JK.COUNT_WIND_JOBS]
+    Each embedded document is built from its own group of columns at once, rather than
+    field-by-field from each row.
+    """
+    # wind counts are sparser than energy and solar counts, so missing ones are left unset
+    counts = df[list(COUNTS_KEYS)].rename(columns=COUNTS_KEYS)
+    counts = counts.astype(object).where(counts.notna(), None).to_dict('records')
 
-    mwh_invested = JobsStat(residential=row[JK.RESIDENTIAL_MWH_INVESTED],
-                            commercial=row[JK.COMMERCIAL_MWH_INVESTED],
-                            utility=row[JK.UTILITY_MWH_INVESTED],
-                            total=row[JK.TOTAL_MWH_INVESTED])
+    stats = {
+        field: df[list(keys)].rename(columns=keys).to_dict('records')
+        for field, keys in STATS_KEYS.items()
+    }
 
-    dollars_invested = JobsStat(residential=row[JK.RESIDENTIAL_DOLLARS_INVESTED],
-                                commercial=row[JK.COMMERCIAL_DOLLARS_INVESTED],
-                                utility=row[JK.UTILITY_DOLLARS_INVESTED],
-                                total=row[JK.TOTAL_DOLLARS_INVESTED],
-                                home_equivalent=row[JK.INVESTMENT_HOMES_EQUIVALENT])
+    return [
+        JobsData(
+            perc_of_state_jobs=perc,
+            counts=JobsCounts(**row_counts),
+            extrapolated=False,
+            **{field: JobsStat(**stats[field][i]) for field in STATS_KEYS},
+        ).to_mongo()
+        for i, (perc, row_counts) in enumerate(zip(df[JK.PERCENT_OF_STATE_JOBS], counts))
+    ]
 
-    installations_count = JobsStat(residential=row[JK.COUNT_RESIDENTIAL_INSTALLATIONS],
-                                   commercial=row[JK.COUNT_COMMERCIAL_INSTALLATIONS],
-                                   utility=row[JK.COUNT_UTILITY_INSTALLATIONS],
-                                   total=row[JK.TOTAL_INSTALLATIONS])
 
-    mw_capacity = JobsStat(residential=row[JK.RESIDENTIAL_MW_CAPACITY],
-                           commercial=row[JK.COMMERCIAL_MW_CAPACITY],
-                           utility=row[JK.UTILITY_MW_CAPACITY],
-                           total=row[JK.TOTAL_MW_CAPACITY])
+def refresh_jobs(states_to_skip, batch_size=DEFAULT_BATCH_INSERT_SIZE):
+    """ Refreshes the jobs counts
 
-    jobs = JobsData(perc_of_state_jobs=row[JK.PERCENT_OF_STATE_JOBS],
-                    counts=counts,
-                    mwh_invested=mwh_invested,
-                    dollars_invested=dollars_invested,
-                    installations_count=installations_count,
-                    mw_capacity=mw_capacity,
-                    extrapolated=False)
-
-    ccid = assemble_ccid(RegionType.fuzzy_cast(row[JK.GEOTYPE]), row[JK.GEOID])
-    region = Region.objects.get(ccid=ccid)
-    region.jobs = jobs
-    region.save()
-
-    update_halo_scroll(spinner, f"{row.name}/{len_df}")
-
-
-def refresh_jobs(states_to_skip):
-    """ Refreshes the jobs counts """
+    Returns:
+        pd.DataFrame: the number of rows applied, missing (no matching region in the
+            database) and skipped (uninterpretable GEOID) for each region type.
+    """
     print("\n~~ Refreshing Jobs Data ~~")
     switch_halo_icon(spinner)
     spinner.start()
@@ -67,8 +90,33 @@ def refresh_jobs(states_to_skip):
     update_halo_base(spinner, "Opening jobs dataset")
     df = pd.read_csv(JD.DATASET)
     df = df[~df[JK.STATE].isin(states_to_skip)].reset_index(drop=True)  # filter out skip states
+    count_rows(len(df))
+
+    df[CCID] = None
+    for geotype, rows in df.groupby(JK.GEOTYPE).groups.items():
+        df.loc[rows, CCID] = assemble_ccids(
+            RegionType.fuzzy_cast(geotype), df.loc[rows, JK.GEOID], errors='coerce'
+        )
 
     update_halo_base(spinner, "Refreshing jobs data from dataset")
-    df.apply(refresh_region_jobs, args=[len(df)], axis=1)
+    existing_ccids = find_existing_ccids(df[CCID].dropna())
+    df[STATUS] = np.select(
+        [df[CCID].isna(), df[CCID].isin(existing_ccids)], [SKIPPED, APPLIED], MISSING
+    )
+
+    loadable = df[df[STATUS] == APPLIED]
+    bulk_set_by_ccid('jobs', zip(loadable[CCID], get_jobs_docs(loadable)), batch_size)
+    update_halo_scroll(spinner, f"{len(loadable)}/{len(df)}")
+
+    # data left behind by rows removed from the dataset since it was last loaded
+    unset_missing_ccids('jobs', states_to_skip, loadable[CCID])
 
     spinner.succeed("Done!")
+
+    summary = (
+        df.groupby([JK.GEOTYPE, STATUS]).size().unstack(fill_value=0)
+        .reindex(columns=[APPLIED, MISSING, SKIPPED], fill_value=0)
+    )
+    print(f"\n{summary.to_string()}")
+
+    return summary
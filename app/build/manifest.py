@@ -0,0 +1,164 @@
+"""Tracks the content hashes of the cleaned datasets each build stage loaded, per state.
+
+A stage's inputs for a state are hashed as follows:
+    * tiger - each cleaned geojson file covering the state, ie - every national
+      (tl_*_us_*) file, and the state's own SLDU/SLDL files
+    * geo_fragments - the same files as tiger, and the state's rows of the asthma dataset
+      (for its county populations)
+    * daily_kos - each of the state's relationship CSVs
+    * asthma, jobs and environmental_orgs - the state's rows of the dataset's single CSV
+
+Once a (stage, state) unit of a build finishes, the hashes of its inputs are recorded as
+ManifestEntry documents in the database being built. A later refresh then only needs to
+reload the states whose hashes differ from (or are missing in) the recorded ones. Since
+daily_kos and geo_fragments write the same fragments, recording either for a state
+replaces the other's record.
+"""
+import re
+import hashlib
+import pandas as pd
+from pathlib import Path
+from pymongo import DeleteMany, InsertOne
+from app.models import ManifestEntry
+from app.config import (
+    STATE_FIPS_TO_ABBR,
+    FRAGMENT_SOURCES,
+    TigerDataset as TD,
+    DailyKosDatasets as DK,
+    AsthmaDataset as AD,
+    JobsDataset as JD,
+    EnvironmentalOrgsDataset as EOD,
+)
+
+CSV_DATASETS = {
+    'asthma': (Path(AD.DATASET), AD.AsthmaKeys.STATE),
+    'jobs': (Path(JD.DATASET), JD.JobsKeys.STATE),
+    'environmental_orgs': (Path(EOD.DATASET), EOD.Keys.STATE_ABBR),
+}
+TIGER_FILE_PATTERN = re.compile(r'^tl_\d{4}_(us|\d{2})_')
+
+
+def hash_file(path, chunk_size=2 ** 20):
+    """Returns the SHA-256 hex digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def hash_rows(df):
+    """Returns a SHA-256 hex digest of the contents of a DataFrame's rows (and columns)."""
+    digest = hashlib.sha256(','.join(map(str, df.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return digest.hexdigest()
+
+
+def get_tiger_digests(abbrs):
+    digests = {abbr: {} for abbr in abbrs}
+
+    # only the year directories, ie - not the per-state splits of the national files
+    for geo_file in sorted(TD.TIGER_DIR.glob('[0-9]*/**/*.geojson')):
+        if not (match := TIGER_FILE_PATTERN.match(geo_file.name)):
+            continue
+
+        covered = abbrs if match[1] == 'us' else [STATE_FIPS_TO_ABBR.get(match[1])]
+        if not (covered := [abbr for abbr in covered if abbr in digests]):
+            continue
+
+        key, file_digest = str(geo_file.relative_to(TD.TIGER_DIR)), hash_file(geo_file)
+        for abbr in covered:
+            digests[abbr][key] = file_digest
+
+    return digests
+
+
+def get_daily_kos_digests(abbrs):
+    digests = {abbr: {} for abbr in abbrs}
+
+    for csv in sorted(DK.DATA_DIR.glob('*/*.csv')):
+        if csv.stem in digests:
+            digests[csv.stem][str(csv.relative_to(DK.DATA_DIR))] = hash_file(csv)
+
+    return digests
+
+
+def get_csv_digests(dataset, abbrs):
+    path, state_key = CSV_DATASETS[dataset]
+    digests = {abbr: {} for abbr in abbrs}
+
+    for abbr, rows in pd.read_csv(path).groupby(state_key):
+        if abbr in digests:
+            digests[abbr][f"{path.name}:{abbr}"] = hash_rows(rows)
+
+    return digests
+
+
+def get_input_digests(dataset, abbrs):
+    """Hashes the cleaned inputs of a build stage for each of the given states.
+
+    Returns:
+        {str: {str: str}}: each state's abbreviation, mapped to the key (ie - a file's path
+            relative to the dataset's data directory) and digest of each of its inputs.
+    """
+    if dataset == 'tiger':
+        return get_tiger_digests(list(abbrs))
+    elif dataset == 'geo_fragments':
+        digests = get_tiger_digests(list(abbrs))
+        for abbr, pops in get_csv_digests('asthma', list(abbrs)).items():
+            digests[abbr].update(pops)
+        return digests
+    elif dataset == 'daily_kos':
+        return get_daily_kos_digests(list(abbrs))
+    elif dataset in CSV_DATASETS:
+        return get_csv_digests(dataset, list(abbrs))
+
+    raise ValueError(f"Build Manifest Error - no inputs are known for dataset '{dataset}'")
+
+
+class BuildManifest:
+    """The current input hashes of a set of build stages, and their recorded counterparts.
+
+    Args:
+        datasets ([str]): the names of the build stages to hash the inputs of.
+        states ([tuple]): the states (as found in ALL_STATES) to hash the inputs of.
+    """
+
+    def __init__(self, datasets, states):
+        self.digests = {
+            dataset: get_input_digests(dataset, [state[0] for state in states])
+            for dataset in datasets
+        }
+
+    def changed_states(self, dataset, recorded_only=False):
+        """Returns the abbreviations of the states whose inputs for a dataset have changed
+        since they were last recorded (including those that were never recorded, unless
+        recorded_only is True - ie - for a stage that was never loaded into the database).
+        """
+        recorded = {}
+        for entry in ManifestEntry.objects(dataset=dataset).only(
+            'state_abbr', 'key', 'digest'
+        ).as_pymongo():
+            recorded.setdefault(entry['state_abbr'], {})[entry['key']] = entry['digest']
+
+        return {
+            abbr for abbr, digests in self.digests[dataset].items()
+            if recorded.get(abbr, {}) != digests and (abbr in recorded or not recorded_only)
+        }
+
+    def record(self, dataset, abbr):
+        """Replaces the recorded input hashes of a dataset for a state with the current ones"""
+        replaced = FRAGMENT_SOURCES if dataset in FRAGMENT_SOURCES else (dataset,)
+
+        ManifestEntry._get_collection().bulk_write(
+            [DeleteMany({'dataset': {'$in': list(replaced)}, 'state_abbr': abbr})] + [
+                InsertOne(
+                    ManifestEntry(dataset=dataset, key=key, state_abbr=abbr, digest=digest)
+                    .to_mongo()
+                )
+                for key, digest in self.digests[dataset][abbr].items()
+            ],
+            ordered=True,
+        )
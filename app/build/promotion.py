@@ -0,0 +1,148 @@
+"""Validates staged databases, promotes them to production, and retires old ones.
+
+Builds are made into a staging database (new-db), and only become the production database
+once they're promoted:
+    1. the staged database is validated (see validate_database), and a few representative
+       queries are timed against it (see time_queries)
+    2. the production pointer in the metadata database is flipped to the staged database
+       in a single atomic update - so every later connect() resolves to it
+    3. the previous production database is retired, and retired databases beyond the
+       retention policy are dropped
+
+Every function here expects the manager's connections to be open, ie - the default
+connection to the database being promoted, and the METADATA_ALIAS one to the metadata
+database.
+"""
+import time
+from datetime import datetime
+from statistics import median
+from mongoengine import get_connection, Q
+from app.models import Region, RegionType, Shape, State, Deployment, ProductionPointer
+from app.models.deployment import STAGED, LIVE, RETIRED, DROPPED, PRODUCTION
+from app.config import METADATA_ALIAS, PRODUCTION_RETENTION
+
+
+def get_production_db_name():
+    """Returns the name of the database the production pointer points to, if there is one"""
+    pointer = ProductionPointer.objects(name=PRODUCTION).only('db_name').first()
+    return pointer.db_name if pointer else None
+
+
+def stage(db_name):
+    """Records a database as staged for promotion, unless it's already been recorded."""
+    Deployment.objects(db_name=db_name).update_one(
+        upsert=True,
+        set_on_insert__status=STAGED,
+        set_on_insert__date_built=datetime.utcnow(),
+    )
+
+
+def validate_database(states):
+    """Checks that the connected database holds a complete build of the given states.
+
+    Args:
+        states ([tuple]): the states (as found in ALL_STATES) the database was built with.
+
+    Returns:
+        {str: dict}: the name of each check, mapped to whether it passed and the counts
+            it was based on.
+    """
+    abbrs = {state[0] for state in states}
+    validations = {}
+
+    for r_type in RegionType:
+        count = r_type.cls.objects.count()
+        validations[f"{r_type.name.lower()}_count"] = {'passed': count > 0, 'count': count}
+
+    missing = sorted(abbrs - set(State.objects.distinct('state_abbr')))
+    validations['states_present'] = {'passed': not missing, 'missing': missing}
+
+    # empty lists aren't saved, so a region without shapes usually has no shapes field at all
+    shapeless = Region.objects(Q(shapes__size=0) | Q(shapes__exists=False)).count()
+    validations['regions_have_shapes'] = {'passed': not shapeless, 'count': shapeless}
+
+    return validations
+
+
+def time_queries(repeat=5):
+    """Times a few of the queries production relies on against the connected database.
+
+    Returns:
+        {str: float}: the name of each query, mapped to its median runtime in milliseconds.
+    """
+    region = Region.objects.only('ccid', 'state_abbr').first()
+    if region is None:
+        return {}
+
+    queries = {
+        'region_by_ccid': lambda: Region.objects(ccid=region.ccid).first(),
+        'state_regions': lambda: list(
+            Region.objects(state_abbr=region.state_abbr).only('ccid', 'name')
+        ),
+        'state_shapes_low': lambda: list(
+            Shape.objects(state_abbr=region.state_abbr).tier('low')
+        ),
+    }
+
+    timings = {}
+    for name, query in queries.items():
+        runtimes = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            query()
+            runtimes.append((time.perf_counter() - start) * 1000)
+        timings[name] = round(median(runtimes), 3)
+
+    return timings
+
+
+def promote(db_name, validations=None, timings=None):
+    """Atomically points production at db_name, and retires the previous production db.
+
+    Returns:
+        str: the name of the previous production database, or None if there wasn't one.
+    """
+    now = datetime.utcnow()
+    Deployment.objects(db_name=db_name).update_one(
+        upsert=True,
+        set__status=LIVE,
+        set__validations=validations or {},
+        set__timings=timings or {},
+        set__date_promoted=now,
+        unset__date_retired=True,
+    )
+
+    previous = ProductionPointer.objects(name=PRODUCTION).modify(
+        upsert=True, new=False, set__db_name=db_name, set__date_promoted=now
+    )
+
+    if previous and previous.db_name != db_name:
+        Deployment.objects(db_name=previous.db_name).update_one(
+            upsert=True, set__status=RETIRED, set__date_retired=now
+        )
+        return previous.db_name
+
+    return None
+
+
+def collect_garbage(retention=PRODUCTION_RETENTION):
+    """Drops every retired production database but the retention most recently retired.
+
+    Only databases recorded as retired are ever dropped - never the live one, staged ones,
+    or anything else on the cluster.
+
+    Returns:
+        [str]: the names of the databases dropped.
+    """
+    live = get_production_db_name()
+    expired = [
+        d.db_name for d in Deployment.objects(status=RETIRED).order_by('-date_retired')
+        .only('db_name')[retention:]
+        if d.db_name != live
+    ]
+
+    for db_name in expired:
+        get_connection(METADATA_ALIAS).drop_database(db_name)
+        Deployment.objects(db_name=db_name).update_one(set__status=DROPPED)
+
+    return expired
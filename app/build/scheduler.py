@@ -0,0 +1,261 @@
+"""Schedules the stages of a database build as a DAG of per-state work units.
+
+Each stage (ie - loading TIGER shapes, or Daily Kos fragments) is partitioned by state, and
+each (stage, state) unit only waits on the units of the stages it depends on *in the same
+state*. Regions, fragments and dataset rows never cross state lines, so unrelated states
+(and unrelated datasets within a state) are free to run concurrently, on a pool of worker
+processes that each hold their own database connection.
+
+A stage can also have a prepare function, run once (in this process) before any of its
+units start - ie - to split the national TIGER files by state, so that each TIGER unit
+only reads its own state's features.
+"""
+from concurrent.futures import wait, FIRST_COMPLETED
+from utils import WorkerPool, connect_worker, measure, span, census_scope
+from app.config import ALL_STATES, FRAGMENT_SOURCES
+from app.build.tiger import refresh_tiger, split_tiger_by_state
+from app.build.environmental_orgs import refresh_environmental_orgs
+from app.build.daily_kos import refresh_daily_kos
+from app.build.geo_fragments import refresh_geo_fragments
+from app.build.asthma import refresh_asthma
+from app.build.jobs import refresh_jobs
+from app.build import checkpoints
+
+
+class Stage:
+    """A build stage, the names of the stages that must finish before it can start, and
+    an optional function to run once before any of its units.
+    """
+
+    def __init__(self, name, func, depends_on=(), prepare=None):
+        self.name = name
+        self.func = func
+        self.depends_on = tuple(depends_on)
+        self.prepare = prepare
+
+    def __repr__(self):
+        return f"<Stage(name='{self.name}', depends_on={self.depends_on})>"
+
+
+STAGES = {
+    stage.name: stage
+    for stage in [
+        Stage('tiger', refresh_tiger, prepare=split_tiger_by_state),
+        Stage('environmental_orgs', refresh_environmental_orgs, depends_on=['tiger']),
+        Stage('daily_kos', refresh_daily_kos, depends_on=['tiger']),
+        # an alternative to daily_kos (see FRAGMENT_SOURCES), computing the same fragments
+        # from TIGER shapes
+        Stage(
+            'geo_fragments', refresh_geo_fragments, depends_on=['tiger'],
+            prepare=split_tiger_by_state,
+        ),
+        # asthma data is extrapolated to districts through the fragments, from whichever
+        # source they were loaded (neither reads anything the asthma stage writes)
+        Stage('asthma', refresh_asthma, depends_on=['daily_kos', 'geo_fragments']),
+        Stage('jobs', refresh_jobs, depends_on=['tiger']),
+    ]
+}
+
+
+def get_skip_states_for(state):
+    """Returns the (flattened) identifiers of every state except the given one, in the form
+    expected by the refresh_* functions' states_to_skip argument.
+    """
+    return [s for other in ALL_STATES if other != state for s in other]
+
+
+def get_upstream_stages(names):
+    """Returns the names of every stage the given stages depend on (directly or through
+    another stage) that isn't one of them, ie - {'tiger'} for ['asthma'].
+    """
+    upstream = set()
+
+    # STAGES is listed in dependency order, so one reversed pass reaches every ancestor
+    for name in reversed(list(STAGES)):
+        if name in names or name in upstream:
+            upstream |= set(STAGES[name].depends_on)
+
+    return upstream - set(names)
+
+
+def propagate_changes(changed):
+    """Extends the states that changed for each stage to every stage downstream of it.
+
+    Args:
+        changed ({str: set}): the names of the stages being run, mapped to the
+            abbreviations of the states whose inputs changed for each.
+
+    Returns:
+        {str: set}: the abbreviations of the states each stage must be rerun for, ie - a
+            state's Daily Kos fragments changing means its asthma data must be extrapolated
+            again. Only the stages in changed are considered.
+    """
+    dirty = {name: set(abbrs) for name, abbrs in changed.items()}
+
+    # STAGES is listed in dependency order, so one pass reaches every downstream stage
+    for name, stage in STAGES.items():
+        if name in dirty:
+            for dep in stage.depends_on:
+                dirty[name] |= dirty.get(dep, set())
+
+    return dirty
+
+
+def run_unit(stage_name, state, kwargs):
+    """Runs a single stage for a single state, returning the metrics measured as it ran."""
+    with measure(stage=stage_name, state=state[0]) as metrics:
+        with span(f"{stage_name} {state[0]}", cat='unit', stage=stage_name, state=state[0]):
+            with census_scope(f"{stage_name} {state[0]}"):
+                STAGES[stage_name].func(get_skip_states_for(state), **kwargs)
+    return metrics.as_dict()
+
+
+class BuildScheduler:
+    """Runs build stages, partitioned by state, on a pool of worker processes.
+
+    Args:
+        stages ({str: dict}): the names of the stages to run, mapped to any extra keyword
+            arguments for that stage's refresh_* function. Dependencies on stages that
+            aren't included are considered already satisfied.
+        states ([tuple] or {str: [tuple]}): the states (as found in ALL_STATES) to run
+            every stage for, or a dict of the states to run for each stage.
+        host (str): the URI of the database each worker process should connect to.
+        workers (int, optional): the number of worker processes. Defaults to the number
+            of CPUs. If 1, every unit is run in this process, in dependency order.
+        manifest (BuildManifest, optional): if given, the input hashes of each unit are
+            recorded as soon as it finishes.
+        checkpoint (bool, optional): if True, units that already completed (according to
+            their checkpoints) are skipped, and every other unit is checkpointed as it
+            starts, completes or fails (see app.build.checkpoints).
+        report (MetricsReport, optional): if given, the metrics of each unit (see
+            utils.metrics) are added to it as soon as it finishes.
+    """
+
+    def __init__(
+        self, stages, states, host, workers=None, manifest=None, checkpoint=False, report=None
+    ):
+        if all(name in stages for name in FRAGMENT_SOURCES):
+            raise ValueError(
+                f"Build Scheduler Error - {' and '.join(FRAGMENT_SOURCES)} are alternative "
+                "sources of the same region fragments, so only one of them can be run at once."
+            )
+
+        self.stages = stages
+        self.states = (
+            states if isinstance(states, dict) else {name: states for name in stages}
+        )
+        self.host = host
+        self.workers = workers
+        self.manifest = manifest
+        self.checkpoint = checkpoint
+        self.report = report
+
+        done = checkpoints.get_completed_units() if checkpoint else set()
+        completed = {
+            (name, state) for name in stages for state in self.states[name]
+            if (name, state[0]) in done
+        }
+
+        self.units = [
+            (name, state) for name in stages for state in self.states[name]
+            if (name, state) not in completed
+        ]
+        self.dependencies = {
+            (name, state): {
+                (dep, state) for dep in STAGES[name].depends_on
+                if dep in stages and state in self.states[dep]
+            } - completed
+            for name, state in self.units
+        }
+
+    def __len__(self):
+        return len(self.units)
+
+    def _ready_units(self, finished, started):
+        return [
+            unit for unit in self.units
+            if unit not in started and self.dependencies[unit] <= finished
+        ]
+
+    def _start(self, unit, started):
+        if self.checkpoint:
+            checkpoints.start_unit(unit[0], unit[1][0])
+        started.add(unit)
+
+    def _finish(self, unit, finished, metrics):
+        if self.report is not None:
+            self.report.add(metrics)
+        if self.manifest:
+            self.manifest.record(unit[0], unit[1][0])
+        if self.checkpoint:
+            checkpoints.complete_unit(unit[0], unit[1][0])
+        finished.add(unit)
+
+    def _fail(self, unit, e, failed):
+        if self.checkpoint:
+            checkpoints.fail_unit(unit[0], unit[1][0], e)
+        failed[unit] = e
+
+    def _prepare(self):
+        prepares = [
+            STAGES[name].prepare for name in STAGES
+            if STAGES[name].prepare and any(unit[0] == name for unit in self.units)
+        ]
+        for prepare in dict.fromkeys(prepares):
+            prepare()
+
+    def _run_serial(self):
+        finished, started, failed = set(), set(), {}
+
+        while (ready := self._ready_units(finished, started)):
+            for unit in ready:
+                self._start(unit, started)
+                try:
+                    metrics = run_unit(*unit, self.stages[unit[0]])
+                except Exception as e:
+                    self._fail(unit, e, failed)
+                else:
+                    self._finish(unit, finished, metrics)
+
+        return finished, failed
+
+    def _run_parallel(self):
+        finished, started, failed = set(), set(), {}
+        running = {}
+
+        with WorkerPool(self.workers, connect_worker, (self.host,)) as pool:
+            while True:
+                for unit in self._ready_units(finished, started):
+                    self._start(unit, started)
+                    running[pool.submit(run_unit, *unit, self.stages[unit[0]])] = unit
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    unit = running.pop(future)
+
+                    if future.exception() is not None:
+                        self._fail(unit, future.exception(), failed)
+                    else:
+                        self._finish(unit, finished, future.result())
+
+        return finished, failed
+
+    def run(self):
+        """Runs every unit whose dependencies succeeded, then raises if any unit failed.
+
+        A failed unit doesn't stop the units that don't depend on it, whether they're run
+        in this process (workers=1) or on the pool - its dependents are never started.
+        """
+        self._prepare()
+        finished, failed = self._run_serial() if self.workers == 1 else self._run_parallel()
+
+        if failed:
+            raise Exception(
+                f"Build Scheduler Error - {len(failed)} of {len(self)} units failed, and "
+                f"{len(self) - len(finished) - len(failed)} were never started:\n\t"
+                + "\n\t".join(f"{name} ({state[0]}): {e!r}" for (name, state), e in failed.items())
+            ) from next(iter(failed.values()))
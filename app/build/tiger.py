@@ -1,16 +1,24 @@
 """Builds Region collection documents from cleaned TIGER geojson files.
 
 """
+import os
 import us
-import geojson
+import json
+from datetime import datetime
+from bson import ObjectId
 from us import states
 from halo import Halo
+from shapely.geometry import shape as to_shapely, mapping
+from pymongo import InsertOne, ReplaceOne, UpdateOne
+from mongoengine import ValidationError
 from mongoengine.queryset import DoesNotExist
 from utils import (
-    switch_halo_icon, update_halo_base, update_halo_scroll
+    switch_halo_icon, update_halo_base, update_halo_scroll, GeoJSONStream, count_rows, span,
 )
-from app.models import Shape, RegionShape, RegionType
+from app.models import Region, Shape, RegionShape, RegionType
+from app.models.regions import SHAPE_TIERS
 from app.config import TigerDataset as TD
+from app.build.manifest import TIGER_FILE_PATTERN
 
 spinner = Halo()
 TK = TD.Keys  # for reading TIGER shapefile rows
@@ -40,6 +48,34 @@ def load_region_specific_fields(reg, r_type, props):
             reg.leg_year = int(props[TK.SL_LEG_YEAR])
 
 
+def _as_lists(coordinates):
+    if isinstance(coordinates, (list, tuple)) and not isinstance(coordinates[0], float):
+        return [_as_lists(c) for c in coordinates]
+    return list(coordinates)
+
+
+def get_simplified_shapes(geometry):
+    """Simplifies a feature's geometry at each of the tolerances in SIMPLIFY_TOLERANCES.
+
+    Returns:
+        dict: the Shape field of each simplified tier, mapped to its geometry. Shapes too
+            small to survive simplification keep their full geometry.
+    """
+    full = to_shapely(geometry)
+    simplified = {}
+
+    for tier, tolerance in TD.SIMPLIFY_TOLERANCES.items():
+        if (tiered := full.simplify(tolerance, preserve_topology=True)).is_empty:
+            simplified[SHAPE_TIERS[tier]] = geometry
+        else:
+            simplified[SHAPE_TIERS[tier]] = {
+                'type': tiered.geom_type,
+                'coordinates': _as_lists(mapping(tiered)['coordinates']),
+            }
+
+    return simplified
+
+
 def refresh_region_from_geojson(feature, year):
     props = feature['properties']
     state = us.states.lookup(props[TK.STATE_FIPS])
@@ -53,6 +89,7 @@ def refresh_region_from_geojson(feature, year):
         ccid=props[TK.CCID],
         name=props[TK.NAME],
         land_area=props[TK.LAND_AREA],
+        **get_simplified_shapes(feature['geometry']),
     )
 
     # try to pull its associated Region, make a new one if not found
@@ -81,29 +118,321 @@ def refresh_region_from_geojson(feature, year):
     shape.save()
 
 
-def refresh_tiger(states_to_skip):
-    year_dirs = sorted(
+class BulkTigerLoader:
+    """Buffers TIGER features and writes their Shape and Region documents in batches.
+
+    The CCIDs of every Region and Shape already in the database (in the states not being
+    skipped) are read once, when the loader is created, so that features are matched to
+    existing documents in memory instead of with a query per feature. Each batch is
+    validated as a whole before it's written: new Shapes are inserted (existing ones are
+    replaced in place), new Regions are upserted by CCID, and existing Regions get the
+    new shape pushed onto their shapes list unless they already have one for that year.
+    """
+
+    def __init__(self, states_to_skip=(), batch_size=TD.BATCH_SIZE):
+        self.batch_size = batch_size
+        in_states = {'state_abbr': {'$nin': list(states_to_skip)}}
+
+        self.region_ids = {
+            r['ccid']: r['_id']
+            for r in Region._get_collection().find(in_states, {'ccid': 1})
+        }
+        self.shape_ids = {
+            (s['ccid'], s['year']): s['_id']
+            for s in Shape._get_collection().find(in_states, {'ccid': 1, 'year': 1})
+        }
+        self._shapes = []
+        self._new_regions = {}
+        self._region_shapes = []
+
+    def __len__(self):
+        return len(self._shapes)
+
+    def add(self, feature, year):
+        """Buffers a single TIGER feature, flushing the buffer once it's full."""
+        props = feature['properties']
+        state = us.states.lookup(props[TK.STATE_FIPS])
+        region_type = RegionType.fuzzy_cast(props[TK.TYPE_CODE])
+        ccid = props[TK.CCID]
+
+        if ccid in self.region_ids:
+            region_id = self.region_ids[ccid]
+        elif ccid in self._new_regions:
+            region_id = self._new_regions[ccid].id
+        else:
+            region = region_type.cls(
+                id=ObjectId(),
+                state_fips=state.fips,
+                state_abbr=state.abbr,
+                geoid=props[TK.GEOID],
+                ccid=ccid,
+                name=props[TK.NAME]
+            )
+            load_region_specific_fields(region, region_type, props)
+
+            self._new_regions[ccid] = region
+            region_id = region.id
+
+        shape = Shape(
+            id=self.shape_ids.get((ccid, year), ObjectId()),
+            year=year,
+            shape=feature['geometry'],
+            state_abbr=state.abbr,
+            geoid=props[TK.GEOID],
+            ccid=ccid,
+            name=props[TK.NAME],
+            land_area=props[TK.LAND_AREA],
+            region=region_id,
+            **get_simplified_shapes(feature['geometry']),
+        )
+
+        self._shapes.append(shape)
+        self._region_shapes.append((ccid, RegionShape(year=year, shape=shape.id)))
+
+        if len(self) >= self.batch_size:
+            self.flush()
+
+    def _validate_batch(self):
+        """Validates every buffered document, raising one error for the whole batch."""
+        errors = {}
+
+        for ccid, region_shape in self._region_shapes:
+            if ccid in self._new_regions:
+                self._new_regions[ccid].shapes.append(region_shape)
+
+        for doc in self._shapes + list(self._new_regions.values()):
+            try:
+                doc.validate()
+            except ValidationError as e:
+                errors[f"{doc.__class__.__name__}({doc.ccid})"] = e
+
+        if errors:
+            raise ValidationError(
+                f"TIGER Bulk Load Error - {len(errors)} documents in the current batch "
+                "failed validation.",
+                errors=errors,
+            )
+
+    def flush(self):
+        """Validates and writes all buffered Shapes and Regions to the database."""
+        if not len(self):
+            return
+
+        self._validate_batch()
+
+        shape_ops = []
+        for shape in self._shapes:
+            if (shape.ccid, shape.year) in self.shape_ids:
+                shape_ops.append(ReplaceOne({'_id': shape.id}, shape.to_mongo()))
+            else:
+                shape_ops.append(InsertOne(shape.to_mongo()))
+
+        region_ops = []
+        for ccid, region in self._new_regions.items():
+            doc = region.to_mongo()
+            shapes = doc.pop('shapes')
+            region_ops.append(UpdateOne(
+                {'ccid': ccid},
+                {
+                    '$setOnInsert': doc,
+                    '$push': {'shapes': {'$each': shapes, '$sort': {'year': -1}}},
+                },
+                upsert=True,
+            ))
+
+        for ccid, region_shape in self._region_shapes:
+            if ccid in self._new_regions:
+                continue
+
+            region_ops.append(UpdateOne(
+                {'ccid': ccid, 'shapes.year': {'$ne': region_shape.year}},
+                {
+                    '$set': {'date_modified': datetime.utcnow()},
+                    '$push': {
+                        'shapes': {
+                            '$each': [region_shape.to_mongo()], '$sort': {'year': -1}
+                        }
+                    },
+                },
+            ))
+
+        with span('tiger flush', cat='flush', shapes=len(shape_ops), regions=len(region_ops)):
+            Shape._get_collection().bulk_write(shape_ops, ordered=False)
+            Region._get_collection().bulk_write(region_ops, ordered=False)
+
+        self.shape_ids.update({(s.ccid, s.year): s.id for s in self._shapes})
+        self.region_ids.update({c: r.id for c, r in self._new_regions.items()})
+
+        self._shapes = []
+        self._new_regions = {}
+        self._region_shapes = []
+
+
+def get_split_dir(geo_file):
+    """Returns the directory a national TIGER file's per-state files are split into."""
+    return TD.STATE_SPLIT_DIR / geo_file.parent.name
+
+
+def _get_split_marker(geo_file):
+    return get_split_dir(geo_file) / f".{geo_file.name}.split"
+
+
+def _get_file_stamp(geo_file):
+    stat = geo_file.stat()
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def is_split(geo_file):
+    """Whether a national TIGER file has been split by state since it was last cleaned."""
+    try:
+        with open(_get_split_marker(geo_file), 'r') as f:
+            return json.load(f) == _get_file_stamp(geo_file)
+    except (FileNotFoundError, ValueError):
+        return False
+
+
+def split_by_state(geo_file):
+    """Streams a national TIGER file once, writing each state's features to a file of
+    their own (ie - by-state/2020/50/tl_2020_us_county.geojson).
+
+    The files are only renamed into place once they're all complete, and a marker
+    recording the national file's size and modification time is written last - so that an
+    interrupted split is redone, rather than read.
+    """
+    split_dir = get_split_dir(geo_file)
+    _get_split_marker(geo_file).unlink(missing_ok=True)
+    for old in split_dir.glob(f"*/{geo_file.name}"):
+        old.unlink()
+
+    parts = {}
+    try:
+        for feature in GeoJSONStream(geo_file):
+            fips = feature['properties'][TK.STATE_FIPS]
+
+            if fips not in parts:
+                (split_dir / fips).mkdir(parents=True, exist_ok=True)
+                parts[fips] = open(split_dir / fips / f".{geo_file.name}.part", 'w')
+                parts[fips].write('{"type": "FeatureCollection", "features": [\n')
+            else:
+                parts[fips].write(",\n")
+
+            parts[fips].write(json.dumps(feature))
+
+        for part in parts.values():
+            part.write("\n]}\n")
+    except BaseException:
+        for part in parts.values():
+            part.close()
+            os.remove(part.name)
+        raise
+
+    for fips, part in parts.items():
+        part.close()
+        os.replace(part.name, split_dir / fips / geo_file.name)
+
+    split_dir.mkdir(parents=True, exist_ok=True)
+    with open(_get_split_marker(geo_file), 'w') as f:
+        json.dump(_get_file_stamp(geo_file), f)
+
+    return len(parts)
+
+
+def get_year_dirs():
+    return sorted(
         [yd for yd in TD.TIGER_DIR.iterdir() if str(yd.name).isdigit()], reverse=True
     )
 
-    for year_dir in year_dirs:
+
+def split_tiger_by_state():
+    """Splits every national TIGER file that hasn't been split since it was last cleaned
+    (see split_by_state). Run once before a build's per-state TIGER units.
+    """
+    to_split = [
+        geo_file for year_dir in get_year_dirs() for geo_file in sorted(year_dir.glob('*.geojson'))
+        if (match := TIGER_FILE_PATTERN.match(geo_file.name)) and match[1] == 'us'
+        and not is_split(geo_file)
+    ]
+    if not to_split:
+        return
+
+    print(f"\n~~ Splitting {len(to_split)} national TIGER files by state ~~")
+    switch_halo_icon(spinner)
+    spinner.start()
+
+    for geo_file in to_split:
+        update_halo_base(spinner, f"Splitting {geo_file.name}")
+        with span(geo_file.name, cat='file'):
+            n_states = split_by_state(geo_file)
+        update_halo_scroll(spinner, f"{n_states} states")
+
+    spinner.succeed('Done!')
+
+
+def get_state_geojsons(year_dir, states_to_skip):
+    """Lists the cleaned geojson files of a year that can hold features of the states not
+    being skipped. The per-state files (ie - SLDU/SLDL) of skipped states are left out,
+    and national files are swapped for their per-state splits, if they're up to date.
+    """
+    paths = []
+
+    for geo_file in sorted(year_dir.glob('**/*.geojson')):
+        if not (match := TIGER_FILE_PATTERN.match(geo_file.name)):
+            paths.append(geo_file)
+        elif match[1] != 'us':
+            if match[1] not in states_to_skip:
+                paths.append(geo_file)
+        elif is_split(geo_file):
+            paths.extend(
+                path for path in sorted(get_split_dir(geo_file).glob(f"*/{geo_file.name}"))
+                if path.parent.name not in states_to_skip
+            )
+        else:
+            paths.append(geo_file)
+
+    return paths
+
+
+def refresh_tiger(states_to_skip, bulk=True):
+    """Loads every cleaned TIGER geojson file into the Shape and Region collections.
+
+    Only the files holding features of the states not being skipped are read (see
+    get_state_geojsons), so national files should be split by state first when loading
+    a state at a time.
+
+    Args:
+        states_to_skip ([str]): abbreviations, FIPS codes and names of states to skip.
+        bulk (bool, optional): if True (the default), features are written in batches
+            through a BulkTigerLoader. If False, each feature is written on its own.
+    """
+    loader = BulkTigerLoader(states_to_skip) if bulk else None
+
+    for year_dir in get_year_dirs():
         print(f"\n~~ Handling {year_dir.name} TIGER/Linefile data ~~")
         switch_halo_icon(spinner)
         spinner.start()
 
-        for geo_file in year_dir.glob(r'**/*.geojson'):
+        for geo_file in get_state_geojsons(year_dir, states_to_skip):
             update_halo_base(spinner, f"Handling {geo_file.name}")
             update_halo_scroll(spinner, "opening...")
 
-            with open(geo_file, 'r') as f:
-                geo = geojson.load(f)
+            # features are read one at a time, and the geometries of those in skipped
+            # states are never decoded
+            features = GeoJSONStream(
+                geo_file, skip=lambda props: props[TK.STATE_FIPS] in states_to_skip
+            )
 
-            for i, feature in enumerate(geo['features']):
-                if feature['properties'][TK.STATE_FIPS] in states_to_skip:
-                    continue
+            with span(geo_file.name, cat='file'):
+                for i, feature in enumerate(features):
+                    update_halo_scroll(spinner, f"{i} features ({features.skipped} skipped)")
+                    count_rows(1)
 
-                update_halo_scroll(spinner, f"{i}/{len(geo['features'])}")
+                    if bulk:
+                        loader.add(feature, int(year_dir.name))
+                    else:
+                        refresh_region_from_geojson(feature, int(year_dir.name))
 
-                refresh_region_from_geojson(feature, int(year_dir.name))
+            if bulk:
+                update_halo_scroll(spinner, "writing...")
+                loader.flush()
 
         spinner.succeed('Done!')
@@ -1,7 +1,10 @@
 from .init_new_dataset import init_new_dataset
+from .benchmark_ccid import benchmark_ccid
 
 
 __all__ = (
     # init_new_dataset
     init_new_dataset,
+    # benchmark_ccid
+    benchmark_ccid,
 )
@@ -0,0 +1,146 @@
+"""Benchmarks CCID assembly, breaking and validation, for a baseline before (and after)
+optimizing app/lookups/ccid.py.
+
+Every case runs offline, against the AddFIPS tables and the irregular district maps
+bundled with the repo. Each case is timed in two ways:
+    * throughput - calls per second over a tight loop of number calls
+    * latency - the p50 and p99 of number individually timed calls
+
+Only the public API of app/lookups/ccid.py is used, so the benchmark runs against any
+version of it. Where assemble_ccid memoizes its results, each assembly case is measured
+both through the memo (warm, ie - a repeated input) and past it (cold, ie - with the memo
+cleared before every call). Otherwise, only the cold cases are run.
+
+    python run.py helper benchmark_ccid --number 5000 --output ccid-baseline.json
+"""
+import json
+import time
+from statistics import quantiles
+from app.models import RegionType
+from app.lookups import ccid
+from app.lookups.ccid import assemble_ccid, break_ccid, BaseCCID
+from app.config import IRREGULAR_CCID_OUTPUT
+
+
+def get_irregular_name(abbr, suffix):
+    """Returns a district name from one of the repo's irregular district maps."""
+    with open(IRREGULAR_CCID_OUTPUT / f"{abbr}_SLD{suffix}.py", 'r') as f:
+        return next(iter(json.load(f)))
+
+
+def get_memo_clear():
+    """Returns the function clearing assemble_ccid's memo, or None if it has no memo."""
+    return getattr(ccid, 'clear_ccid_cache', None) or getattr(
+        assemble_ccid, 'cache_clear', None
+    )
+
+
+def get_assembly_cases():
+    """Returns the (name, region type, region, state) of every assembly case."""
+    return [
+        ('state, numeric fips', RegionType.STATE, '50', None),
+        ('state, int fips', RegionType.STATE, 50, None),
+        ('state, name', RegionType.STATE, 'Vermont', None),
+        ('state, abbreviation', RegionType.STATE, 'VT', None),
+        ('county, numeric fips', RegionType.COUNTY, '001', '50'),
+        ('county, full geoid', RegionType.COUNTY, '50001', None),
+        ('county, int geoid', RegionType.COUNTY, 50001, None),
+        ('county, name (AddFIPS)', RegionType.COUNTY, 'Addison County', 'VT'),
+        ('county, parish name (AddFIPS)', RegionType.COUNTY, 'Orleans Parish', 'Louisiana'),
+        ('congr, numeric fips', RegionType.CONGR, '03', '26'),
+        ('congr, full geoid', RegionType.CONGR, '2603', None),
+        ('congr, at large', RegionType.CONGR, 'at large', 'VT'),
+        ('congr, district name', RegionType.CONGR, 'Congressional District 3', 'MI'),
+        ('sldu, numeric fips', RegionType.SLDU, '012', '26'),
+        ('sldu, full geoid', RegionType.SLDU, '26012', None),
+        ('sldu, district name', RegionType.SLDU, 'State Senate District 12', 'MI'),
+        ('sldu, AK irregular name', RegionType.SLDU, get_irregular_name('AK', 'U'), 'AK'),
+        ('sldu, MA irregular name', RegionType.SLDU, get_irregular_name('MA', 'U'), 'MA'),
+        ('sldu, VT irregular name', RegionType.SLDU, get_irregular_name('VT', 'U'), 'VT'),
+        ('sldu, VT irregular geoid', RegionType.SLDU, '50ADD', None),
+        ('sldl, numeric fips', RegionType.SLDL, '001', '26'),
+        ('sldl, MA irregular name', RegionType.SLDL, get_irregular_name('MA', 'L'), 'MA'),
+        ('sldl, VT irregular name', RegionType.SLDL, get_irregular_name('VT', 'L'), 'VT'),
+    ]
+
+
+def get_cases():
+    """Returns the (name, function, args) of every benchmark case."""
+    cases = []
+
+    if (clear_memo := get_memo_clear()) is not None:
+        def assemble_cold(*args):
+            clear_memo()
+            return assemble_ccid(*args)
+    else:
+        assemble_cold = assemble_ccid
+
+    for name, reg_type, reg, state in get_assembly_cases():
+        cases.append((f"assemble_ccid cold: {name}", assemble_cold, (reg_type, reg, state)))
+        if clear_memo is not None:
+            cases.append(
+                (f"assemble_ccid warm: {name}", assemble_ccid, (reg_type, reg, state))
+            )
+
+    for ccid in ('50', '50001', '5000', '26012U', '26001L'):
+        cases.append((f"break_ccid: {ccid}", break_ccid, (ccid,)))
+
+    for ccid in ('26012U', '50ZZZ'):
+        cases.append((f"_is_valid_ccid_format: {ccid}", BaseCCID._is_valid_ccid_format, (ccid,)))
+
+    return cases
+
+
+def time_case(func, args, number):
+    """Times a single case.
+
+    Returns:
+        dict: the case's throughput (calls/s), and its p50 and p99 latencies (µs).
+    """
+    func(*args)  # warm up, ie - load the AddFIPS tables, and fill the memo for warm cases
+
+    start = time.perf_counter()
+    for _ in range(number):
+        func(*args)
+    elapsed = time.perf_counter() - start
+
+    latencies = []
+    for _ in range(number):
+        call_start = time.perf_counter_ns()
+        func(*args)
+        latencies.append((time.perf_counter_ns() - call_start) / 1000)
+
+    percentiles = quantiles(latencies, n=100)
+    return {
+        'calls_per_s': round(number / elapsed),
+        'p50_us': round(percentiles[49], 3),
+        'p99_us': round(percentiles[98], 3),
+    }
+
+
+def benchmark_ccid(number=2000, output=None):
+    """Runs every CCID benchmark case, printing a table of the results.
+
+    Args:
+        number (int, optional): the number of calls timed per case, for each measurement.
+        output (str, optional): if given, the results are also written to this JSON file.
+    """
+    number = int(number)
+    results = {}
+    for name, func, args in get_cases():
+        results[name] = time_case(func, args, number)
+
+    width = max(map(len, results))
+    print(f"\n{'case':<{width}}  {'calls/s':>12}  {'p50 (µs)':>10}  {'p99 (µs)':>10}")
+    for name, r in results.items():
+        print(
+            f"{name:<{width}}  {r['calls_per_s']:>12,}  {r['p50_us']:>10.3f}  "
+            f"{r['p99_us']:>10.3f}"
+        )
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump({'number': number, 'results': results}, f, indent=2)
+        print(f"\nResults written to {output}")
+
+    return results
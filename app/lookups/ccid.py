@@ -22,23 +22,67 @@ Todo:
 import re
 import us
 import json
+import pandas as pd
+from functools import lru_cache
 from addfips import AddFIPS
 from app.models import RegionType
 from app.config import IRREGULAR_DISTRICT_STATES, IRREGULAR_CCID_OUTPUT
 
+# the maximum number of (region type, raw region, state) inputs whose CCID's are memoized
+CCID_CACHE_SIZE = 2 ** 16
+
+VALID_CCID_REG_PATTERN = re.compile(r"(^\d{2,3}$|^\d{2}[A,B,C]$|^Z{3}$)")
+NON_ALPHA_PATTERN = re.compile(r"[^a-z]")
+TWO_DIGIT_PATTERN = re.compile(r"^\d{2}$")
+SLD_NAME_PATTERN = re.compile(r"(^\d{2}[A,B,C]$|^\d{3}$)")
+
+
+@lru_cache(maxsize=None)
+def get_addfips():
+    """Returns the process-wide AddFIPS instance (building one reads its bundled tables)."""
+    return AddFIPS()
+
+
+@lru_cache(maxsize=None)
+def lookup_state(val):
+    """A memoized version of us.states.lookup"""
+    return us.states.lookup(val)
+
+
+@lru_cache(maxsize=None)
+def load_irregular_maps():
+    """Loads every irregular district name-to-GEOID map, keyed by (state abbr, chamber suffix).
+
+    The maps are read from disk once per process, the first time any of them are needed.
+    """
+    maps = {}
+
+    for state, chambers in IRREGULAR_DISTRICT_STATES.items():
+        for suffix in ('U', 'L'):
+            if getattr(RegionType, f"SLD{suffix}").census not in chambers:
+                continue
+
+            with open(IRREGULAR_CCID_OUTPUT / f"{state.abbr}_SLD{suffix}.py", 'r') as f:
+                names_to_geoids = json.load(f)
+
+            maps[(state.abbr, suffix)] = (names_to_geoids, frozenset(names_to_geoids.values()))
+
+    return maps
+
 
 class BaseCCID:
-    VALID_RAW_STATE_PATTERN = r"^\d{1,2}$"
+    VALID_RAW_STATE_PATTERN = re.compile(r"^\d{1,2}$")
 
     def __init__(self, raw_reg, raw_state=None):
         self.code = self._clean_raw_input(raw_reg, raw_state)
 
     def _clean_state_input(self, raw_state):
-        if re.match(self.VALID_RAW_STATE_PATTERN, str(raw_state)):  # try to handle it as a code
+        if self.VALID_RAW_STATE_PATTERN.match(str(raw_state)):  # try to handle it as a code
             return str(raw_state).zfill(2)
 
         try:  # try to handle it as a name
-            assert(found_fips := AddFIPS().get_state_fips(raw_state))  # prevent returning if None
+            # prevent returning if None
+            assert(found_fips := get_addfips().get_state_fips(raw_state))
             return found_fips
         except (AssertionError, AttributeError):
             pass
@@ -69,7 +113,7 @@ class BaseCCID:
 
         state = self._clean_state_input(raw_state) if raw_state else None
 
-        if re.match(self.VALID_RAW_PATTERN, str(raw_reg)):  # try to handle it as a code
+        if self.VALID_RAW_PATTERN.match(str(raw_reg)):  # try to handle it as a code
             return self._handle_as_fips_code(raw_reg, state)
 
         if (found_fips := self._handle_as_name(raw_reg, state)):  # try to handle as a name
@@ -97,7 +141,7 @@ class BaseCCID:
                 f"1 (Alabama) and 95 (Palmyra Atoll)."
             )
 
-        if reg and not re.match(r"(^\d{2,3}$|^\d{2}[A,B,C]$|^Z{3}$)", reg):
+        if reg and not VALID_CCID_REG_PATTERN.match(reg):
             raise ValueError(
                 f"Invalid CCID value - '{ccid}' must contain a 3-digit, region-specific FIPS code "
                 f"after the first 2-digits representing a county or voting district (or 'ZZZ' for "
@@ -113,7 +157,7 @@ class BaseCCID:
 
 
 class StateCCID(BaseCCID):
-    VALID_RAW_PATTERN = r"^\d{1,2}$"
+    VALID_RAW_PATTERN = re.compile(r"^\d{1,2}$")
     FULL_LENGTH = 2
 
     def _handle_as_fips_code(self, raw_state, _):
@@ -121,7 +165,7 @@ class StateCCID(BaseCCID):
 
     def _handle_as_name(self, raw_state, _):
         try:
-            found_fips = AddFIPS().get_state_fips(raw_state)
+            found_fips = get_addfips().get_state_fips(raw_state)
         except AttributeError:
             found_fips = None
 
@@ -135,7 +179,7 @@ class StateCCID(BaseCCID):
 
 
 class CountyCCID(BaseCCID):
-    VALID_RAW_PATTERN = r"^\d{1,5}$"
+    VALID_RAW_PATTERN = re.compile(r"^\d{1,5}$")
     DIST_LENGTH = 3
     FULL_LENGTH = 5
 
@@ -161,7 +205,7 @@ class CountyCCID(BaseCCID):
 
     def _handle_as_name(self, raw_reg, state):
         try:
-            found_fips = AddFIPS().get_county_fips(raw_reg, state)
+            found_fips = get_addfips().get_county_fips(raw_reg, state)
         except AttributeError:
             found_fips = None
 
@@ -175,7 +219,7 @@ class CountyCCID(BaseCCID):
 
 
 class CongrCCID(BaseCCID):
-    VALID_RAW_PATTERN = r"(^\d{1,4}$|^\d{2}ZZ$)"
+    VALID_RAW_PATTERN = re.compile(r"(^\d{1,4}$|^\d{2}ZZ$)")
     DIST_LENGTH = 2
     FULL_LENGTH = 4
 
@@ -205,7 +249,7 @@ class CongrCCID(BaseCCID):
 
     def _handle_as_name(self, raw_reg, state_fips):
         # handle 'at large' districts
-        if re.sub(r"[^a-z]", "", raw_reg.lower()) == 'atlarge':
+        if NON_ALPHA_PATTERN.sub("", raw_reg.lower()) == 'atlarge':
             # some "At Large" districts send non-voting reps, and have
             # a different FIPS code as a result
             non_voting = ('11', '60', '66', '69', '72', '78')
@@ -214,7 +258,7 @@ class CongrCCID(BaseCCID):
             # handle full district names
             extracted_reg = raw_reg.strip().split(" ")[-1].zfill(self.DIST_LENGTH)
 
-            if re.match(r"^\d{2}$", extracted_reg):
+            if TWO_DIGIT_PATTERN.match(extracted_reg):
                 return state_fips + extracted_reg
 
         return None  # if we've made it here, we cannot parse this region name input
@@ -232,13 +276,13 @@ class CongrCCID(BaseCCID):
 
 
 class StateLegCCID(BaseCCID):
-    VALID_RAW_PATTERN = r"(" + r"|".join([
+    VALID_RAW_PATTERN = re.compile(r"(" + r"|".join([
         r"^\d{1,5}$",  # standard form
         r"^\d{1,4}[A,B,C]$",  # standard form w/ trailing letter
         r"^0200[A-Z]",  # upper chamber in AK
         r"50[A-Z0-9-][A-Z0-9-][A-Z0-9]",  # upper and lower chambers in VT
         r"^\d{2}ZZZ$"  # land area of undefined district membership, added by US Census
-    ]) + ")"
+    ]) + ")")
 
     DIST_LENGTH = 3
     FULL_LENGTH = 5
@@ -268,13 +312,12 @@ class StateLegCCID(BaseCCID):
             reg = state_fips + str(raw_reg).zfill(self.DIST_LENGTH)
 
         if (  # check if this state and chamber combination is an irregular GEOID case
-            (state := us.states.lookup(reg[:2])) in IRREGULAR_DISTRICT_STATES.keys() and
+            (state := lookup_state(reg[:2])) in IRREGULAR_DISTRICT_STATES.keys() and
             getattr(RegionType, f"SLD{self.SUFFIX}").census in IRREGULAR_DISTRICT_STATES[state]
         ):
-            with open(IRREGULAR_CCID_OUTPUT / f"{state.abbr}_SLD{self.SUFFIX}.py", 'r') as f:
-                names_to_geoids = json.load(f)
+            _, geoids = load_irregular_maps()[(state.abbr, self.SUFFIX)]
 
-            if reg not in names_to_geoids.values():
+            if reg not in geoids:
                 raise ValueError(
                     f"StateLegCCID Assemble Error - {reg} must be a valid GEOID code for a ",
                     f"district in the state of {state.abbr}."
@@ -283,10 +326,17 @@ class StateLegCCID(BaseCCID):
         return reg + self.SUFFIX
 
     def _handle_as_name(self, raw_reg, state_fips):
-        if (state := us.states.lookup(state_fips)) in IRREGULAR_DISTRICT_STATES.keys():
-            # load the correct DIST_NAMES_TO_GEOID map
-            with open(IRREGULAR_CCID_OUTPUT / f"{state.abbr}_SLD{self.SUFFIX}.py", 'r') as f:
-                names_to_geoids = json.load(f)
+        if (state := lookup_state(state_fips)) in IRREGULAR_DISTRICT_STATES.keys():
+            # get the correct DIST_NAMES_TO_GEOID map
+            if (state.abbr, self.SUFFIX) not in (irregular_maps := load_irregular_maps()):
+                # as before the maps were shared - there's no map file for this chamber
+                raise FileNotFoundError(
+                    f"StateLegCCID Assemble Error - no irregular district map for the "
+                    f"SLD{self.SUFFIX} chamber of {state.abbr} (expected "
+                    f"'{IRREGULAR_CCID_OUTPUT / f'{state.abbr}_SLD{self.SUFFIX}.py'}')."
+                )
+
+            names_to_geoids, _ = irregular_maps[(state.abbr, self.SUFFIX)]
             # clean raw_reg (if at all?)
             reg = raw_reg.lower().strip()
             # if it's in keys, return the result + self.suffix
@@ -298,7 +348,7 @@ class StateLegCCID(BaseCCID):
             # if reg.upper() == "ZZZ":
             #     return state + "ZZZ" + self.SUFFIX
 
-            if re.match(r"(^\d{2}[A,B,C]$|^\d{3}$)", reg):
+            if SLD_NAME_PATTERN.match(reg):
                 return state_fips + reg + self.SUFFIX
 
         return None  # if we've made it here, we cannot parse this region name input
@@ -334,29 +384,165 @@ def break_ccid(ccid):
         return (RegionType.COUNTY, ccid[:2], ccid[2:])
 
 
-def assemble_ccid(reg_type, reg, state=None):
-    """Assembles a CCID code for a region."""
-    ccid = None
+CCID_CLASSES = {
+    RegionType.STATE: StateCCID,
+    RegionType.COUNTY: CountyCCID,
+    RegionType.CONGR: CongrCCID,
+    RegionType.SLDU: StateLegUpperCCID,
+    RegionType.SLDL: StateLegLowerCCID,
+}
+
+
+@lru_cache(maxsize=CCID_CACHE_SIZE, typed=True)
+def _assemble_cached_ccid(reg_type, reg, state):
+    return _assemble_ccid(reg_type, reg, state)
+
+
+def _get_ccid_class(reg_type):
+    # checked before the lookup, so that unhashable region types raise the same error
+    if not isinstance(reg_type, RegionType):
+        raise ValueError(
+            f"CCID Assembly error - unable to interpet region type '{reg_type}' as a "
+            f"valid RegionType Enum option."
+        )
+
+    return CCID_CLASSES[reg_type]
+
+
+def _assemble_ccid(reg_type, reg, state):
+    ccid_cls = _get_ccid_class(reg_type)
 
     if reg_type == RegionType.STATE:
-        ccid = StateCCID(reg)
+        return ccid_cls(reg).code
 
-    elif reg_type == RegionType.COUNTY:
-        ccid = CountyCCID(reg, state)
+    return ccid_cls(reg, state).code
 
-    elif reg_type == RegionType.CONGR:
-        ccid = CongrCCID(reg, state)
 
-    elif reg_type == RegionType.SLDU:
-        ccid = StateLegUpperCCID(reg, state)
+def assemble_ccid(reg_type, reg, state=None):
+    """Assembles a CCID code for a region.
 
-    elif reg_type == RegionType.SLDL:
-        ccid = StateLegLowerCCID(reg, state)
+    Results are memoized per (reg_type, reg, state), so repeated calls with the same inputs
+    skip the FIPS/name lookups entirely. Inputs that can't be cached (ie - unhashable
+    values) are passed straight through, so they raise the same errors as always.
+    """
+    if (
+        isinstance(reg_type, RegionType) and isinstance(reg, (int, str, float)) and
+        isinstance(state, (int, str, type(None)))
+    ):
+        return _assemble_cached_ccid(reg_type, reg, state)
 
-    if not ccid:
+    return _assemble_ccid(reg_type, reg, state)
+
+
+def clear_ccid_cache():
+    """Empties the assemble_ccid memo (the AddFIPS tables and irregular maps are kept)."""
+    _assemble_cached_ccid.cache_clear()
+
+
+def _accepts_as_code(series):
+    """Flags the values of a Series that assemble_ccid could read as a numeric FIPS code."""
+    if pd.api.types.is_integer_dtype(series.dtype):
+        return pd.Series(True, index=series.index)
+
+    if pd.api.types.is_object_dtype(series.dtype) or pd.api.types.is_string_dtype(series.dtype):
+        return series.map(lambda v: isinstance(v, (int, str)) and not isinstance(v, bool))
+
+    return pd.Series(False, index=series.index)
+
+
+def _state_fips_or_blank(raw_state):
+    """Returns the state's FIPS code, '' if no state was given, or None if it's unreadable."""
+    if raw_state is None:
+        return ''
+
+    if not isinstance(raw_state, (int, str)) or isinstance(raw_state, bool):
+        return None
+
+    if not raw_state:
+        return ''
+
+    try:
+        return assemble_ccid(RegionType.STATE, raw_state)
+    except ValueError:
+        return None
+
+
+def _assemble_or_coerce(reg_type, reg, state, errors):
+    try:
+        return assemble_ccid(reg_type, reg, state=state)
+    except (ValueError, TypeError, AttributeError, FileNotFoundError):
+        if errors == 'raise':
+            raise
+        return None
+
+
+def assemble_ccids(reg_type, series, state_series=None, errors='raise'):
+    """Assembles CCID codes for a whole Series of regions at once.
+
+    Purely numeric FIPS codes are converted with vectorized string operations. Everything
+    else (ie - county or district names) goes through the memoized assemble_ccid, so each
+    unique (region, state) pair is only resolved once, and the results are joined back on.
+
+    Args:
+        reg_type (RegionType): the type of every region in the Series.
+        series (pd.Series): the region FIPS codes or names, as accepted by assemble_ccid.
+        state_series (pd.Series or str, optional): the state of each region, or a single
+            state shared by the whole Series.
+        errors (str, optional): if 'raise' (the default), the first region that can't be
+            interpreted raises an error. If 'coerce', its CCID is set to None instead.
+
+    Returns:
+        pd.Series: the CCID of each region, indexed the same as the input Series.
+    """
+    if errors not in ('raise', 'coerce'):
         raise ValueError(
-            f"CCID Assembly error - unable to interpet region type '{reg_type}' as a "
-            f"valid RegionType Enum option."
+            f"CCID Assembly error - errors must be either 'raise' or 'coerce', not '{errors}'."
         )
 
-    return ccid.code
+    ccid_cls = _get_ccid_class(reg_type)
+
+    if reg_type == RegionType.STATE or not isinstance(state_series, pd.Series):
+        state = None if reg_type == RegionType.STATE else state_series
+        state_series = pd.Series([state] * len(series), index=series.index, dtype=object)
+
+    state_fips = state_series.map(_state_fips_or_blank)
+    readable_state = state_fips.notna()
+    state_fips = state_fips.fillna('')
+    has_state = state_fips != ''
+
+    raw = series.astype(str)
+    full_length = ccid_cls.FULL_LENGTH
+
+    if reg_type == RegionType.STATE:
+        codes = raw.str.zfill(full_length)
+        fast = raw.str.fullmatch(r"\d{1,2}")
+    else:
+        is_full = raw.str.len() > full_length - 2
+        codes = raw.str.zfill(full_length).where(
+            is_full, state_fips + raw.str.zfill(ccid_cls.DIST_LENGTH)
+        )
+        fast = raw.str.fullmatch(rf"\d{{1,{full_length}}}") & (
+            (is_full & (~has_state | (codes.str[:2] == state_fips))) | (~is_full & has_state)
+        )
+
+    if reg_type in (RegionType.SLDU, RegionType.SLDL):
+        codes = codes + ccid_cls.SUFFIX
+        # irregular districts have their GEOID's validated against a lookup table
+        irregular_fips = [
+            s.fips for s, chambers in IRREGULAR_DISTRICT_STATES.items()
+            if reg_type.census in chambers
+        ]
+        fast &= ~codes.str[:2].isin(irregular_fips)
+
+    fast = fast.fillna(False).astype(bool) & _accepts_as_code(series) & readable_state
+    ccids = codes.astype(object).where(fast, None)
+
+    if (~fast).any():
+        ccids[~fast] = [
+            _assemble_or_coerce(reg_type, reg, state, errors)
+            for reg, state in zip(
+                series[~fast].astype(object), state_series[~fast].astype(object)
+            )
+        ]
+
+    return ccids
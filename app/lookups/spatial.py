@@ -0,0 +1,227 @@
+"""An in-process spatial index over TIGER shapes, for point-in-region and overlap lookups.
+
+The index is a static, bulk-loaded R-tree built with the Sort-Tile-Recursive (STR)
+algorithm: the shapes' bounding boxes are sorted into vertical slices by the x of their
+centers, each slice is sorted by y, and runs of NODE_CAPACITY boxes are packed into nodes.
+The same is repeated with the nodes' own bounding boxes until a single root is left.
+Since every level is packed in order, node i of a level covers nodes (or shapes)
+[i * NODE_CAPACITY, (i + 1) * NODE_CAPACITY) of the level below it, and the whole tree is
+just one (n, 4) array of bounding boxes per level - which is searched a level at a time
+with vectorized comparisons.
+
+Bounding box hits are then narrowed down with exact (shapely) geometry tests. Geometries
+are stored as WKB, and only decoded when a lookup first needs them, so that a persisted
+index loads quickly.
+
+    index = SpatialIndex.from_tiger(years=[2020])
+    index.save()
+    ...
+    index = SpatialIndex.load()
+    index.containing(-72.58, 44.26, region_type=RegionType.SLDU, year=2020)
+"""
+import pickle
+import numpy as np
+from shapely import wkb
+from shapely.geometry import Point, box, shape as to_shapely
+from utils import GeoJSONStream
+from app.models import RegionType
+from app.config import TigerDataset as TD
+
+NODE_CAPACITY = 16
+
+
+def str_pack(bboxes, capacity=NODE_CAPACITY):
+    """Orders bounding boxes for packing with the Sort-Tile-Recursive algorithm.
+
+    Args:
+        bboxes (np.ndarray): an (n, 4) array of (minx, miny, maxx, maxy) boxes.
+        capacity (int, optional): the number of boxes in each node.
+
+    Returns:
+        np.ndarray: the order the boxes should be packed in.
+    """
+    n = len(bboxes)
+    centers = (bboxes[:, :2] + bboxes[:, 2:]) / 2
+
+    slice_size = capacity * int(np.ceil(np.sqrt(np.ceil(n / capacity))))
+    by_x = np.argsort(centers[:, 0], kind='stable')
+
+    return np.concatenate([
+        s[np.argsort(centers[s, 1], kind='stable')]
+        for s in (by_x[i:i + slice_size] for i in range(0, n, slice_size))
+    ]) if n else by_x
+
+
+def pack_level(bboxes, capacity=NODE_CAPACITY):
+    """Returns the bounding boxes of the nodes that cover each run of capacity boxes."""
+    starts = np.arange(0, len(bboxes), capacity)
+    return np.column_stack([
+        np.minimum.reduceat(bboxes[:, 0], starts),
+        np.minimum.reduceat(bboxes[:, 1], starts),
+        np.maximum.reduceat(bboxes[:, 2], starts),
+        np.maximum.reduceat(bboxes[:, 3], starts),
+    ])
+
+
+class SpatialIndex:
+    """A spatial index over the shapes of many regions, across region types and years.
+
+    Args:
+        ccids ([str]): the CCID of each shape's region.
+        region_types ([RegionType]): the region type of each shape.
+        years ([int]): the year of each shape.
+        geometries ([dict]): each shape's geojson geometry (or shapely geometry).
+    """
+
+    def __init__(self, ccids, region_types, years, geometries):
+        geometries = [g if hasattr(g, 'bounds') else to_shapely(g) for g in geometries]
+
+        bboxes = np.array([g.bounds for g in geometries], dtype=float).reshape(-1, 4)
+        order = str_pack(bboxes)
+
+        self.ccids = np.array(ccids, dtype=object)[order]
+        self.region_types = np.array([rt.name for rt in region_types], dtype=object)[order]
+        self.years = np.array(years, dtype=int)[order]
+        self.wkbs = [geometries[i].wkb for i in order]
+
+        # levels[0] holds the shapes' own bounding boxes, and levels[-1] the root's
+        self.levels = [bboxes[order]]
+        while len(self.levels[-1]) > 1:
+            self.levels.append(pack_level(self.levels[-1]))
+
+        self._geometries = {}
+
+    def __len__(self):
+        return len(self.ccids)
+
+    @classmethod
+    def from_tiger(cls, tiger_dir=TD.TIGER_DIR, years=None, region_types=None):
+        """Builds an index from the cleaned TIGER geojson files.
+
+        Args:
+            tiger_dir (Path, optional): the directory of cleaned TIGER data, by year.
+            years ([int], optional): the years to include. Defaults to every year.
+            region_types ([RegionType], optional): the region types to include. Defaults to
+                every region type.
+        """
+        mafs = {rt.maf for rt in (region_types or RegionType)}
+        ccids, types, shape_years, geometries = [], [], [], []
+
+        for year_dir in sorted(d for d in tiger_dir.iterdir() if d.name.isdigit()):
+            if years and int(year_dir.name) not in years:
+                continue
+
+            for geo_file in sorted(year_dir.glob('**/*.geojson')):
+                for feature in GeoJSONStream(
+                    geo_file, skip=lambda props: props[TD.Keys.TYPE_CODE] not in mafs
+                ):
+                    props = feature['properties']
+                    ccids.append(props[TD.Keys.CCID])
+                    types.append(RegionType.fuzzy_cast(props[TD.Keys.TYPE_CODE]))
+                    shape_years.append(int(year_dir.name))
+                    geometries.append(to_shapely(feature['geometry']))
+
+        return cls(ccids, types, shape_years, geometries)
+
+    def save(self, path=TD.SPATIAL_INDEX):
+        """Persists the index (its bounding boxes, and geometries as WKB) to disk."""
+        with open(path, 'wb') as f:
+            pickle.dump(
+                {k: v for k, v in self.__dict__.items() if k != '_geometries'},
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+
+    @classmethod
+    def load(cls, path=TD.SPATIAL_INDEX):
+        """Loads an index persisted with save."""
+        index = cls.__new__(cls)
+
+        with open(path, 'rb') as f:
+            index.__dict__.update(pickle.load(f))
+
+        index._geometries = {}
+        return index
+
+    def geometry(self, i):
+        """Returns the shapely geometry of the i-th shape, decoding it on first use."""
+        if (geom := self._geometries.get(i)) is None:
+            geom = self._geometries[i] = wkb.loads(self.wkbs[i])
+        return geom
+
+    def _candidates(self, minx, miny, maxx, maxy, region_type=None, year=None):
+        """Returns the indices of the shapes whose bounding boxes intersect the given one"""
+        nodes = np.arange(len(self.levels[-1]))
+
+        for depth in reversed(range(len(self.levels))):
+            boxes = self.levels[depth][nodes]
+            nodes = nodes[
+                (boxes[:, 0] <= maxx) & (boxes[:, 2] >= minx)
+                & (boxes[:, 1] <= maxy) & (boxes[:, 3] >= miny)
+            ]
+
+            if depth:  # expand the matched nodes into their children on the level below
+                nodes = (nodes[:, None] * NODE_CAPACITY + np.arange(NODE_CAPACITY)).ravel()
+                nodes = nodes[nodes < len(self.levels[depth - 1])]
+
+        if region_type is not None:
+            nodes = nodes[self.region_types[nodes] == region_type.name]
+        if year is not None:
+            nodes = nodes[self.years[nodes] == year]
+
+        return nodes
+
+    def _results(self, indices):
+        return [self.ccids[i] for i in indices]
+
+    def containing(self, lon, lat, region_type=None, year=None):
+        """Returns the CCIDs of the regions whose shapes contain (or border) a point."""
+        point = Point(lon, lat)
+        return self._results(
+            i for i in self._candidates(lon, lat, lon, lat, region_type, year)
+            if self.geometry(i).intersects(point)
+        )
+
+    def intersecting_bbox(self, minx, miny, maxx, maxy, region_type=None, year=None):
+        """Returns the CCIDs of the regions whose shapes intersect a bounding box."""
+        bbox = box(minx, miny, maxx, maxy)
+        return self._results(
+            i for i in self._candidates(minx, miny, maxx, maxy, region_type, year)
+            if self.geometry(i).intersects(bbox)
+        )
+
+    def overlapping(self, geometry, region_type=None, year=None):
+        """Returns the CCIDs of the regions whose shapes share some area with a geometry
+        (ie - the districts that overlap a county), not counting those that only touch it.
+        """
+        geometry = geometry if hasattr(geometry, 'bounds') else to_shapely(geometry)
+        return self._results(
+            i for i in self._candidates(*geometry.bounds, region_type, year)
+            if (g := self.geometry(i)).intersects(geometry) and not g.touches(geometry)
+        )
+
+    def locate(self, points, region_type, year=None):
+        """Looks up the region of a given type containing each of many points, ie - to
+        find the districts of a list of geocoded addresses.
+
+        Args:
+            points ([(float, float)]): (longitude, latitude) pairs.
+
+        Returns:
+            [str]: the CCID of a region containing each point, or None if there isn't one.
+        """
+        return [
+            next(iter(self.containing(lon, lat, region_type, year)), None)
+            for lon, lat in points
+        ]
+
+    def intersections(self, geometry, region_type=None, year=None):
+        """Yields the CCID of each region whose shape shares some area with a geometry,
+        along with the area they share (in the geometries' units, ie - square degrees).
+        """
+        geometry = geometry if hasattr(geometry, 'bounds') else to_shapely(geometry)
+
+        for i in self._candidates(*geometry.bounds, region_type, year):
+            if (g := self.geometry(i)).intersects(geometry):
+                if (area := g.intersection(geometry).area) > 0:
+                    yield self.ccids[i], area
@@ -1,14 +1,25 @@
 from app.models.asthma import *
+from app.models.checkpoint import *
+from app.models.deployment import *
 from app.models.jobs import *
+from app.models.manifest import *
 from app.models.regions import *
 
 __all__ = (
     # asthma.py
     AsthmaData,
+    # checkpoint.py
+    BuildPlan,
+    BuildCheckpoint,
+    # deployment.py
+    Deployment,
+    ProductionPointer,
     # jobs.py
     JobsData,
     JobsStat,
     JobsCounts,
+    # manifest.py
+    ManifestEntry,
     # regions.py
     RegionType,
     RegionShape,
@@ -22,4 +33,5 @@ __all__ = (
     CongressionalDistrict,
     StateLegDistUpper,
     StateLegDistLower,
+    FragmentGraph,
 )
@@ -0,0 +1,45 @@
+"""A module for the data models recording the progress of a database build.
+
+When a build starts, its plan (the stages it runs, and the states it runs them for) is
+saved as the database's single BuildPlan document. As each (stage, state) unit of the
+build starts, finishes or fails, its BuildCheckpoint document is updated - so that a
+build that dies partway through can be resumed from its incomplete units, instead of
+being started again from scratch.
+
+"""
+from datetime import datetime
+from mongoengine import Document, StringField, DateTimeField, DictField, ListField
+
+STARTED, COMPLETE, FAILED = 'started', 'complete', 'failed'
+
+
+class BuildPlan(Document):
+    stages = DictField(required=True)
+    states = ListField(StringField(max_length=2, min_length=2), required=True)
+
+    date_started = DateTimeField(default=datetime.utcnow)
+    date_completed = DateTimeField()
+
+    def __repr__(self):
+        return f"<BuildPlan(stages={list(self.stages)}, states={len(self.states)})>"
+
+
+class BuildCheckpoint(Document):
+    stage = StringField(required=True)
+    state_abbr = StringField(required=True, max_length=2, min_length=2)
+    status = StringField(required=True, choices=[STARTED, COMPLETE, FAILED])
+    error = StringField()
+
+    date_modified = DateTimeField(default=datetime.utcnow)
+
+    meta = {
+        'indexes': [
+            {'fields': ['stage', 'state_abbr'], 'unique': True},
+        ]
+    }
+
+    def __repr__(self):
+        return (
+            f"<BuildCheckpoint(stage='{self.stage}', state_abbr='{self.state_abbr}', "
+            f"status='{self.status}')>"
+        )
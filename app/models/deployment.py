@@ -0,0 +1,43 @@
+"""A module for the data models recording which database is live in production.
+
+Unlike every other model, these documents live in the metadata database (METADATA_DB)
+rather than in any one built database, and are accessed through the METADATA_ALIAS
+connection. The single ProductionPointer document names the live production database,
+and is flipped from one build to the next in a single atomic update when a build is
+promoted. Each build has a Deployment document tracking it from staging to retirement.
+
+"""
+from datetime import datetime
+from mongoengine import Document, StringField, DateTimeField, DictField
+from app.config import METADATA_ALIAS
+
+STAGED, LIVE, RETIRED, DROPPED = 'staged', 'live', 'retired', 'dropped'
+PRODUCTION = 'production'
+
+
+class Deployment(Document):
+    db_name = StringField(required=True, unique=True)
+    status = StringField(required=True, choices=[STAGED, LIVE, RETIRED, DROPPED])
+    validations = DictField()
+    timings = DictField()
+
+    date_built = DateTimeField(default=datetime.utcnow)
+    date_promoted = DateTimeField()
+    date_retired = DateTimeField()
+
+    meta = {'db_alias': METADATA_ALIAS, 'indexes': ['status']}
+
+    def __repr__(self):
+        return f"<Deployment(db_name='{self.db_name}', status='{self.status}')>"
+
+
+class ProductionPointer(Document):
+    name = StringField(primary_key=True, default=PRODUCTION)
+    db_name = StringField(required=True)
+
+    date_promoted = DateTimeField(default=datetime.utcnow)
+
+    meta = {'db_alias': METADATA_ALIAS}
+
+    def __repr__(self):
+        return f"<ProductionPointer(name='{self.name}', db_name='{self.db_name}')>"
@@ -0,0 +1,92 @@
+"""Vectorized weighted-sum extrapolation for embedded data documents.
+
+Extrapolating data for a set of target regions from their intersecting source regions is a
+sparse matrix product - the weight matrix W (targets x sources) holds the perc_of_whole of
+each fragment, and the source matrix X (sources x fields) holds every numeric field of the
+sources' embedded documents, flattened into dotted paths (ie - 'counts.solar'). The
+targets' extrapolated data is then W @ X.
+
+W is kept in coordinate form (parallel arrays of row, column and weight), and the product
+is computed one field at a time with numpy.bincount, which sums each row's weighted
+contributions in a single pass.
+"""
+import numpy as np
+
+
+def flatten_numeric(doc, prefix=''):
+    """Flattens the numeric leaves of a (raw, nested) embedded document into a dict of
+    dotted paths to values. Booleans and non-numeric fields are ignored.
+    """
+    flat = {}
+
+    for key, value in doc.items():
+        if isinstance(value, dict):
+            flat.update(flatten_numeric(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+
+    return flat
+
+
+def unflatten(flat):
+    """The inverse of flatten_numeric, skipping paths whose value is None."""
+    doc = {}
+
+    for path, value in flat.items():
+        if value is None:
+            continue
+
+        *parents, leaf = path.split('.')
+        node = doc
+        for p in parents:
+            node = node.setdefault(p, {})
+        node[leaf] = value
+
+    return doc
+
+
+def source_matrix(source_docs, fields):
+    """Builds the dense (sources x fields) matrix of flattened source documents, with NaN
+    wherever a source is missing a field.
+    """
+    matrix = np.full((len(source_docs), len(fields)), np.nan)
+    field_cols = {f: j for j, f in enumerate(fields)}
+
+    for i, doc in enumerate(source_docs):
+        for path, value in doc.items():
+            if (j := field_cols.get(path)) is not None:
+                matrix[i, j] = value
+
+    return matrix
+
+
+def weighted_sums(rows, cols, weights, sources, n_targets):
+    """Computes the sparse-dense product W @ X.
+
+    Args:
+        rows (np.ndarray): the target (row) index of each nonzero weight in W.
+        cols (np.ndarray): the source (column) index of each nonzero weight in W.
+        weights (np.ndarray): the nonzero weights of W.
+        sources (np.ndarray): the dense (sources x fields) matrix X, with NaN for missing
+            values.
+        n_targets (int): the number of rows in W.
+
+    Returns:
+        np.ndarray: a (targets x fields) matrix. A target's field is NaN if none of its
+            sources had a value for that field; missing values are otherwise treated as 0.
+    """
+    result = np.full((n_targets, sources.shape[1]), np.nan)
+
+    if not len(weights):
+        return result
+
+    contributions = sources[cols] * weights[:, np.newaxis]
+    present = ~np.isnan(contributions)
+    contributions[~present] = 0
+
+    for j in range(sources.shape[1]):
+        sums = np.bincount(rows, weights=contributions[:, j], minlength=n_targets)
+        has_value = np.bincount(rows, weights=present[:, j], minlength=n_targets) > 0
+        result[has_value, j] = sums[has_value]
+
+    return result
@@ -0,0 +1,28 @@
+"""A module for the data model recording which cleaned inputs a database was built from.
+
+Each document in the database's ManifestEntry collection holds the content hash of one
+cleaned input (a file, or a single state's rows of a file) as it was when a build stage
+last loaded it for a given state. Refreshes compare the current hashes of the cleaned
+inputs against these entries to find the states whose data has actually changed.
+
+"""
+from datetime import datetime
+from mongoengine import Document, StringField, DateTimeField
+
+
+class ManifestEntry(Document):
+    dataset = StringField(required=True)
+    key = StringField(required=True)
+    state_abbr = StringField(required=True, max_length=2, min_length=2)
+    digest = StringField(required=True)
+
+    date_modified = DateTimeField(default=datetime.utcnow)
+
+    meta = {
+        'indexes': [
+            {'fields': ['dataset', 'state_abbr', 'key'], 'unique': True},
+        ]
+    }
+
+    def __repr__(self):
+        return f"<ManifestEntry(dataset='{self.dataset}', key='{self.key}')>"
@@ -2,7 +2,9 @@
 
 """
 from datetime import datetime
+import numpy as np
 from enum import Enum
+from pymongo import UpdateOne
 from mongoengine import (
     Document,
     StringField,
@@ -20,6 +22,10 @@ from mongoengine import (
     URLField,
 )
 from mongoengine.base import GeoJsonBaseField
+from mongoengine.queryset import QuerySet
+from app.models.extrapolation import (
+    flatten_numeric, unflatten, source_matrix, weighted_sums
+)
 
 
 class RegionShapeField(GeoJsonBaseField):
@@ -51,9 +57,29 @@ class RegionShapeField(GeoJsonBaseField):
             self.error(error)
 
 
+# the Shape field that holds each tier of (simplified) geometry
+SHAPE_TIERS = {'full': 'shape', 'medium': 'shape_medium', 'low': 'shape_low'}
+
+
+class ShapeQuerySet(QuerySet):
+    def tier(self, tier):
+        """Loads only the geometry of the given tier (see SHAPE_TIERS), ie -
+        Shape.objects(state_abbr='VT').tier('low'), to avoid transferring the others.
+        """
+        if tier not in SHAPE_TIERS:
+            raise ValueError(
+                f"Shape Error - '{tier}' is not a shape tier, choose from "
+                f"{', '.join(SHAPE_TIERS)}"
+            )
+
+        return self.exclude(*[field for t, field in SHAPE_TIERS.items() if t != tier])
+
+
 class Shape(Document):
     year = IntField(required=True)
     shape = RegionShapeField(required=True)
+    shape_medium = RegionShapeField()
+    shape_low = RegionShapeField()
     state_abbr = StringField(required=True, max_length=2, min_length=2)
     geoid = StringField(required=True)
     ccid = StringField(required=True)
@@ -68,12 +94,19 @@ class Shape(Document):
             {'fields': ['ccid', 'year'], 'unique': True},
             'state_abbr',
             '(shape',
-        ]
+        ],
+        'queryset_class': ShapeQuerySet,
     }
 
     def __repr__(self):
         return f"<Shape(name='{self.name}', ccid='{self.ccid}')>"
 
+    def get_shape(self, tier='full'):
+        """Returns the geometry of the given tier, or the full geometry if the tier wasn't
+        computed for this shape.
+        """
+        return getattr(self, SHAPE_TIERS[tier]) or self.shape
+
 
 class RegionShape(EmbeddedDocument):
     """Stores the geojson shape for a region"""
@@ -139,7 +172,7 @@ class Region(Document):
         # Anytime save() is called, make sure the date_modified field updates
         self.date_modified = datetime.utcnow
 
-    def extrapolate_count(self, target_cls, frag_type, doc_attr, omit=[]):
+    def extrapolate_count(self, target_cls, frag_type, doc_attr, omit=[], graph=None):
         """Extrapolates region-specific data from data of intersecting regions
         using the population-based fragments list.
 
@@ -162,82 +195,26 @@ class Region(Document):
             omit ([str], optional): a list of field names inside the target_cls
                 that should be skipped when extrapolating data for the new
                 class instance.
+            graph (FragmentGraph, optional): a pre-loaded graph containing this
+                region and its intersecting regions. If not provided, one is
+                loaded with a single query.
 
         Returns:
             EmbeddedDocument: The new embedded document with extrapolated data
         """
-        target = target_cls()
-
-        for f in self.fragments:
-            # if the type of region creating this fragment with self's region
-            # isn't the region type specified by frag_type, skip it
-            if (
-                Region.objects.only('_cls').get(id=f.region.id)._cls
-                != frag_type.cls_name
-            ):
-                continue
-
-            f_reg = Region.objects.only('fragments', 'ccid', doc_attr).get(
-                id=f.region.id
-            )
-
-            if (source_emb_doc := getattr(f_reg, doc_attr)).extrapolated:
-                raise Exception(
-                    f"Extrapolation error - could not extrapolate {target_cls} data for"
-                    f" {self} using intersecting {frag_type.name} regions, since those"
-                    " intersecting regions have extrapolated data themselves. Make"
-                    " sure extrapolated data is sourced from non-extrapolated regions."
-                )
-
-            frag_of_self_from_source = list(
-                filter(lambda f: f.region.id == self.id, f_reg.fragments)
-            )[0]
-
-            source_perc_of_whole = frag_of_self_from_source.perc_of_whole
-
-            for field in target._data.keys():
-                if field not in omit:
-                    curr = getattr(target, field) if getattr(target, field) else 0
-                    new_val = (
-                        curr + getattr(source_emb_doc, field) * source_perc_of_whole
-                    )
-                    setattr(target, field, new_val)
-
-        target.extrapolated = True
-        return target
+        if graph is None:
+            graph = FragmentGraph.for_region(self, [doc_attr])
 
-    def extrapolate_weighted_average(self, target_cls, frag_type, doc_attr, omit=[]):
-        target = target_cls()
+        return graph.extrapolate_count(self.id, target_cls, frag_type, doc_attr, omit)
 
-        for f in self.fragments:
-            # if the type of region creating this fragment with self's region
-            # isn't the region type specified by frag_type, skip it
-            if (
-                Region.objects.only('_cls').get(id=f.region.id)._cls
-                != frag_type.cls_name
-            ):
-                continue
+    def extrapolate_weighted_average(self, target_cls, frag_type, doc_attr, omit=[],
+                                     graph=None):
+        if graph is None:
+            graph = FragmentGraph.for_region(self, [doc_attr])
 
-            f_reg = Region.objects.only('fragments', 'ccid', doc_attr).get(
-                id=f.region.id
-            )
-
-            if (source_emb_doc := getattr(f_reg, doc_attr)).extrapolated:
-                raise Exception(
-                    f"Extrapolation error - could not extrapolate {target_cls} data for"
-                    f" {self} using intersecting {frag_type.name} regions, since those"
-                    " intersecting regions have extrapolated data themselves. Make"
-                    " sure extrapolated data is sourced from non-extrapolated regions."
-                )
-
-            for field in target._fields.keys():
-                if field not in omit:
-                    curr = getattr(target, field) if getattr(target, field) else 0
-                    new_val = curr + getattr(source_emb_doc, field) * f.perc_of_whole
-                    setattr(target, field, new_val)
-
-        target.extrapolated = True
-        return target
+        return graph.extrapolate_weighted_average(
+            self.id, target_cls, frag_type, doc_attr, omit
+        )
 
 
 class State(Region):
@@ -363,3 +340,212 @@ class RegionType(Enum):
             )
 
         return found
+
+
+class FragmentGraph:
+    """An in-memory copy of the fragment relationships between regions.
+
+    Built from a single projection query, the graph holds each region's class, CCID,
+    fragment weights and any embedded data documents needed for extrapolation, so that
+    extrapolating data for many regions at once doesn't need a query per fragment.
+    Results are written back with one bulk write.
+
+    Attributes:
+        classes ({ObjectId: str}): each region's '_cls' value.
+        ccids ({ObjectId: str}): each region's CCID.
+        data ({ObjectId: {str: dict}}): each region's raw embedded data documents, by
+            document attribute name.
+        weights ({ObjectId: {ObjectId: float}}): the perc_of_whole of every fragment
+            a region owns, keyed by owner and then by the fragment's source region. An
+            owner's fragments of the same source are summed.
+    """
+
+    def __init__(self, regions, doc_attrs):
+        self.doc_attrs = tuple(doc_attrs)
+        self.classes = {}
+        self.ccids = {}
+        self.state_abbrs = {}
+        self.data = {}
+        self.weights = {}
+
+        for r in regions:
+            self.classes[r['_id']] = r['_cls']
+            self.ccids[r['_id']] = r['ccid']
+            self.state_abbrs[r['_id']] = r.get('state_abbr')
+            self.data[r['_id']] = {a: r[a] for a in self.doc_attrs if r.get(a) is not None}
+            weights = self.weights[r['_id']] = {}
+            for f in r.get('fragments', []):
+                weights[f['region']] = weights.get(f['region'], 0) + f['perc_of_whole']
+
+    @classmethod
+    def _projection(cls, doc_attrs):
+        return {
+            '_cls': 1,
+            'ccid': 1,
+            'state_abbr': 1,
+            'fragments.region': 1,
+            'fragments.perc_of_whole': 1,
+            **{a: 1 for a in doc_attrs},
+        }
+
+    @classmethod
+    def load(cls, doc_attrs, states_to_skip=()):
+        """Builds a graph of every region outside of states_to_skip."""
+        return cls(
+            Region._get_collection().find(
+                {'state_abbr': {'$nin': list(states_to_skip)}}, cls._projection(doc_attrs)
+            ),
+            doc_attrs,
+        )
+
+    @classmethod
+    def for_region(cls, region, doc_attrs):
+        """Builds a graph of a single region and the regions it has fragments of."""
+        sources = Region._get_collection().find(
+            {'_id': {'$in': [f.region.id for f in region.fragments]}},
+            cls._projection(doc_attrs),
+        )
+        return cls([region.to_mongo(), *sources], doc_attrs)
+
+    def __contains__(self, region_id):
+        return region_id in self.classes
+
+    def targets(self, doc_attr):
+        """Returns the ids of regions with fragments, but without direct doc_attr data."""
+        return [
+            r_id for r_id, frags in self.weights.items()
+            if frags and (
+                doc_attr not in self.data[r_id] or self.data[r_id][doc_attr].get('extrapolated')
+            )
+        ]
+
+    def _check_source(self, region_id, source_id, target_cls, frag_type, doc_attr):
+        """Makes sure a source region holds non-extrapolated data to extrapolate from."""
+        source_doc = self.data[source_id].get(doc_attr)
+
+        if source_doc is None or source_doc.get('extrapolated'):
+            raise Exception(
+                f"Extrapolation error - could not extrapolate {target_cls} data for"
+                f" <Region(ccid='{self.ccids[region_id]}')> using intersecting"
+                f" {frag_type.name} regions, since those intersecting regions have"
+                f" {'no' if source_doc is None else 'extrapolated'} data themselves."
+                " Make sure extrapolated data is sourced from non-extrapolated regions."
+            )
+
+        return source_doc
+
+    def extrapolate_all(self, region_ids, target_cls, frag_type, doc_attr, omit=[],
+                        method='count'):
+        """Extrapolates data for many regions at once, as a weighted sum of their sources.
+
+        Each region's fragments of type frag_type become a row of (sparse) weights, and the
+        numeric fields of those fragments' embedded documents become the source matrix.
+        Their product is summed one field at a time with numpy.bincount (see
+        app.models.extrapolation.weighted_sums).
+
+        A source missing a field contributes nothing to it, and a field none of a region's
+        sources have is left unset (None). The per-region extrapolation this replaced
+        raised instead, on any missing field.
+
+        Args:
+            region_ids ([ObjectId]): the regions to extrapolate data for.
+            target_cls (EmbeddedDocument): the class of the embedded document to build.
+            frag_type (RegionType): the type of intersecting region to extrapolate from.
+            doc_attr (str): the name of the embedded document in each region.
+            omit ([str], optional): (dotted) field names to leave out of the result.
+            method (str, optional): 'count' weights each source by the share of the
+                source inside the target region (see Region.extrapolate_count), while
+                'weighted_average' weights each source by the share of the target
+                region inside the source.
+
+        Returns:
+            {ObjectId: EmbeddedDocument}: the extrapolated document for each region.
+        """
+        if method not in ('count', 'weighted_average'):
+            raise ValueError(
+                f"Extrapolation error - method must be either 'count' or "
+                f"'weighted_average', not '{method}'."
+            )
+
+        rows, cols, weights = [], [], []
+        source_cols = {}
+        source_docs = []
+
+        for row, region_id in enumerate(region_ids):
+            for source_id, perc_of_whole in self.weights[region_id].items():
+                # if the type of region creating this fragment with the target region
+                # isn't the region type specified by frag_type, skip it
+                if self.classes.get(source_id) != frag_type.cls_name:
+                    continue
+
+                if source_id not in source_cols:
+                    source_doc = self._check_source(
+                        region_id, source_id, target_cls, frag_type, doc_attr
+                    )
+                    source_cols[source_id] = len(source_docs)
+                    source_docs.append(flatten_numeric(source_doc))
+
+                rows.append(row)
+                cols.append(source_cols[source_id])
+                weights.append(
+                    self.weights[source_id][region_id] if method == 'count' else perc_of_whole
+                )
+
+        fields = sorted(
+            {path for doc in source_docs for path in doc}
+            - {'extrapolated', *omit}
+        )
+        fields = [f for f in fields if f.split('.')[0] in target_cls._fields]
+
+        results = weighted_sums(
+            np.array(rows, dtype=int),
+            np.array(cols, dtype=int),
+            np.array(weights, dtype=float),
+            source_matrix(source_docs, fields),
+            len(region_ids),
+        )
+
+        return {
+            region_id: target_cls._from_son({
+                **unflatten({
+                    f: (None if np.isnan(v) else float(v)) for f, v in zip(fields, values)
+                }),
+                'extrapolated': True,
+            })
+            for region_id, values in zip(region_ids, results)
+        }
+
+    def extrapolate_count(self, region_id, target_cls, frag_type, doc_attr, omit=[]):
+        """Extrapolates counts for a region, weighting each intersecting region's data by
+        the share of that intersecting region which falls inside this one. See
+        Region.extrapolate_count.
+        """
+        return self.extrapolate_all(
+            [region_id], target_cls, frag_type, doc_attr, omit, method='count'
+        )[region_id]
+
+    def extrapolate_weighted_average(self, region_id, target_cls, frag_type, doc_attr,
+                                     omit=[]):
+        """Extrapolates averages for a region, weighting each intersecting region's data by
+        the share of this region which falls inside the intersecting one.
+        """
+        return self.extrapolate_all(
+            [region_id], target_cls, frag_type, doc_attr, omit, method='weighted_average'
+        )[region_id]
+
+    def write(self, doc_attr, region_ids_to_docs):
+        """Writes extrapolated embedded documents back to the database in one bulk write,
+        and updates the graph's copy of the data to match.
+        """
+        if not region_ids_to_docs:
+            return
+
+        ops = []
+        for region_id, doc in region_ids_to_docs.items():
+            doc.validate()
+            ops.append(
+                UpdateOne({'_id': region_id}, {'$set': {doc_attr: (son := doc.to_mongo())}})
+            )
+            self.data[region_id][doc_attr] = son.to_dict()
+
+        Region._get_collection().bulk_write(ops, ordered=False)
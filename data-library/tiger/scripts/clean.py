@@ -3,12 +3,15 @@
 This code is based almost entirely on open source code written by @jamesturk
 at OpenStates, which can be found here --> is.gd/1K0YAy
 """
+import os
 import re
-import geojson
+import json
+import time
 import zipfile
+import tempfile
 import subprocess
 from pathlib import Path
-from utils import print_cr
+from utils import print_cr, print_fail, run_with_pool, GeoJSONStream, WorkerPoolError
 from app.models import RegionType
 from app.config import DATA_RAW_PATH, DATA_CLEANED_PATH, TigerDataset
 from app.lookups.ccid import assemble_ccid
@@ -47,73 +50,106 @@ def render_district_type_and_shortcode(reg_type, props):
     return dist_type, shortcode
 
 
-def nitpick_geojson(file_path):
-    with open(file_path, 'r+') as geo_file:
-        geo = geojson.load(geo_file)
+def nitpick_feature(ftr):
+    """Enriches a feature's properties with the fields the TIGER loader expects"""
+    props = ftr['properties']
 
-        for ftr in geo['features']:
-            props = ftr['properties']
+    r_type = RegionType.fuzzy_cast(props[TK.TYPE_CODE])
 
-            r_type = RegionType.fuzzy_cast(props[TK.TYPE_CODE])
+    # make NAME field consistent across all region types
+    if 'NAMELSAD' in props.keys():
+        props[TK.NAME] = props['NAMELSAD']
+        del props['NAMELSAD']
 
-            # make NAME field consistent across all region types
-            if 'NAMELSAD' in props.keys():
-                props[TK.NAME] = props['NAMELSAD']
-                del props['NAMELSAD']
+    # build a CCID field for the region
+    props[TK.CCID] = assemble_ccid(r_type, props[TK.GEOID])
 
-            # build a CCID field for the region
-            props[TK.CCID] = assemble_ccid(
-                RegionType.fuzzy_cast(props[TK.TYPE_CODE]), props[TK.GEOID]
-            )
+    if r_type in (RegionType.CONGR, RegionType.SLDU, RegionType.SLDL):
+        # make district number field consistent across all district types
+        dist_num_key = list(
+            filter(lambda k: re.match(r'SLD[UL]ST|CD11\dFP', k), props.keys())
+        ).pop()
+        props[TK.DIST_NUM] = props[dist_num_key]
+        del props[dist_num_key]
 
-            if r_type in (RegionType.CONGR, RegionType.SLDU, RegionType.SLDL):
-                # make district number field consistent across all district types
-                dist_num_key = list(
-                    filter(lambda k: re.match(r'SLD[UL]ST|CD11\dFP', k), props.keys())
-                ).pop()
-                props[TK.DIST_NUM] = props[dist_num_key]
-                del props[dist_num_key]
+        # in SC, house district names seem to be malformed - where every other
+        # name just includes the number, SC house districts include a 'HD-' prefix
+        props[TK.NAME] = re.sub(r'HD-0*', '', props[TK.NAME])
 
-                # in SC, house district names seem to be malformed - where every other
-                # name just includes the number, SC house districts include a 'HD-' prefix
-                props[TK.NAME] = re.sub(r'HD-0*', '', props[TK.NAME])
+        dist_type, shortcode = render_district_type_and_shortcode(r_type, props)
+        props[TK.SHORTCODE] = shortcode
+        props[TK.DIST_TYPE] = dist_type
 
-                dist_type, shortcode = render_district_type_and_shortcode(r_type, props)
-                props[TK.SHORTCODE] = shortcode
-                props[TK.DIST_TYPE] = dist_type
+    return ftr
 
-        geo_file.seek(0)
-        geo_file.truncate()
-        geo_file.write(geojson.dumps(geo))
 
+def _write_collection_start(out, header):
+    out.write("{\n" + "".join(
+        f"{json.dumps(k)}: {json.dumps(v)},\n" for k, v in header.items()
+    ) + '"features": [\n')
+    return set(header)
 
-def clean(_):
-    TIGER_CLEAN_PATH.mkdir(exist_ok=True)
 
-    for raw_year in [yp for yp in TIGER_RAW_PATH.iterdir() if str(yp.name).isdigit()]:
-        (TIGER_CLEAN_PATH / raw_year.name).mkdir(exist_ok=True)
-        (TIGER_CLEAN_PATH / raw_year.name / 'sldu').mkdir(exist_ok=True)
-        (TIGER_CLEAN_PATH / raw_year.name / 'sldl').mkdir(exist_ok=True)
+def nitpick_geojson(src_path, dest_path=None):
+    """Streams the features of a geojson file through nitpick_feature, one at a time.
 
-        # make a working directory for intermediate files
-        (working_dir := raw_year / 'temp').mkdir(exist_ok=True)
+    The output is written to a temporary file beside dest_path (which defaults to
+    src_path), with one feature per line, and only renamed into place once it's complete -
+    so an interrupted run never leaves a partially written file behind.
+    """
+    dest_path = Path(dest_path or src_path)
+    temp_path = dest_path.with_name(f".{dest_path.name}.part")
+    features = GeoJSONStream(src_path)
 
-        for raw_zip in raw_year.glob(r'**/tl*.zip'):
-            # see if it already exists in clean, and continue if so
-            clean_geo = Path(
-                str(raw_zip).replace('/raw-data/', '/data/').replace('.zip', '.geojson')
-            )
-            if clean_geo.exists():
-                print_cr(f"{clean_geo.name} already cleaned, skipping!")
-                continue
+    try:
+        with open(temp_path, 'w') as out:
+            written = None  # the collection's members written before its features
+
+            for ftr in features:
+                if written is None:
+                    written = _write_collection_start(out, features.header)
+                else:
+                    out.write(",\n")
+
+                out.write(json.dumps(nitpick_feature(ftr)))
+
+            if written is None:  # the collection had no features
+                written = _write_collection_start(out, features.header)
+
+            out.write("\n]" + "".join(
+                f",\n{json.dumps(k)}: {json.dumps(v)}"
+                for k, v in features.header.items() if k not in written
+            ) + "\n}\n")
+
+        os.replace(temp_path, dest_path)
+    finally:
+        if temp_path.exists():
+            temp_path.unlink()
 
-            # unzip the zip file
-            with zipfile.ZipFile(raw_zip, "r") as f:
-                f.extractall(working_dir)
 
-            working_shp = working_dir / raw_zip.name.replace('.zip', '.shp')
+def clean_zip(paths):
+    """Converts a single TIGER shapefile zip into a cleaned geojson file.
 
-            print_cr(f"{working_shp} => {clean_geo}")
+    The zip is extracted and converted inside its own scratch directory, so that any
+    number of zips can be cleaned at once.
+
+    Returns:
+        float: the number of seconds it took to clean the zip.
+    """
+    raw_zip, clean_geo = paths
+    start = time.perf_counter()
+
+    with tempfile.TemporaryDirectory(
+        prefix=f"{raw_zip.stem}-", dir=raw_zip.parent
+    ) as scratch_dir:
+        # unzip the zip file
+        with zipfile.ZipFile(raw_zip, "r") as f:
+            f.extractall(scratch_dir)
+
+        working_shp = Path(scratch_dir) / raw_zip.name.replace('.zip', '.shp')
+        working_geo = Path(scratch_dir) / clean_geo.name
+
+        try:
             subprocess.run(  # create the GeoJSON file
                 [
                     "ogr2ogr",
@@ -123,14 +159,85 @@ def clean(_):
                     "crs:84",
                     "-f",
                     "GeoJSON",
-                    str(clean_geo),
+                    str(working_geo),
                     str(working_shp),
                 ],
                 check=True,
+                capture_output=True,
+                text=True,
+            )
+        except subprocess.CalledProcessError as e:
+            # ogr2ogr's output is captured, so its stderr is the only record of what failed
+            raise Exception(
+                f"TIGER Clean Error - ogr2ogr exited with status {e.returncode} converting "
+                f"{raw_zip.name}:\n{e.stderr.strip()}"
+            ) from e
+
+        # nitpick fields in the new geojson file, writing it out to clean
+        nitpick_geojson(working_geo, clean_geo)
+
+    return time.perf_counter() - start
+
+
+def report_clean_times(results, elapsed):
+    """Prints the time it took to clean each zip, slowest first, and any that failed."""
+    cleaned = [r for r in results if r.ok]
+
+    print("\n")
+    for r in sorted(cleaned, key=lambda r: r.result, reverse=True):
+        print(f"{r.result:8.1f}s  {r.item[1].relative_to(TIGER_CLEAN_PATH)}")
+    for r in results:
+        if not r.ok:
+            print_fail(f"FAILED  {r.item[1].relative_to(TIGER_CLEAN_PATH)}: {r.exception}")
+
+    print(
+        f"\nCleaned {len(cleaned)}/{len(results)} TIGER zips in {elapsed:.1f}s "
+        f"({sum(r.result for r in cleaned):.1f}s of work)"
+    )
+
+
+def clean(_, workers=None):
+    """Cleans every fetched TIGER shapefile zip that hasn't already been cleaned, with one
+    zip per worker process at a time.
+
+    Args:
+        workers (int, optional): the number of worker processes. Defaults to the CPU count.
+    """
+    TIGER_CLEAN_PATH.mkdir(exist_ok=True)
+    to_clean = []
+
+    for raw_year in [yp for yp in TIGER_RAW_PATH.iterdir() if str(yp.name).isdigit()]:
+        (TIGER_CLEAN_PATH / raw_year.name).mkdir(exist_ok=True)
+        (TIGER_CLEAN_PATH / raw_year.name / 'sldu').mkdir(exist_ok=True)
+        (TIGER_CLEAN_PATH / raw_year.name / 'sldl').mkdir(exist_ok=True)
+
+        for raw_zip in raw_year.glob(r'**/tl*.zip'):
+            # see if it already exists in clean, and continue if so
+            clean_geo = Path(
+                str(raw_zip).replace('/raw-data/', '/data/').replace('.zip', '.geojson')
             )
+            if clean_geo.exists():
+                print_cr(f"{clean_geo.name} already cleaned, skipping!")
+                continue
 
-            # nitpick fields in the new geojson file
-            nitpick_geojson(clean_geo)
+            to_clean.append((raw_zip, clean_geo))
 
-        # remove the temporary zip file from clean
-        subprocess.run(['rm', '-rf', str(working_dir)], check=True)
+    if not to_clean:
+        return
+
+    start = time.perf_counter()
+    results = []
+
+    try:
+        results = run_with_pool(
+            clean_zip,
+            to_clean,
+            update_callback=lambda n: print_cr(f"{n}/{len(to_clean)} TIGER zips cleaned"),
+            workers=workers,
+        )
+    except WorkerPoolError as e:
+        results = e.results
+        raise
+    finally:
+        # reported either way, so that a failed clean still shows the work that finished
+        report_clean_times(results, time.perf_counter() - start)
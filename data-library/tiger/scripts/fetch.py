@@ -4,9 +4,14 @@ This code is based almost entirely on open source code written by @jamesturk
 at OpenStates, which can be found here --> is.gd/AaD7iB
 """
 
+import os
+import re
 import us
+import json
+import threading
 import requests
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from app.config import DATA_RAW_PATH
 from utils import print_cr
 
@@ -19,85 +24,220 @@ YEARS_AND_CGR_SESSIONS = [
     (2015, 114),
 ]
 TIGER_RAW_PATH = Path(DATA_RAW_PATH % 'tiger')
-TIGER_BASE_URL = "https://www2.census.gov/geo/tiger/TIGER{year}/{region_type_uppercase}/tl_{year}_{parent_region_id}_{region_type}.zip"  # noqa: E501
+# can be pointed elsewhere (ie - at a mirror, or a local server) through the environment
+TIGER_BASE_URL = os.environ.get('TIGER_BASE_URL', "https://www2.census.gov/geo/tiger")
+TIGER_URL_PATH = "TIGER{year}/{region_type_uppercase}/tl_{year}_{parent_region_id}_{region_type}.zip"  # noqa: E501
+DEFAULT_FETCH_WORKERS = 8
+CHUNK_SIZE = 2 ** 20
 
+DOWNLOADED, RESUMED, SKIPPED = 'downloaded', 'resumed', 'skipped'
+# the Content-Range of a 416 (Range Not Satisfiable) response, ie - 'bytes */123456'
+UNSATISFIED_RANGE_PATTERN = re.compile(r'^bytes \*/(\d+)$')
 
-def get_zip_from_url(url, out_path):
-    response = requests.get(url)
+_local = threading.local()
+
+
+def get_session():
+    """Returns this thread's requests session, so connections are reused between files"""
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def get_tiger_url(base_url, **kwargs):
+    return f"{base_url.rstrip('/')}/{TIGER_URL_PATH.format(**kwargs)}"
+
+
+def read_sidecar(out_path):
+    """Returns the ETag and size recorded when out_path was downloaded, if any"""
+    try:
+        with open(out_path.with_name(f"{out_path.name}.etag"), 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def write_sidecar(out_path, etag, size):
+    with open(out_path.with_name(f"{out_path.name}.etag"), 'w') as f:
+        json.dump({'etag': etag, 'size': size}, f)
+
+
+def is_up_to_date(out_path, response):
+    """Whether a downloaded file matches the ETag (or failing that, the size) of the
+    remote file, as given by the headers of a HEAD response.
+    """
+    sidecar = read_sidecar(out_path)
+
+    if (etag := response.headers.get('ETag')) and sidecar.get('etag'):
+        return etag == sidecar['etag']
+
+    size = response.headers.get('Content-Length')
+    return size is not None and int(size) == out_path.stat().st_size
 
-    if response.status_code == 200:
-        with open(out_path, 'wb') as f:
-            f.write(response.content)
+
+def is_part_complete(session, url, part_path, response, sidecar):
+    """Whether a 416 (Range Not Satisfiable) response to resuming part_path means that it
+    already holds the whole remote file, rather than that the server refused the range
+    for some other reason.
+
+    The size of the remote file is read from the response's Content-Range, or failing
+    that from a HEAD request - whose ETag must also match the one part_path was started
+    with, if both are known.
+    """
+    remote_etag = response.headers.get('ETag')
+
+    if match := UNSATISFIED_RANGE_PATTERN.match(response.headers.get('Content-Range', '')):
+        size = int(match[1])
     else:
-        response.raise_for_status()
+        head = session.head(url, allow_redirects=True)
+        head.raise_for_status()
+        size = int(head.headers['Content-Length']) if 'Content-Length' in head.headers else None
+        remote_etag = head.headers.get('ETag') or remote_etag
 
+    if remote_etag and sidecar.get('etag') and remote_etag != sidecar['etag']:
+        return False
 
-def fetch():
+    return size is not None and size == part_path.stat().st_size
 
-    TIGER_RAW_PATH.mkdir(exist_ok=True)
 
-    for year, cgr_session_num in YEARS_AND_CGR_SESSIONS:
-        print(f"-/-/---- Fetching TIGER shapes for {year} ----/-/-")
+def get_zip_from_url(url, out_path):
+    """Streams a file to a .part file beside out_path, which is renamed once complete.
+
+    An existing .part file is resumed with an HTTP Range request (guarded by If-Range, so
+    that a file that changed remotely is downloaded from scratch), and an existing
+    out_path is skipped if it matches the remote file's ETag or size. A .part file the
+    server won't resume is only kept if it's known to be complete, and is otherwise
+    downloaded again from scratch.
+
+    Returns:
+        str: whether the file was downloaded, resumed or skipped.
+    """
+    session = get_session()
+    part_path = out_path.with_name(f"{out_path.name}.part")
+    sidecar = read_sidecar(out_path)
+
+    if out_path.exists():
+        head = session.head(url, allow_redirects=True)
+        head.raise_for_status()
+        if is_up_to_date(out_path, head):
+            return SKIPPED
+
+    headers, restart = {}, False
+    if part_path.exists() and (offset := part_path.stat().st_size):
+        headers['Range'] = f"bytes={offset}-"
+        if sidecar.get('etag'):
+            headers['If-Range'] = sidecar['etag']
+
+    with session.get(url, headers=headers, stream=True) as response:
+        if response.status_code == 416:
+            restart = not is_part_complete(session, url, part_path, response, sidecar)
+            status, etag = RESUMED, sidecar.get('etag')
+        else:
+            response.raise_for_status()
+
+            # only a 206 means the server honored the range - anything else is the whole file
+            status = RESUMED if response.status_code == 206 else DOWNLOADED
+            etag = response.headers.get('ETag') or (
+                sidecar.get('etag') if status == RESUMED else None
+            )
+
+            # record the ETag up front, so that an interrupted download can be resumed
+            write_sidecar(out_path, etag, None)
+
+            with open(part_path, 'ab' if status == RESUMED else 'wb') as f:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
+
+    if restart:  # the range was refused, and the .part file isn't the whole remote file
+        part_path.unlink()
+        return get_zip_from_url(url, out_path)
+
+    os.replace(part_path, out_path)
+    write_sidecar(out_path, etag, out_path.stat().st_size)
 
+    return status
+
+
+def get_tiger_downloads(base_url):
+    """Lists the (url, path) of every zip file that makes up the TIGER dataset"""
+    downloads = []
+
+    for year, cgr_session_num in YEARS_AND_CGR_SESSIONS:
         year_path = TIGER_RAW_PATH / Path(str(year))
-        year_path.mkdir(exist_ok=True)
 
-        print_cr("\tHandling state and county shapes")
         for region_type in ['state', 'county']:
-            url = TIGER_BASE_URL.format(
+            url = get_tiger_url(
+                base_url,
                 year=year,
                 region_type_uppercase=region_type.upper(),
                 parent_region_id='us',
                 region_type=region_type,
             )
+            downloads.append((url, year_path / f"tl_{year}_us_{region_type}.zip"))
 
-            # if the .zip file already exists, skip download
-            if (year_path / url.split('/')[-1]).exists():
-                print_cr(f"\tSkipping {region_type} shapes for {year}, already downloaded!")
-                continue
-
-            get_zip_from_url(url, year_path / f"tl_{year}_us_{region_type}.zip")
-
-        print_cr("\tHandling congressional district shapes")
-        cd_url = TIGER_BASE_URL.format(
+        cd_url = get_tiger_url(
+            base_url,
             year=year,
             region_type_uppercase="CD",
             parent_region_id='us',
             region_type=f"cd{cgr_session_num}"
         )
-        # if the .zip file already exists, skip download
-        if (year_path / cd_url.split('/')[-1]).exists():
-            print_cr(f"\tSkipping {region_type} shapes for {year}, already downloaded!")
-        else:
-            get_zip_from_url(cd_url, year_path / f"tl_{year}_us_cd{cgr_session_num}.zip")
+        downloads.append((cd_url, year_path / f"tl_{year}_us_cd{cgr_session_num}.zip"))
 
         for state in us.STATES + [us.states.PR]:
-
-            print_cr(f"\tHandling SLD shapes in {state.abbr}")
-
-            sldu_path = year_path / Path('sldu')
-            sldu_path.mkdir(exist_ok=True)
-
-            sldl_path = year_path / Path('sldl')
-            sldl_path.mkdir(exist_ok=True)
-
-            for chamber, chamber_path in [('l', sldl_path), ('u', sldu_path)]:
+            for chamber, chamber_path in [('l', year_path / 'sldl'), ('u', year_path / 'sldu')]:
 
                 # DC and NE are unicameral, and therefore have no lower chamber
                 if state.abbr in ('DC', 'NE') and chamber == 'l':
                     continue
 
-                if (chamber_path / f"tl_{year}_{state.fips}_sld{chamber}.zip").exists():
-                    print(f"\tSkipping shapes for {state.abbr}, already downloaded!", end="\r")
-                    continue
-
-                url = TIGER_BASE_URL.format(
+                url = get_tiger_url(
+                    base_url,
                     year=year,
                     region_type_uppercase=chamber_path.name.upper(),
                     parent_region_id=state.fips,
                     region_type=chamber_path.name,
                 )
+                downloads.append(
+                    (url, chamber_path / f"tl_{year}_{state.fips}_sld{chamber}.zip")
+                )
+
+    return downloads
+
+
+def fetch(base_url=TIGER_BASE_URL, workers=DEFAULT_FETCH_WORKERS):
+    """Downloads every TIGER zip file, with at most workers downloads at once.
+
+    A failed download doesn't stop the others - they're all reported (and raised) once
+    every download has finished, and rerunning fetch resumes them.
+    """
+    downloads = get_tiger_downloads(base_url)
+
+    TIGER_RAW_PATH.mkdir(exist_ok=True)
+    for path in {out_path.parent for _, out_path in downloads}:
+        path.mkdir(parents=True, exist_ok=True)
 
-                get_zip_from_url(url, chamber_path / f"tl_{year}_{state.fips}_sld{chamber}.zip")
+    print(f"-/-/---- Fetching {len(downloads)} TIGER files ----/-/-")
+    counts = {DOWNLOADED: 0, RESUMED: 0, SKIPPED: 0}
+    failures = []
 
-        print('\n')
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(get_zip_from_url, *d): d for d in downloads}
+
+        for i, future in enumerate(as_completed(futures)):
+            url, out_path = futures[future]
+
+            if (e := future.exception()) is not None:
+                failures.append((url, e))
+            else:
+                counts[future.result()] += 1
+
+            print_cr(f"\t{i + 1}/{len(downloads)} handled, latest: {out_path.name}")
+
+    print(f"\n\t{', '.join(f'{n} {status}' for status, n in counts.items())}")
+
+    if failures:
+        raise Exception(
+            f"TIGER Fetch Error - {len(failures)} downloads failed, and can be resumed by "
+            "fetching again:\n\t" + "\n\t".join(f"{url}: {e!r}" for url, e in failures)
+        )
@@ -1,5 +1,8 @@
 import us
+import atexit
+import inspect
 import argparse
+from datetime import datetime
 from haikunator import Haikunator
 from importlib import import_module
 from app.config import (
@@ -9,21 +12,84 @@ from app.config import (
     CLI_FETCH_CLEAN_ENTRY_NAMES,
     STATE_ABBR_TO_FIPS,
     ALL_STATES,
+    PRODUCTION_RETENTION,
+    PROFILES_DIR,
+    QUERY_CENSUS_THRESHOLD,
 )
 from app import ClimateCabinetDBManager as CCDB
+from utils.profiling import PROFILE_MODES
+from utils import (
+    start_tracing, finish_tracing, start_profiling, stop_profiling, start_census,
+    start_counting_bytes, print_warning,
+)
 
 
 def get_parsed_args():
     """Determines the subcommand and parses CLI arguments"""
     meta_parser = argparse.ArgumentParser()
 
+    # arguments shared by every subcommand
+    common_parser = argparse.ArgumentParser(add_help=False)
+    common_parser.add_argument(
+        "--profile",
+        choices=PROFILE_MODES,
+        help=(
+            "if given, the run (and each of its worker processes) is profiled - with"
+            " cProfile (.pstats files), or a sampling profiler (.collapsed stacks, ready"
+            " for a flamegraph). Profiles are written to a new directory in PROFILES_DIR."
+        ),
+    )
+
+    # arguments shared by every subcommand that runs build stages
+    build_parser = argparse.ArgumentParser(add_help=False)
+    build_parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        help=(
+            "the number of worker processes to build with; defaults to the number of CPUs."
+            " If 1, every stage is run serially in the main process."
+        ),
+    )
+    build_parser.add_argument(
+        "--trace",
+        help=(
+            "if given, a timeline of the run (across every worker process) is written to"
+            " this path, in the Chrome trace-event format - open it in Perfetto or"
+            " about:tracing."
+        ),
+    )
+    build_parser.add_argument(
+        "--query-census",
+        nargs="?",
+        type=int,
+        const=QUERY_CENSUS_THRESHOLD,
+        metavar="N",
+        help=(
+            "if present, every query is fingerprinted and counted by stage and state, and"
+            " those sent more than N times by a stage for one state (default"
+            f" {QUERY_CENSUS_THRESHOLD}) are reported and explained as likely N+1s."
+        ),
+    )
+    build_parser.add_argument(
+        "--count-bytes",
+        action="store_true",
+        help=(
+            "if present, the bytes sent to and received from MongoDB are added to the"
+            " build's metrics. Each command and reply is encoded again to measure it, so"
+            " it's off by default."
+        ),
+    )
+
     subs_desc = "the permitted operations performable through the run.py script"
     subparsers = meta_parser.add_subparsers(
         title='subcommand', dest="operation", description=subs_desc
     )
 
     # setup parser for building a new database
-    new_db_parser = subparsers.add_parser('new-db', help='Builds a new database')
+    new_db_parser = subparsers.add_parser(
+        'new-db', help='Builds a new database', parents=[common_parser, build_parser]
+    )
     new_db_parser.add_argument(
         "--target",
         '-t',
@@ -62,10 +128,82 @@ def get_parsed_args():
         nargs="*",
         help="the datasets to refresh data from",
     )
+    new_db_parser.add_argument(
+        "--promote",
+        "-p",
+        action="store_true",
+        help=(
+            "if present, the database is validated and promoted to production once it's"
+            " built, as opposed to being left staged."
+        ),
+    )
+
+    # setup parser for resuming a failed database build
+    resume_parser = subparsers.add_parser(
+        'resume', help='Resumes a failed database build from its incomplete units',
+        parents=[common_parser, build_parser],
+    )
+    resume_parser.add_argument(
+        "--database",
+        '-db',
+        help="the name of the Atlas database whose build should be resumed",
+        required=True,
+    )
+    resume_parser.add_argument(
+        "--local",
+        "-l",
+        action="store_true",
+        help=(
+            "if present, a connection is made with a database running on localhost, as"
+            " opposed to the cloud prodcution database."
+        ),
+    )
+
+    # setup parser for promoting a staged database to production
+    promote_parser = subparsers.add_parser(
+        'promote', help='Validates a staged database and promotes it to production',
+        parents=[common_parser],
+    )
+    promote_parser.add_argument(
+        "--database",
+        '-db',
+        help="the name of the staged database to promote",
+        required=True,
+    )
+    promote_parser.add_argument(
+        "--target",
+        '-t',
+        action="store_true",
+        help=(
+            "if present, a database without a build plan is validated against only the"
+            " states present in the global list TARGET_STATES (found in config.py). Otherwise,"
+            " it's validated against the states it was built with."
+        ),
+    )
+    promote_parser.add_argument(
+        "--local",
+        "-l",
+        action="store_true",
+        help=(
+            "if present, a connection is made with a database running on localhost, as"
+            " opposed to the cloud prodcution database."
+        ),
+    )
+    promote_parser.add_argument(
+        "--retain",
+        "-r",
+        type=int,
+        default=PRODUCTION_RETENTION,
+        help=(
+            "the number of retired production databases to keep after promoting; older"
+            f" ones are dropped. Defaults to {PRODUCTION_RETENTION}."
+        ),
+    )
 
     # setup parser for rebuilding a specific dataset
     refresh_parser = subparsers.add_parser(
-        'refresh', help='Refreshes the data from a list of specific datasets'
+        'refresh', help='Refreshes the data from a list of specific datasets',
+        parents=[common_parser, build_parser],
     )
     refresh_parser.add_argument(
         "datasets",
@@ -107,16 +245,39 @@ def get_parsed_args():
         help="the name of the Atlas database to connect to",
         required=True,
     )
+    refresh_parser.add_argument(
+        "--full",
+        "-f",
+        action="store_true",
+        help=(
+            "if present, every state is reloaded, as opposed to only those whose cleaned"
+            " data has changed since the database was last built or refreshed."
+        ),
+    )
 
     # setup parser for running data fetching scripts (scraping/ downloading external data)
     fetch_parser = subparsers.add_parser(
-        'fetch', help='Runs a data-library\'s fetching script.'
+        'fetch', help='Runs a data-library\'s fetching script.',
+        parents=[common_parser],
     )
     fetch_parser.add_argument("dataset", choices=CLI_FETCH_CLEAN_ENTRY_NAMES)
 
+    # arguments shared by every subcommand that runs a cleaning script
+    cleaning_parser = argparse.ArgumentParser(add_help=False)
+    cleaning_parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        help=(
+            "the number of worker processes to clean with, for datasets whose cleaning"
+            " script supports it; defaults to the number of CPUs."
+        ),
+    )
+
     # setup parser for running data cleaning scripts (raw-data --> data ready for db consumption)
     clean_parser = subparsers.add_parser(
-        'clean', help='Runs a data-library\'s cleaning script.'
+        'clean', help='Runs a data-library\'s cleaning script.',
+        parents=[common_parser, cleaning_parser],
     )
     clean_parser.add_argument("dataset", choices=CLI_FETCH_CLEAN_ENTRY_NAMES)
     clean_parser.add_argument(
@@ -127,10 +288,10 @@ def get_parsed_args():
         default=[],
         help="the state(s) to clean data for",
     )
-
     flean_parser = subparsers.add_parser(
         'flean',
         help="Runs a data-library's fetching and cleaning scripts, in that order.",
+        parents=[common_parser, cleaning_parser],
     )
     flean_parser.add_argument('dataset', choices=CLI_FETCH_CLEAN_ENTRY_NAMES)
     flean_parser.add_argument(
@@ -141,16 +302,25 @@ def get_parsed_args():
         default=[],
         help="the state(s) to fetch and clean data for",
     )
-
     # setup parser for running helper functions
     util_parser = subparsers.add_parser(
-        'helper', help='Runs a script from the helpers directory.'
+        'helper', help='Runs a script from the helpers directory.',
+        parents=[common_parser],
     )
     util_parser.add_argument("func")
 
     return meta_parser.parse_known_args()
 
 
+def write_trace(path):
+    print(f"\nWrote {finish_tracing(path)} trace events to {path}")
+
+
+def write_profiles():
+    profiles = stop_profiling()
+    print(f"\nWrote {len(profiles)} profiles to {profiles[0].parent if profiles else '-'}")
+
+
 def parse_unknown_args(unknowns):
     kwds = {}
     flags = list(filter(lambda arg: arg.find("--") > -1, unknowns))
@@ -176,18 +346,61 @@ def parse_unknown_args(unknowns):
 if __name__ == '__main__':
     args, unknown = get_parsed_args()
 
+    if getattr(args, 'trace', None):
+        start_tracing()
+        # written on exit, so that failed runs (the ones most worth a look) are traced too
+        atexit.register(write_trace, args.trace)
+
+    if getattr(args, 'profile', None):
+        start_profiling(
+            args.profile,
+            PROFILES_DIR / f"{args.operation}-{datetime.now():%Y%m%d-%H%M%S}-{args.profile}",
+        )
+        atexit.register(write_profiles)
+
+    if getattr(args, 'query_census', None) is not None:
+        start_census(args.query_census)
+
+    if getattr(args, 'count_bytes', None):
+        start_counting_bytes()
+
     if args.operation == 'new-db':
         db_name = (
             args.database if args.database else Haikunator().haikunate(token_length=0)
         )
         with CCDB(BUILD_USER, db_name=db_name, local=args.local) as db:
-            db.build(datasets=args.datasets, targets_only=args.target, slim=args.slim)
+            db.build(
+                datasets=args.datasets,
+                targets_only=args.target,
+                slim=args.slim,
+                workers=args.workers,
+            )
+            if args.promote:
+                db.promote(targets_only=args.target)
+
+    elif args.operation == 'resume':
+        with CCDB(
+            BUILD_USER, db_name=args.database, ensure_db=True, local=args.local
+        ) as db:
+            db.resume(workers=args.workers)
+
+    elif args.operation == 'promote':
+        with CCDB(
+            BUILD_USER, db_name=args.database, ensure_db=True, local=args.local
+        ) as db:
+            db.promote(targets_only=args.target, retention=args.retain)
 
     elif args.operation == 'refresh':
         with CCDB(
             BUILD_USER, db_name=args.database, ensure_db=True, local=args.local
         ) as db:
-            db.refresh(datasets=args.datasets, targets_only=args.target, slim=args.slim)
+            db.refresh(
+                datasets=args.datasets,
+                targets_only=args.target,
+                slim=args.slim,
+                workers=args.workers,
+                full=args.full,
+            )
 
     elif args.operation in ('fetch', 'clean', 'flean'):
         data_scripts = import_module(f'data-library.{args.dataset}.scripts')
@@ -201,7 +414,17 @@ if __name__ == '__main__':
             ]
             target_states = [s for state in targets_raw for s in state]
 
-            data_scripts.clean(target_states)
+            kwargs = {}
+            if args.workers:
+                if 'workers' in inspect.signature(data_scripts.clean).parameters:
+                    kwargs['workers'] = args.workers
+                else:
+                    print_warning(
+                        f"The {args.dataset} cleaning script doesn't run in parallel, so"
+                        " --workers is ignored."
+                    )
+
+            data_scripts.clean(target_states, **kwargs)
 
     elif args.operation == 'helper':
         helper_args, kwds = parse_unknown_args(unknown)
@@ -0,0 +1,61 @@
+"""Bounds the number of queries the loaders send, against a MongoDB running on localhost.
+
+The query census only counts the commands pymongo reports through its monitoring events, so
+these tests need a real server - they're skipped if there isn't one.
+"""
+import pandas as pd
+import pytest
+from mongoengine import connect, disconnect, get_connection
+from pymongo.errors import ServerSelectionTimeoutError
+from utils import register_census_listener, assert_max_queries
+from app.models import Region
+from app.build.daily_kos import refresh_state_fragments, OWNER_CCID, SOURCE_CCID, POP, PERC
+
+TEST_DB = 'ccdb-test-query-bounds'
+
+
+@pytest.fixture
+def db():
+    register_census_listener(force=True)  # before connecting, so the client reports to it
+    connect(host=f"mongodb://127.0.0.1:27017/{TEST_DB}", serverSelectionTimeoutMS=500)
+
+    try:
+        get_connection().server_info()
+    except ServerSelectionTimeoutError:
+        disconnect()
+        pytest.skip("no MongoDB server running on localhost")
+
+    get_connection().drop_database(TEST_DB)
+    yield
+    get_connection().drop_database(TEST_DB)
+    disconnect()
+
+
+def insert_counties(ccids, **fields):
+    Region._get_collection().insert_many([
+        {
+            '_cls': 'Region.County', 'ccid': ccid, 'geoid': ccid, 'state_fips': '50',
+            'state_abbr': 'VT', 'name': ccid, **fields,
+        }
+        for ccid in ccids
+    ])
+
+
+def test_refresh_state_fragments_is_two_queries(db):
+    owners = [f"50{i:03d}" for i in range(1, 40, 2)]
+    sources = [f"50{i:03d}" for i in range(41, 80, 2)]
+    insert_counties(owners + sources)
+    insert_counties(['50099'], fragments=[{'population': 1, 'perc_of_whole': 1.0}])
+
+    fragments = pd.DataFrame([
+        {OWNER_CCID: owner, SOURCE_CCID: source, POP: 10, PERC: 0.5}
+        for owner in owners
+        for source in sources[:2]
+    ])
+
+    # one find resolving every CCID, then one bulk write - however many regions there are
+    with assert_max_queries(2):
+        refresh_state_fragments('VT', fragments)
+
+    assert Region.objects(fragments__size=2).count() == len(owners)
+    assert Region.objects(ccid='50099', fragments__exists=True).count() == 0
@@ -0,0 +1,128 @@
+"""Tests for the TIGER fetch script's resumable downloads, against a local HTTP server."""
+import os
+import hashlib
+import threading
+from importlib import import_module
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+
+fetch = import_module('data-library.tiger.scripts.fetch')
+
+PAYLOAD = os.urandom(3 * fetch.CHUNK_SIZE + 17)
+ETAG = f'"{hashlib.md5(PAYLOAD).hexdigest()}"'
+
+
+class TigerHandler(BaseHTTPRequestHandler):
+    """Serves PAYLOAD at every path, honoring Range and If-Range like the Census server.
+
+    If the server's refuse_ranges attribute is set, every Range is refused with a 416 -
+    whether or not it's actually past the end of the file.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, with_body):
+        self.server.requests.append((self.command, self.headers.get('Range')))
+        start = 0
+
+        if (range_ := self.headers.get('Range')) and self.headers.get('If-Range', ETAG) == ETAG:
+            start = int(range_.split('=')[1].rstrip('-'))
+
+            if self.server.refuse_ranges or start >= len(PAYLOAD):
+                self.send_response(416)
+                self.send_header('Content-Range', f"bytes */{len(PAYLOAD)}")
+                self.end_headers()
+                return
+
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{len(PAYLOAD) - 1}/{len(PAYLOAD)}")
+        else:
+            self.send_response(200)
+
+        self.send_header('ETag', ETAG)
+        self.send_header('Content-Length', str(len(PAYLOAD) - start))
+        self.end_headers()
+
+        if with_body:
+            self.wfile.write(PAYLOAD[start:])
+
+    def do_HEAD(self):
+        self._respond(with_body=False)
+
+    def do_GET(self):
+        self._respond(with_body=True)
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), TigerHandler)
+    server.requests, server.refuse_ranges = [], False
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def url(server):
+    return f"http://127.0.0.1:{server.server_port}/TIGER2020/SLDU/tl_2020_50_sldu.zip"
+
+
+@pytest.fixture
+def out_path(tmp_path):
+    return tmp_path / 'tl_2020_50_sldu.zip'
+
+
+def get_part_path(out_path):
+    return out_path.with_name(f"{out_path.name}.part")
+
+
+def test_fresh_download(server, url, out_path):
+    assert fetch.get_zip_from_url(url, out_path) == fetch.DOWNLOADED
+
+    assert out_path.read_bytes() == PAYLOAD
+    assert not get_part_path(out_path).exists()
+    assert fetch.read_sidecar(out_path) == {'etag': ETAG, 'size': len(PAYLOAD)}
+    assert server.requests == [('GET', None)]
+
+
+def test_resume_partial_download(server, url, out_path):
+    get_part_path(out_path).write_bytes(PAYLOAD[:1000])
+    fetch.write_sidecar(out_path, ETAG, None)
+
+    assert fetch.get_zip_from_url(url, out_path) == fetch.RESUMED
+
+    assert out_path.read_bytes() == PAYLOAD
+    assert server.requests == [('GET', 'bytes=1000-')]
+
+
+def test_skip_on_etag_match(server, url, out_path):
+    fetch.get_zip_from_url(url, out_path)
+    server.requests.clear()
+
+    assert fetch.get_zip_from_url(url, out_path) == fetch.SKIPPED
+    assert server.requests == [('HEAD', None)]
+
+
+def test_complete_part_is_promoted_on_416(server, url, out_path):
+    get_part_path(out_path).write_bytes(PAYLOAD)
+    fetch.write_sidecar(out_path, ETAG, None)
+
+    assert fetch.get_zip_from_url(url, out_path) == fetch.RESUMED
+
+    assert out_path.read_bytes() == PAYLOAD
+    assert server.requests == [('GET', f"bytes={len(PAYLOAD)}-")]
+
+
+def test_truncated_part_is_downloaded_again_on_416(server, url, out_path):
+    server.refuse_ranges = True
+    get_part_path(out_path).write_bytes(PAYLOAD[:1000])
+    fetch.write_sidecar(out_path, ETAG, None)
+
+    assert fetch.get_zip_from_url(url, out_path) == fetch.DOWNLOADED
+
+    assert out_path.read_bytes() == PAYLOAD
+    assert server.requests == [('GET', 'bytes=1000-'), ('GET', None)]
@@ -2,6 +2,11 @@ from .bot import *
 from .multiprocessing import *
 from .command_line import *
 from .regex import *
+from .geojson_stream import *
+from .metrics import *
+from .tracing import *
+from .profiling import *
+from .query_census import *
 
 __all__ = (
     # bot.py
@@ -9,6 +14,10 @@ __all__ = (
     get_sheets_bot_client,
     save_file,
     # multiprocessing.py
+    WorkerPool,
+    WorkResult,
+    WorkerPoolError,
+    connect_worker,
     run_with_pool,
     # command_line.py
     get_user_choices,
@@ -20,5 +29,39 @@ __all__ = (
     update_halo_base,
     update_halo_scroll,
     # regex.py
-    find_first_from_regex
+    find_first_from_regex,
+    # geojson_stream.py
+    GeoJSONStream,
+    # metrics.py
+    UnitMetrics,
+    MongoMetricsListener,
+    counting_bytes,
+    start_counting_bytes,
+    register_metrics_listener,
+    count_rows,
+    measure,
+    MetricsReport,
+    # tracing.py
+    span,
+    traced,
+    TraceListener,
+    register_trace_listener,
+    start_tracing,
+    finish_tracing,
+    merge_traces,
+    # profiling.py
+    StackSampler,
+    profile_process,
+    start_profiling,
+    stop_profiling,
+    # query_census.py
+    QueryCensus,
+    CensusListener,
+    fingerprint,
+    census_enabled,
+    register_census_listener,
+    census_scope,
+    assert_max_queries,
+    start_census,
+    finish_census,
 )
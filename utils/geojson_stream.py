@@ -0,0 +1,165 @@
+import re
+import json
+
+WHITESPACE = re.compile(r'\s*')
+# a run of characters that can only belong to (nested) arrays of numbers, ie - coordinates
+NUMERIC_RUN = re.compile(r'[\[\],\s\d.eE+\-]+')
+DECODER = json.JSONDecoder()
+
+
+class _Incomplete(Exception):
+    """Raised while parsing when the buffer ends before the value being parsed does."""
+
+
+class GeoJSONStream:
+    """Iterates over the features of a GeoJSON FeatureCollection file one at a time, without
+    loading the entire collection into memory.
+
+    The file is read in chunks, and each feature is decoded from the buffer as soon as it's
+    complete. A feature's members are decoded in the order they appear in the file, so if
+    its properties come before its geometry (as they do in ogr2ogr's output), a skip
+    predicate can reject the feature before the geometry's coordinates are ever decoded.
+
+    The collection's other top-level members (ie - 'type', 'name' and 'crs') are kept in
+    the header attribute as they're reached.
+
+    Args:
+        path (str or Path): the path of the GeoJSON file.
+        skip (callable, optional): called with each feature's properties - features for
+            which it returns True aren't yielded.
+        chunk_size (int, optional): the number of characters read from the file at once.
+    """
+
+    def __init__(self, path, skip=None, chunk_size=2 ** 20):
+        self.path = path
+        self.skip = skip
+        self.chunk_size = chunk_size
+        self.header = {}
+        self.skipped = 0
+
+    def __iter__(self):
+        self.header, self.skipped = {}, 0
+
+        with open(self.path, 'r') as self._file:
+            self._buf, self._pos, self._eof = '', 0, False
+            yield from self._read_collection()
+
+    def _read_more(self):
+        # drop whatever has already been consumed before growing the buffer
+        self._buf, self._pos = self._buf[self._pos:], 0
+
+        chunk = self._file.read(max(self.chunk_size, len(self._buf)))
+        self._eof = not chunk
+        self._buf += chunk
+
+    def _parse(self, func):
+        """Parses from the current position with func, reading more of the file (and
+        retrying) whenever the buffer ends first. Returns func's result, and advances the
+        current position past the parsed text.
+        """
+        while True:
+            try:
+                result, self._pos = func(self._pos)
+                return result
+            except (_Incomplete, json.JSONDecodeError) as e:
+                if self._eof:
+                    raise ValueError(
+                        f"GeoJSON Stream Error - unable to parse '{self.path}' as a "
+                        "FeatureCollection"
+                    ) from e
+                self._read_more()
+
+    def _skip_ws(self, i):
+        if (i := WHITESPACE.match(self._buf, i).end()) >= len(self._buf):
+            raise _Incomplete
+        return i
+
+    def _expect(self, i, chars):
+        i = self._skip_ws(i)
+        if self._buf[i] not in chars:
+            raise json.JSONDecodeError(f"Expecting one of '{chars}'", self._buf, i)
+        return self._buf[i], i + 1
+
+    def _peek(self, i):
+        i = self._skip_ws(i)
+        return self._buf[i], i
+
+    def _decode(self, i):
+        value, i = DECODER.raw_decode(self._buf, self._skip_ws(i))
+        # a value is only known to be complete once whatever follows it is in the buffer
+        return value, self._skip_ws(i)
+
+    def _skip_value(self, i):
+        """Finds the end of a value without decoding it, if it's cheap to do so."""
+        i = self._skip_ws(i)
+
+        if self._buf[i] == '{':
+            c, i = self._expect(i + 1, '"}')
+            while c != '}':
+                _, i = self._decode(i - 1)
+                _, i = self._expect(i, ':')
+                i = self._skip_value(i)
+                c, i = self._expect(i, ',}')
+                if c == ',':
+                    _, i = self._expect(i, '"')
+            return self._skip_ws(i)
+
+        if self._buf[i] == '[' and (run := NUMERIC_RUN.match(self._buf, i)):
+            text = run.group()
+            if run.end() < len(self._buf) and text.count('[') == text.count(']'):
+                return self._skip_ws(i + text.rindex(']') + 1)
+
+        return self._decode(i)[1]
+
+    def _read_member_key(self, i):
+        key, i = self._decode(i)
+        _, i = self._expect(i, ':')
+        return key, i
+
+    def _read_feature(self, i):
+        _, i = self._expect(i, '{')
+        feature, skipping = {}, False
+
+        c, i = self._expect(i, '"}')
+        while c != '}':
+            key, i = self._read_member_key(i - 1)
+
+            if key == 'geometry' and skipping:
+                i = self._skip_value(i)
+            else:
+                feature[key], i = self._decode(i)
+
+            if key == 'properties' and self.skip and self.skip(feature[key]):
+                skipping = True
+
+            c, i = self._expect(i, ',}')
+            if c == ',':
+                _, i = self._expect(i, '"')
+
+        return (None if skipping else feature), i
+
+    def _read_collection(self):
+        self._parse(lambda i: self._expect(i, '{'))
+        c = self._parse(lambda i: self._expect(i, '"}'))
+
+        while c != '}':
+            self._pos -= 1  # step back onto the key's opening quote
+            key = self._parse(self._read_member_key)
+
+            if key != 'features':
+                self.header[key] = self._parse(self._decode)
+            else:
+                self._parse(lambda i: self._expect(i, '['))
+                if (c := self._parse(self._peek)) == ']':
+                    self._parse(lambda i: self._expect(i, ']'))
+
+                while c != ']':
+                    if (feature := self._parse(self._read_feature)) is None:
+                        self.skipped += 1
+                    else:
+                        yield feature
+                    c = self._parse(lambda i: self._expect(i, ',]'))
+
+            c = self._parse(lambda i: self._expect(i, ',}'))
+            if c == ',':
+                self._parse(lambda i: self._expect(i, '"'))
@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import bson
+from pymongo import monitoring
+
+# set by start_counting_bytes - worker processes inherit it through the environment
+COUNT_BYTES_ENV = 'CCDB_METRICS_COUNT_BYTES'
+WRITE_COMMANDS = {'insert', 'update', 'delete', 'findAndModify'}
+READ_COMMANDS = {'find', 'getMore', 'aggregate'}
+
+_active = []
+
+
+class UnitMetrics:
+    """The resources used while measuring a single unit of work (ie - one build stage for one
+    state), as recorded by measure(), MongoMetricsListener and count_rows().
+    """
+
+    FIELDS = (
+        'wall_s', 'cpu_s', 'rows_read', 'docs_written', 'docs_read', 'round_trips', 'mongo_s',
+    )
+    # only counted (and reported) if counting_bytes()
+    BYTE_FIELDS = ('bytes_sent', 'bytes_received')
+
+    def __init__(self, **labels):
+        self.labels = labels
+        for field in self.FIELDS + self.BYTE_FIELDS:
+            setattr(self, field, 0)
+
+    @classmethod
+    def fields(cls):
+        """Returns the fields being recorded, ie - FIELDS, and BYTE_FIELDS if counted."""
+        return cls.FIELDS + (cls.BYTE_FIELDS if counting_bytes() else ())
+
+    def as_dict(self):
+        return {
+            **self.labels,
+            **{field: round(getattr(self, field), 3) for field in self.fields()},
+        }
+
+    def __repr__(self):
+        return f"<UnitMetrics({', '.join(f'{k}={v!r}' for k, v in self.as_dict().items())})>"
+
+
+class MongoMetricsListener(monitoring.CommandListener):
+    """Counts the round trips, time and documents of every command sent to MongoDB while a
+    unit is being measured.
+
+    Args:
+        count_bytes (bool, optional): if True, the BSON sizes of every command and reply
+            are counted too. Each one is encoded again to measure it, so it's off by default.
+    """
+
+    def __init__(self, count_bytes=False):
+        self.count_bytes = count_bytes
+
+    def started(self, event):
+        if _active:
+            _active[-1].round_trips += 1
+            if self.count_bytes:
+                _active[-1].bytes_sent += len(bson.encode(event.command))
+
+    def succeeded(self, event):
+        if not _active:
+            return
+
+        metrics, reply = _active[-1], event.reply
+        metrics.mongo_s += event.duration_micros / 1e6
+        if self.count_bytes:
+            metrics.bytes_received += len(bson.encode(reply))
+
+        if event.command_name in WRITE_COMMANDS:
+            metrics.docs_written += reply.get('n', 0)
+        elif event.command_name in READ_COMMANDS and 'cursor' in reply:
+            cursor = reply['cursor']
+            metrics.docs_read += len(cursor.get('firstBatch', cursor.get('nextBatch', [])))
+
+    def failed(self, event):
+        if _active:
+            _active[-1].mongo_s += event.duration_micros / 1e6
+
+
+_listener = None
+
+
+def counting_bytes():
+    return COUNT_BYTES_ENV in os.environ
+
+
+def start_counting_bytes():
+    """Turns on byte counting (see MongoMetricsListener), for this process and any worker
+    processes started after it. Must be called before the listener is registered.
+    """
+    os.environ[COUNT_BYTES_ENV] = '1'
+
+
+def register_metrics_listener():
+    """Registers a MongoMetricsListener with pymongo, once per process. Only clients created
+    after it's registered (ie - by connect) report to it.
+    """
+    global _listener
+    if _listener is None:
+        _listener = MongoMetricsListener(count_bytes=counting_bytes())
+        monitoring.register(_listener)
+
+
+def count_rows(n):
+    """Adds to the number of input rows read by the unit currently being measured, if any."""
+    if _active:
+        _active[-1].rows_read += n
+
+
+class measure:
+    """A context manager measuring the wall time, CPU time, rows read and database traffic
+    of the work done inside it.
+
+        with measure(stage='tiger', state='VT') as metrics:
+            ...
+        metrics.as_dict()
+    """
+
+    def __init__(self, **labels):
+        self.metrics = UnitMetrics(**labels)
+
+    def __enter__(self):
+        _active.append(self.metrics)
+        self._wall, self._cpu = time.perf_counter(), time.process_time()
+        return self.metrics
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.metrics.wall_s = time.perf_counter() - self._wall
+        self.metrics.cpu_s = time.process_time() - self._cpu
+        _active.remove(self.metrics)
+
+
+class MetricsReport:
+    """Collects UnitMetrics, and reports them as JSON and as a table grouped by a label.
+
+    Args:
+        name (str): the name of what's being reported on, ie - the database being built.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.units = []
+
+    def add(self, metrics):
+        self.units.append(metrics.as_dict() if isinstance(metrics, UnitMetrics) else metrics)
+
+    def totals(self, by):
+        """Sums every unit's metrics by the value of one of their labels."""
+        totals = {}
+        for unit in self.units:
+            group = totals.setdefault(unit[by], {field: 0 for field in UnitMetrics.fields()})
+            for field in UnitMetrics.fields():
+                group[field] += unit[field]
+        return totals
+
+    def write(self, path, **extra):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'name': self.name, **extra, 'units': self.units}, f, indent=2)
+
+    def table(self, by):
+        """Returns a compact, fixed-width table of the report's totals by one label."""
+        headers = (by,) + UnitMetrics.fields()
+        rows = [
+            (str(group),) + tuple(
+                f"{v:.2f}" if isinstance(v, float) else str(v)
+                for v in (totals[field] for field in UnitMetrics.fields())
+            )
+            for group, totals in self.totals(by).items()
+        ]
+
+        widths = [max(len(r[i]) for r in [headers] + rows) for i in range(len(headers))]
+        return "\n".join(
+            "  ".join([row[0].ljust(widths[0])] + [
+                v.rjust(w) for v, w in zip(row[1:], widths[1:])
+            ])
+            for row in [headers] + rows
+        )
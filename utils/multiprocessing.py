@@ -1,42 +1,191 @@
-from multiprocessing import Manager
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from mongoengine import connect, disconnect
+from .metrics import register_metrics_listener
+from .tracing import register_trace_listener, span
+from .profiling import profile_process
+from .query_census import register_census_listener
 
 
-def run_with_pool(worker, work_items, update_callback=None, db=None, chunksize=None):
-    """ Maps a worker function onto a list of work items using a pool of concurrent workers"""
+class WorkResult:
+    """The outcome of running a worker function on a single work item."""
 
-    if db:
-        db.disconnect(quiet=True)
+    def __init__(self, item, result=None, exception=None):
+        self.item = item
+        self.result = result
+        self.exception = exception
 
-    chunk_size = len(work_items) if not chunksize else chunksize
-    items_handled = 0
-    batch_ind = 0
+    @property
+    def ok(self):
+        return self.exception is None
 
-    while(batch := work_items[batch_ind: batch_ind+chunk_size]):
-        batch_ind += chunk_size
+    def __repr__(self):
+        outcome = f"result={self.result!r}" if self.ok else f"exception={self.exception!r}"
+        return f"<WorkResult(item={self.item!r}, {outcome})>"
 
-        # design for ProcessPoolExecutor code snippet from https://stackoverflow.com/a/47108581
-        with Manager() as manager:
-            lock = manager.Lock()  # use of Manager.Lock() inspired by is.gd/IjgMVc
 
-            with ProcessPoolExecutor(max_workers=6) as pool:
+class WorkerPoolError(Exception):
+    """Raised once a pool has drained if any work item failed. Every WorkResult, including
+    those of the items that completed successfully, is kept in the results attribute.
+    """
 
-                if update_callback:
-                    update_callback(items_handled)
+    def __init__(self, message, results):
+        super().__init__(message)
+        self.results = results
 
-                futures = [pool.submit(worker, item, lock) for item in batch]
+    @property
+    def failures(self):
+        return [r for r in self.results if not r.ok]
 
-                for f in as_completed(futures):
-                    if f.exception() is not None:
-                        for f in futures:
-                            f.cancel()
-                        break
-                    else:
-                        items_handled += 1
-                        if update_callback:
-                            update_callback(items_handled)
 
-                [f.result() for f in futures]
+def connect_worker(host):
+    """A WorkerPool initializer that gives each worker process its own database connection."""
+    register_metrics_listener()
+    register_trace_listener()
+    register_census_listener()
 
-    if db:
-        db.connect(quiet=True)
+    disconnect()
+    connect(host=host)
+
+
+def _initialize_worker(initializer, initargs):
+    profile_process()
+    if initializer is not None:
+        initializer(*initargs)
+
+
+class WorkerPool:
+    """A persistent pool of worker processes, used as a context manager.
+
+    Workers are started with the 'spawn' start method so that no database connection (or
+    any other state) is inherited from the parent process - use the initializer to set up
+    per-worker state, ie - initializer=connect_worker, initargs=(host,). Each worker is
+    also profiled, if profiling is on (see utils.profiling).
+
+    Args:
+        workers (int, optional): the number of worker processes. Defaults to the CPU count.
+        initializer (callable, optional): called once in each worker process when it starts.
+        initargs (tuple, optional): the arguments passed to the initializer.
+        max_in_flight (int, optional): the most work items submitted to the pool at once by
+            imap. Defaults to twice the number of workers.
+    """
+
+    def __init__(self, workers=None, initializer=None, initargs=(), max_in_flight=None):
+        self.workers = workers or os.cpu_count()
+        self.initializer = initializer
+        self.initargs = initargs
+        self.max_in_flight = max_in_flight or 2 * self.workers
+        self._executor = None
+
+    def __enter__(self):
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_initialize_worker,
+            initargs=(self.initializer, self.initargs),
+        )
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._executor.shutdown(wait=True, cancel_futures=exc_type is not None)
+        self._executor = None
+
+    def submit(self, func, *args, **kwargs):
+        """Submits a single call to the pool, returning its Future."""
+        if self._executor is None:
+            raise Exception("Worker Pool Error - the pool must be entered before use")
+
+        return self._executor.submit(func, *args, **kwargs)
+
+    def imap(self, func, work_items, *args, **kwargs):
+        """Lazily maps func onto the work items, yielding a WorkResult for each as it
+        completes (not in order). At most max_in_flight items are pending at any time, so
+        work_items may be a generator that is too large to hold in memory. A failed item
+        doesn't interrupt the others.
+        """
+        items = iter(work_items)
+        pending = {}
+        exhausted = False
+
+        while True:
+            while not exhausted and len(pending) < self.max_in_flight:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                else:
+                    pending[self.submit(func, item, *args, **kwargs)] = item
+
+            if not pending:
+                return
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                item = pending.pop(future)
+
+                if (e := future.exception()) is not None:
+                    yield WorkResult(item, exception=e)
+                else:
+                    yield WorkResult(item, result=future.result())
+
+
+def run_with_pool(
+    worker, work_items, update_callback=None, db=None, chunksize=None, workers=None,
+    initializer=None, initargs=(),
+):
+    """Maps a worker function onto a list of work items using a pool of concurrent workers.
+
+    Args:
+        worker (callable): a module-level function, called with each work item.
+        work_items (iterable): the items to handle.
+        update_callback (callable, optional): called with the number of items handled so
+            far, each time an item finishes.
+        db (ClimateCabinetDBManager, optional): if given (and no initializer is), each worker
+            connects to the same database.
+        chunksize (int, optional): the most work items in flight at once.
+        workers (int, optional): the number of worker processes. Defaults to the CPU count.
+        initializer (callable, optional): called once in each worker process when it starts.
+        initargs (tuple, optional): the arguments passed to the initializer.
+
+    Returns:
+        [WorkResult]: the results of every item, in the order of work_items.
+
+    Raises:
+        WorkerPoolError: once every item has been handled, if any of them failed.
+    """
+    if db and not initializer:
+        initializer, initargs = connect_worker, (db.host,)
+
+    work_items = list(work_items)
+    results = []
+
+    if update_callback:
+        update_callback(0)
+
+    with WorkerPool(workers, initializer, initargs, max_in_flight=chunksize) as pool:
+        for result in pool.imap(_call_with_item, enumerate(work_items), worker):
+            results.append(result)
+            if update_callback:
+                update_callback(len(results))
+
+    # imap is handed (index, item) pairs so results can be put back into order
+    ordered = [None] * len(work_items)
+    for r in results:
+        i, r.item = r.item
+        ordered[i] = r
+
+    if failures := [r for r in ordered if not r.ok]:
+        raise WorkerPoolError(
+            f"Run With Pool Error - {len(failures)} of {len(ordered)} work items failed, "
+            f"the first of which was {failures[0].item!r}",
+            ordered,
+        ) from failures[0].exception
+
+    return ordered
+
+
+def _call_with_item(indexed_item, worker):
+    with span(worker.__name__, cat='work item', index=indexed_item[0]):
+        return worker(indexed_item[1])
@@ -0,0 +1,135 @@
+"""Opt-in whole-process profiling, with a file per process (ie - per pool worker).
+
+Profiling is turned on with start_profiling, which sets the PROFILE_MODE_ENV and
+PROFILE_DIR_ENV environment variables (inherited by every worker process), and starts a
+profiler in this process. Each WorkerPool worker starts its own profiler when it's
+initialized, and every profiler writes its file to the profile directory as its process
+exits. There are two modes:
+    * cprofile - a deterministic cProfile of the process' main thread, written as a
+      .pstats file (ie - for `python -m pstats`, or snakeviz)
+    * sample - a statistical profile of every thread, written as .collapsed stacks (one
+      "root;...;leaf count" line per stack), ready for flamegraph.pl or speedscope
+
+With profiling off, the only cost is an environment lookup as each worker starts.
+"""
+import os
+import sys
+import cProfile
+import threading
+import multiprocessing
+from collections import Counter
+from multiprocessing.util import Finalize
+from pathlib import Path
+
+PROFILE_MODE_ENV = 'CCDB_PROFILE_MODE'
+PROFILE_DIR_ENV = 'CCDB_PROFILE_DIR'
+PROFILE_MODES = ('cprofile', 'sample')
+
+_finalizer = None
+
+
+class StackSampler(threading.Thread):
+    """A daemon thread sampling the stacks of every other thread in its process.
+
+    Args:
+        interval (float, optional): the number of seconds between samples.
+    """
+
+    def __init__(self, interval=0.005):
+        super().__init__(name='StackSampler', daemon=True)
+        self.interval = interval
+        self.counts = Counter()
+        self._stopped = threading.Event()
+
+    @staticmethod
+    def collapse(frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(
+                f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            )
+            frame = frame.f_back
+        return ';'.join(reversed(stack))
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != self.ident:
+                    self.counts[self.collapse(frame)] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.counts.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def _get_profile_path(suffix):
+    role = 'main' if multiprocessing.parent_process() is None else 'worker'
+    return Path(os.environ[PROFILE_DIR_ENV]) / f"{role}-{os.getpid()}{suffix}"
+
+
+def _finish_cprofile(profiler):
+    profiler.disable()
+    profiler.dump_stats(_get_profile_path('.pstats'))
+
+
+def _finish_sample(sampler):
+    sampler.stop()
+    sampler.write(_get_profile_path('.collapsed'))
+
+
+def profile_process():
+    """Starts profiling this process if profiling is on (and it hasn't already started).
+    The profile is written when the process exits, or when stop_profiling is called.
+    """
+    global _finalizer
+    if _finalizer is not None or PROFILE_MODE_ENV not in os.environ:
+        return
+
+    if os.environ[PROFILE_MODE_ENV] == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+        _finalizer = Finalize(None, _finish_cprofile, args=(profiler,), exitpriority=10)
+    else:
+        sampler = StackSampler()
+        sampler.start()
+        _finalizer = Finalize(None, _finish_sample, args=(sampler,), exitpriority=10)
+
+
+def start_profiling(mode, profile_dir):
+    """Profiles this process, and every worker process it starts from now on.
+
+    Args:
+        mode (str): one of PROFILE_MODES.
+        profile_dir (Path): the directory each process' profile is written to.
+    """
+    if mode not in PROFILE_MODES:
+        raise ValueError(
+            f"Profiling Error - unknown mode '{mode}', expected one of {PROFILE_MODES}"
+        )
+
+    Path(profile_dir).mkdir(parents=True, exist_ok=True)
+    os.environ[PROFILE_MODE_ENV] = mode
+    os.environ[PROFILE_DIR_ENV] = str(profile_dir)
+    profile_process()
+
+
+def stop_profiling():
+    """Writes this process' profile, and turns profiling off for any later workers.
+
+    Returns:
+        [Path]: every profile written to the profile directory so far.
+    """
+    global _finalizer
+    if _finalizer is not None:
+        _finalizer()
+        _finalizer = None
+
+    os.environ.pop(PROFILE_MODE_ENV, None)
+    profile_dir = Path(os.environ.pop(PROFILE_DIR_ENV))
+    return sorted(profile_dir.iterdir())
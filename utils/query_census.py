@@ -0,0 +1,342 @@
+"""An opt-in census of the MongoDB commands a run sends, for finding N+1 query patterns.
+
+Every command is fingerprinted by its name, collection and the shape of its filter - with
+every value normalized out, so that Region.objects(ccid='...') is counted as the same
+query whichever CCID it's for. Fingerprints are counted per scope (ie - per build unit,
+one stage for one state, see census_scope), and any fingerprint sent more than a threshold
+number of times in one scope is flagged as a likely N+1. The worst offenders can then be
+explained, to show whether they're served by an index or a collection scan.
+
+The census is turned on with start_census, which (like utils.tracing) points an
+environment variable at a scratch directory that worker processes inherit. Each process
+counts its own commands, and writes them to that directory as it exits - finish_census
+merges them back together.
+
+assert_max_queries bounds the number of commands sent inside a block, ie - in a test (see
+tests/test_query_bounds.py):
+
+    register_census_listener(force=True)  # before connecting
+    ...
+    with assert_max_queries(3):
+        refresh_state_fragments('VT', fragments)
+"""
+import os
+import json
+import shutil
+import tempfile
+from collections import Counter
+from multiprocessing.util import Finalize
+from pathlib import Path
+from bson import json_util
+from pymongo import monitoring
+
+CENSUS_DIR_ENV = 'CCDB_QUERY_CENSUS_DIR'
+DEFAULT_SCOPE = '-'
+
+# handshakes, auth, session and cursor bookkeeping - none of which a loader chooses to send
+IGNORED_COMMANDS = {
+    'isMaster', 'ismaster', 'hello', 'ping', 'buildInfo', 'buildinfo', 'saslStart',
+    'saslContinue', 'getnonce', 'authenticate', 'endSessions', 'killCursors', 'getMore',
+    'getLastError', 'listDatabases', 'serverStatus', 'explain',
+}
+# the field of each command holding its filter
+FILTER_FIELDS = {
+    'find': 'filter', 'count': 'query', 'distinct': 'query', 'findAndModify': 'query',
+    'aggregate': 'pipeline', 'update': 'updates', 'delete': 'deletes',
+}
+# the fields of a command that only matter to the session or connection it was sent over
+SESSION_FIELDS = {'lsid', '$clusterTime', '$db', 'txnNumber', '$readPreference', 'signature'}
+
+_scopes = [DEFAULT_SCOPE]
+_recorders = []
+_census = None
+_listener = None
+_threshold = None
+
+
+def normalize(value):
+    """Replaces every value in a filter with '?', keeping its keys and operators."""
+    if isinstance(value, dict):
+        return {k: normalize(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        shapes = [normalize(v) for v in value]
+        # a list of values (ie - for $in) is the same query however long it is
+        return ['?'] if all(shape == '?' for shape in shapes) else shapes
+    return '?'
+
+
+def fingerprint(command_name, command):
+    """Returns the fingerprint of a command, ie - 'find region {"ccid": "?"}'."""
+    collection = command.get(command_name)
+    query = command.get(FILTER_FIELDS.get(command_name), {})
+
+    if command_name in ('update', 'delete'):
+        # a bulk write is fingerprinted by the filter of its first statement
+        query = (query[0].get('q', {}) if query else {})
+
+    return f"{command_name} {collection} {json.dumps(normalize(query), sort_keys=True)}"
+
+
+class QueryCensus:
+    """The number of times each command fingerprint was sent in each scope, and how long
+    they took, along with a sample of each fingerprint's commands (to explain).
+    """
+
+    def __init__(self, threshold=None):
+        self.counts = Counter()
+        self.micros = Counter()
+        self.samples = {}
+        self.threshold = threshold
+
+    def record(self, scope, command_name, command, database_name, duration_micros):
+        key = (scope, fingerprint(command_name, command))
+        self.counts[key] += 1
+        self.micros[key] += duration_micros
+
+        if key[1] not in self.samples:
+            self.samples[key[1]] = (
+                database_name,
+                {k: v for k, v in command.items() if k not in SESSION_FIELDS},
+            )
+
+    def __len__(self):
+        return sum(self.counts.values())
+
+    def merge(self, other):
+        self.counts.update(other.counts)
+        self.micros.update(other.micros)
+        for fp, sample in other.samples.items():
+            self.samples.setdefault(fp, sample)
+
+    def suspects(self, threshold=None):
+        """Returns the (scope, fingerprint) and count of each fingerprint sent more than
+        threshold times in a scope - likely N+1s - most frequent first.
+        """
+        threshold = self.threshold if threshold is None else threshold
+        return [(key, n) for key, n in self.counts.most_common() if n > threshold]
+
+    def explain(self, client, fingerprint):
+        """Explains the sample command of a fingerprint, returning the stages of its winning
+        plan (ie - 'FETCH > IXSCAN', or 'COLLSCAN'), or None if it can't be explained.
+        """
+        database_name, command = self.samples[fingerprint]
+        if (command_name := next(iter(command))) not in FILTER_FIELDS:
+            return None
+
+        if command_name in ('update', 'delete'):
+            # only a single statement can be explained at once
+            field = FILTER_FIELDS[command_name]
+            command = {**command, field: command[field][:1]}
+
+        explained = client[database_name].command(
+            {'explain': command, 'verbosity': 'queryPlanner'}
+        )
+        plan = _find_key(explained, 'winningPlan')
+        return ' > '.join(_plan_stages(plan)) if plan else None
+
+    def summary(self, client=None, top=5):
+        """Returns a printable summary of the likely N+1s, with the query plans of the top
+        offenders if a client is given to explain them with.
+        """
+        suspects = self.suspects()
+        lines = [
+            f"{len(self)} queries, {len(self.counts)} (scope, fingerprint) pairs, "
+            f"{len(suspects)} sent more than {self.threshold} times in a scope"
+        ]
+
+        for i, ((scope, fp), n) in enumerate(suspects):
+            lines.append(f"\t{n:>8}x  {scope}: {fp}")
+            if client is not None and i < top:
+                try:
+                    lines.append(f"\t{'':>10}plan: {self.explain(client, fp)}")
+                except Exception as e:
+                    lines.append(f"\t{'':>10}plan: unable to explain ({e!r})")
+
+        return "\n".join(lines)
+
+    def as_dict(self):
+        return {
+            'queries': [
+                {
+                    'scope': scope, 'fingerprint': fp, 'count': n,
+                    'ms': self.micros[scope, fp] / 1000,
+                }
+                for (scope, fp), n in self.counts.most_common()
+            ],
+            'threshold': self.threshold,
+            'samples': {
+                fp: {'db': db, 'command': json.loads(json_util.dumps(command))}
+                for fp, (db, command) in self.samples.items()
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        census = cls(d.get('threshold'))
+        for q in d['queries']:
+            census.counts[(q['scope'], q['fingerprint'])] += q['count']
+            census.micros[(q['scope'], q['fingerprint'])] += int(q['ms'] * 1000)
+        census.samples = {
+            fp: (s['db'], json_util.loads(json.dumps(s['command'])))
+            for fp, s in d['samples'].items()
+        }
+        return census
+
+
+def _find_key(d, key):
+    if isinstance(d, dict):
+        if key in d:
+            return d[key]
+        d = list(d.values())
+    if isinstance(d, list):
+        for v in d:
+            if (found := _find_key(v, key)) is not None:
+                return found
+    return None
+
+
+def _plan_stages(plan):
+    stages = [plan['stage']] if 'stage' in plan else []
+    for child in [plan.get('inputStage'), plan.get('queryPlan')] + plan.get('inputStages', []):
+        if child:
+            stages.extend(_plan_stages(child))
+    return stages
+
+
+class CensusListener(monitoring.CommandListener):
+    """Records every command sent while a census (or assert_max_queries) is recording."""
+
+    def __init__(self):
+        self._started = {}
+
+    def started(self, event):
+        recording = _census is not None or _recorders
+        if recording and event.command_name not in IGNORED_COMMANDS:
+            self._started[event.request_id] = (event.command, event.database_name)
+
+    def succeeded(self, event):
+        if (started := self._started.pop(event.request_id, None)) is None:
+            return
+
+        for census in ([_census] if _census is not None else []) + _recorders:
+            census.record(_scopes[-1], event.command_name, *started, event.duration_micros)
+
+    def failed(self, event):
+        self.succeeded(event)
+
+
+def census_enabled():
+    return CENSUS_DIR_ENV in os.environ
+
+
+def register_census_listener(force=False):
+    """Registers a CensusListener with pymongo if the census is on (or force is True), once
+    per process. Only clients created after it's registered report to it.
+    """
+    global _listener, _census
+    if _listener is None and (force or census_enabled()):
+        _listener = CensusListener()
+        monitoring.register(_listener)
+
+    if census_enabled() and _census is None:
+        _census = QueryCensus()
+        Finalize(None, flush_census, exitpriority=10)
+
+
+class census_scope:
+    """Attributes the commands sent inside it to a scope, ie - a build unit."""
+
+    def __init__(self, scope):
+        self.scope = scope
+
+    def __enter__(self):
+        _scopes.append(self.scope)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _scopes.pop()
+
+
+class assert_max_queries:
+    """Raises an AssertionError if more than max_queries commands (optionally, of a single
+    fingerprint) are sent inside it. The census listener must be registered (see
+    register_census_listener) before the connection is made.
+    """
+
+    def __init__(self, max_queries, fingerprint=None):
+        self.max_queries = max_queries
+        self.fingerprint = fingerprint
+        self.census = QueryCensus()
+
+    def __enter__(self):
+        if _listener is None:
+            raise AssertionError(
+                "Query Census Error - the census listener isn't registered, so no queries "
+                "can be counted"
+            )
+        _recorders.append(self.census)
+        return self.census
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _recorders.remove(self.census)
+        if exc_type is not None:
+            return
+
+        counted = sum(
+            n for (_, fp), n in self.census.counts.items()
+            if self.fingerprint in (None, fp)
+        )
+        if counted > self.max_queries:
+            raise AssertionError(
+                f"Query Census Error - expected at most {self.max_queries} queries, but "
+                f"{counted} were sent:\n\t" + "\n\t".join(
+                    f"{n}x {fp}" for (_, fp), n in self.census.counts.most_common()
+                )
+            )
+
+
+def flush_census():
+    """Writes this process' census to its file in the census directory."""
+    if _census is None or not census_enabled():
+        return
+
+    path = Path(os.environ[CENSUS_DIR_ENV]) / f"{os.getpid()}-{id(_census)}.json"
+    with open(path, 'w') as f:
+        json.dump(_census.as_dict(), f)
+
+    _census.__init__()
+
+
+def start_census(threshold):
+    """Turns the census on for this process and every process it starts from now on.
+
+    Args:
+        threshold (int): the number of times a fingerprint can be sent in a single scope
+            before it's flagged as a likely N+1.
+    """
+    global _threshold
+    _threshold = threshold
+    os.environ[CENSUS_DIR_ENV] = tempfile.mkdtemp(prefix='ccdb-census-')
+    register_census_listener()
+
+
+def finish_census():
+    """Merges and returns the census of every process, and turns the census back off.
+
+    Worker processes only write their census as they exit, so any pool they belong to
+    should have been shut down first.
+    """
+    global _census
+    census_dir = os.environ.pop(CENSUS_DIR_ENV)
+    merged = QueryCensus(_threshold)
+    if _census is not None:
+        merged.merge(_census)
+    _census = None
+
+    try:
+        for path in Path(census_dir).glob('*.json'):
+            with open(path, 'r') as f:
+                merged.merge(QueryCensus.from_dict(json.load(f)))
+    finally:
+        shutil.rmtree(census_dir, ignore_errors=True)
+
+    return merged
@@ -0,0 +1,188 @@
+"""Opt-in timeline tracing, exported in the Chrome trace-event format (for Perfetto, or
+chrome://tracing).
+
+Tracing is turned on with start_tracing, which points the TRACE_DIR_ENV environment
+variable at a scratch directory. Worker processes inherit the environment, so every
+process traces itself: spans (and MongoDB commands, through TraceListener) are buffered
+in memory, and each process writes its buffer to its own file in the scratch directory as
+it exits. finish_tracing then merges every process' file into a single trace.
+
+    start_tracing()
+    with span('tiger VT', cat='unit'):
+        ...
+    finish_tracing('out.json')
+
+Spans cost a single environment lookup while tracing is off.
+"""
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+import multiprocessing
+from functools import wraps
+from multiprocessing.util import Finalize
+from pathlib import Path
+from pymongo import monitoring
+
+TRACE_DIR_ENV = 'CCDB_TRACE_DIR'
+
+_events = []
+_finalizer = None
+_listener = None
+
+
+def tracing_enabled():
+    return TRACE_DIR_ENV in os.environ
+
+
+def _now_us():
+    # wall clock microseconds, so that timestamps line up across processes
+    return time.time_ns() // 1000
+
+
+def _record(event):
+    global _finalizer
+    if _finalizer is None:
+        # flushed as the process exits - including pool workers, once their pool shuts down
+        _finalizer = Finalize(None, flush_trace, exitpriority=10)
+
+    _events.append({'pid': os.getpid(), 'tid': threading.get_native_id(), **event})
+
+
+def flush_trace():
+    """Writes this process' buffered events to its file in the trace directory."""
+    if not _events or not tracing_enabled():
+        return
+
+    trace_dir = Path(os.environ[TRACE_DIR_ENV])
+    role = 'main' if multiprocessing.parent_process() is None else 'worker'
+
+    with open(trace_dir / f"{os.getpid()}-{_now_us()}.json", 'w') as f:
+        json.dump({'pid': os.getpid(), 'role': role, 'events': _events}, f)
+
+    _events.clear()
+
+
+class span:
+    """A context manager recording the time spent inside it as a complete ('X') event.
+
+    Args:
+        name (str): the span's name, ie - 'tiger VT'.
+        cat (str, optional): the span's category, ie - 'unit', 'file' or 'flush'.
+        **args: any other details to show with the span.
+    """
+
+    def __init__(self, name, cat='ccdb', **args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self._start = _now_us() if tracing_enabled() else None
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._start is None:
+            return
+
+        _record({
+            'name': self.name,
+            'cat': self.cat,
+            'ph': 'X',
+            'ts': self._start,
+            'dur': _now_us() - self._start,
+            'args': {**self.args, **({'error': repr(exc_val)} if exc_type else {})},
+        })
+
+
+def traced(name=None, cat='ccdb'):
+    """Decorates a function, recording each of its calls as a span."""
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name or func.__qualname__, cat=cat):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+class TraceListener(monitoring.CommandListener):
+    """Records every MongoDB command as a span, ending when its reply (or error) arrives."""
+
+    def started(self, event):
+        pass
+
+    def _finished(self, event, **args):
+        end = _now_us()
+        _record({
+            'name': event.command_name,
+            'cat': 'mongo',
+            'ph': 'X',
+            'ts': end - event.duration_micros,
+            'dur': event.duration_micros,
+            'args': {'db': event.database_name, **args},
+        })
+
+    def succeeded(self, event):
+        self._finished(event)
+
+    def failed(self, event):
+        self._finished(event, failure=str(event.failure))
+
+
+def register_trace_listener():
+    """Registers a TraceListener with pymongo if tracing is on, once per process. Only
+    clients created after it's registered report to it.
+    """
+    global _listener
+    if _listener is None and tracing_enabled():
+        _listener = TraceListener()
+        monitoring.register(_listener)
+
+
+def start_tracing():
+    """Turns tracing on for this process and every process it starts from now on."""
+    os.environ[TRACE_DIR_ENV] = tempfile.mkdtemp(prefix='ccdb-trace-')
+
+
+def merge_traces(trace_dir, out_path):
+    """Merges the files of every traced process into a single Chrome trace-event file."""
+    events = []
+
+    for path in sorted(Path(trace_dir).glob('*.json')):
+        with open(path, 'r') as f:
+            trace = json.load(f)
+
+        events.append({
+            'name': 'process_name', 'ph': 'M', 'pid': trace['pid'],
+            'args': {'name': f"{trace['role']} ({trace['pid']})"},
+        })
+        events.append({
+            'name': 'process_sort_index', 'ph': 'M', 'pid': trace['pid'],
+            'args': {'sort_index': 0 if trace['role'] == 'main' else 1},
+        })
+        events.extend(trace['events'])
+
+    with open(out_path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    return len(events)
+
+
+def finish_tracing(out_path):
+    """Merges every process' trace into out_path, and turns tracing back off.
+
+    Worker processes only write their traces as they exit, so any pool they belong to
+    should have been shut down first.
+    """
+    flush_trace()
+    trace_dir = os.environ.pop(TRACE_DIR_ENV)
+
+    try:
+        return merge_traces(trace_dir, out_path)
+    finally:
+        shutil.rmtree(trace_dir, ignore_errors=True)